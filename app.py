@@ -1,46 +1,48 @@
 import os
+import time
 from dotenv import load_dotenv
 import glob
 
+# Inicio de la importación del módulo (para medir el tiempo de arranque)
+_INICIO_IMPORT = time.perf_counter()
+
 # --- Cargar variables de entorno ANTES de todo ---
 load_dotenv()
 
 import json
-import time
 import re
 import logging
 import sys
 import codecs
-from datetime import datetime
+import queue
+import threading
+import uuid
+import hmac
+from functools import wraps
+from collections import Counter
+from datetime import datetime, timedelta
 from email_validator import validate_email, EmailNotValidError
-import google.generativeai as genai
-from flask import Flask, request, Response, jsonify
+from flask import Flask, request, Response, jsonify, g
 from flask_cors import CORS
-
-# Debug opcional para ver la carga de variables
-print("DEBUG DB_PASSWORD:", os.getenv("DB_PASSWORD"))
+from werkzeug.test import EnvironBuilder
 
 sys.stdout = codecs.getwriter("utf-8")(sys.stdout.detach())
 
-# --- Configuración de logging ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),  # ya con UTF-8
-        logging.FileHandler('app.log', encoding='utf-8')  # importante para el archivo también
-    ]
-)
+# --- Configuración de logging (asíncrono, JSON, ver logs.py) ---
+import logs
+logs.configurar_logging()
 logger = logging.getLogger(__name__)
 
 # --- Validación de variables de entorno ---
-required_env_vars = [
-    'GEMINI_API_KEY',
-    'DB_HOST',
-    'DB_NAME',
-    'DB_USER',
-    'DB_PASSWORD'
-]
+# Proveedor del modelo: 'gemini' (producción) o 'fake' (local, ver fake_llm.py)
+LLM_PROVIDER = os.getenv('LLM_PROVIDER', 'gemini').lower()
+
+required_env_vars = []
+# Con DB_ENGINE=sqlite la base de datos es un archivo local (storage.py)
+if os.getenv('DB_ENGINE', 'mysql').lower() != 'sqlite':
+    required_env_vars += ['DB_HOST', 'DB_NAME', 'DB_USER', 'DB_PASSWORD']
+if LLM_PROVIDER != 'fake':
+    required_env_vars.insert(0, 'GEMINI_API_KEY')
 
 for var in required_env_vars:
     if os.getenv(var) is None:
@@ -53,9 +55,67 @@ CORS(app, resources={r"/*": {"origins": "*"}})
 
 # Importar después de cargar entorno y validar
 from database import db_manager
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+from upstream import UpstreamGovernor, UpstreamNoDisponible, cancelar_respuesta
+from catalog import precalcular_resumenes, obtener_resumen, CatalogoBinario, IndiceCatalogo
+from tour_search import IndicePrecios, extraer_restricciones, filtra_por_precio
+from assets import AssetsWidget
+from responses import ProveedorJSON, respuesta_json_stream, comprimir_respuesta, SERIALIZADOR
+from exports import exportar, parsear_fecha, FORMATOS, COLUMNAS, EXPORT_BATCH
+from stats import BUCKETS as STATS_BUCKETS, IDIOMA_TODOS
+from cache import crear_cache
+import spool
+from profiling import perfilador, memoria, funciones_principales, PROFILER_MAX_REQUESTS
+from pipeline import ejecutar_grafo, MetricasEtapas
+from idempotency import Generacion, RegistroIdempotencia, RegistroCompartido
+from health import ProbadorSalud
+
+# jsonify con serializador rápido (msgspec); compresión en comprimir_respuestas_grandes
+app.json = ProveedorJSON(app)
+
+_genai = None
+_genai_lock = threading.Lock()
+
+def obtener_genai():
+    """Importa y configura google.generativeai en el primer uso (es un import pesado)."""
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+                _genai = genai
+    return _genai
+
+def crear_modelo(model_name, **kwargs):
+    """Crea el modelo generativo según LLM_PROVIDER."""
+    if LLM_PROVIDER == 'fake':
+        from fake_llm import FakeGenerativeModel
+        return FakeGenerativeModel(model_name=model_name, **kwargs)
+    return obtener_genai().GenerativeModel(model_name=model_name, **kwargs)
 
-gemini_model = genai.GenerativeModel(
+class ModeloPerezoso:
+    """Envoltorio que crea el modelo real en la primera llamada a generate_content."""
+    
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+        self._kwargs = kwargs
+        self._modelo = None
+        self._lock = threading.Lock()
+    
+    def cargar(self):
+        if self._modelo is None:
+            with self._lock:
+                if self._modelo is None:
+                    self._modelo = crear_modelo(self.model_name, **self._kwargs)
+        return self._modelo
+    
+    def generate_content(self, *args, **kwargs):
+        return self.cargar().generate_content(*args, **kwargs)
+
+# Todas las llamadas al modelo pasan por este gobernador (concurrencia, reintentos, circuito)
+gemini_governor = UpstreamGovernor.desde_entorno('gemini', prefijo='GEMINI')
+
+gemini_model = ModeloPerezoso(
     model_name="gemini-2.0-flash-exp",  # Cambiado a Gemini 2.0 Flash Experimental
     generation_config={
         "temperature": 0.6,
@@ -70,10 +130,94 @@ gemini_model = genai.GenerativeModel(
         {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
     ]
 )
+translation_model = ModeloPerezoso('gemini-1.5-flash')
 
 # --- Constantes y configuraciones ---
 MAX_HISTORY_TURNS = 5
 MAX_SESSION_AGE_DAYS = 30
+# Presupuesto (segundos desde que llega la petición) para recibir el primer token del modelo.
+# Pasado ese tiempo se responde en modo degradado solo con el catálogo.
+CHAT_FIRST_TOKEN_BUDGET = float(os.getenv('CHAT_FIRST_TOKEN_BUDGET', 8))
+# Responder localmente (sin LLM) las consultas generales de la primera interacción
+LOCAL_FAST_PATH = os.getenv('LOCAL_FAST_PATH', '1') != '0'
+# Motor de búsqueda de tours de /chat (ver BACKENDS_BUSQUEDA y benchmarks/eval_retrieval.py)
+RETRIEVAL_BACKEND = os.getenv('RETRIEVAL_BACKEND', 'keywords')
+# Marca añadida a las respuestas guardadas cuando el cliente se desconecta a mitad del stream
+MARCA_RESPUESTA_TRUNCADA = "\n\n[respuesta truncada: el cliente cerró la conexión]"
+# ...y cuando es el modelo el que falla a mitad del stream
+MARCA_RESPUESTA_INTERRUMPIDA = "\n\n[respuesta truncada: el modelo falló a mitad de la respuesta]"
+# Claves de idempotencia de /chat: caducidad y espera a un reintento antes de cancelar
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 600))
+IDEMPOTENCY_REATTACH_GRACE = float(os.getenv('IDEMPOTENCY_REATTACH_GRACE', 15))
+# Probador de salud en segundo plano (/livez, /readyz, /health leen su caché)
+HEALTH_PROBE_INTERVAL = float(os.getenv('HEALTH_PROBE_INTERVAL', 15))
+HEALTH_PROBE_TIMEOUT = float(os.getenv('HEALTH_PROBE_TIMEOUT', 5))
+READY_REQUIRES_LLM = os.getenv('READY_REQUIRES_LLM', '0') == '1'
+# Caché HTTP de la API de catálogo (/destinations, /tours): segundos frescos y de revalidación en segundo plano
+CATALOG_CACHE_MAX_AGE = int(os.getenv('CATALOG_CACHE_MAX_AGE', 300))
+CATALOG_CACHE_SWR = int(os.getenv('CATALOG_CACHE_SWR', 86400))
+CATALOG_PAGE_MAX = 200
+# Páginas de /session/<id>/history (keyset por id de mensaje)
+HISTORY_PAGE_DEFAULT = int(os.getenv('HISTORY_PAGE_DEFAULT', 50))
+HISTORY_PAGE_MAX = 200
+# Caché compartida (ver cache.py): segundos de vida por tipo de dato
+CACHE_TTL_USER = int(os.getenv('CACHE_TTL_USER', 300))
+CACHE_TTL_HISTORY = int(os.getenv('CACHE_TTL_HISTORY', 600))
+CACHE_TTL_TRANSLATION = int(os.getenv('CACHE_TTL_TRANSLATION', 86400))
+# ultimo_acceso de los usuarios servidos desde la caché: segundos entre actualizaciones por sesión
+LAST_ACCESS_INTERVAL = int(os.getenv('LAST_ACCESS_INTERVAL', 60))
+# Serie de /admin/stats/series: días por defecto y rango máximo
+STATS_SERIES_DEFAULT_DAYS = 30
+STATS_SERIES_MAX_DAYS = 3 * 366
+# Token de los endpoints de diagnóstico y de exportación (/admin/profile, /admin/memory, /admin/export); sin token están desactivados
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+# Assets del widget con hash en el nombre: cacheables "para siempre"
+CACHE_INMUTABLE = "public, max-age=31536000, immutable"
+
+# Contadores del endpoint /chat (por proceso)
+metricas_chat = Counter()
+_metricas_lock = threading.Lock()
+
+def incrementar_metrica(nombre, n=1):
+    with _metricas_lock:
+        metricas_chat[nombre] += n
+
+def snapshot_metricas():
+    with _metricas_lock:
+        return dict(metricas_chat)
+
+# Duraciones por etapa del pipeline previo a la generación
+metricas_etapas = MetricasEtapas()
+
+registro_idempotencia = RegistroIdempotencia(ttl=IDEMPOTENCY_TTL)
+
+# Caché compartida entre workers (y nodos con Redis) para usuarios, historial y traducciones
+cache = crear_cache()
+# Dueño, progreso y respuesta de cada clave de idempotencia, visibles para todos los workers
+registro_compartido = RegistroCompartido(cache, ttl=IDEMPOTENCY_TTL)
+# Las marcas read-your-writes de las réplicas se comparten entre workers a través de la caché
+db_manager.enrutador.usar_almacen(cache)
+
+def aplicar_turno_spool(turno):
+    """Inserta en MySQL un turno del spool (idempotente por turno_id)."""
+    return db_manager.guardar_mensajes_transaccionales(
+        session_id=turno['session_id'],
+        usuario_id=turno['usuario_id'],
+        pregunta=turno['pregunta'],
+        respuesta=turno['respuesta'],
+        idioma=turno.get('idioma'),
+        turno_id=turno['turno_id'],
+        fecha=datetime.fromisoformat(turno['ts'])
+    )
+
+# Los turnos terminados se escriben en el spool local y este hilo los pasa a MySQL
+reproductor_spool = spool.ReproductorSpool(aplicar_turno_spool, db_manager.verificar_conexion)
+
+# Tiempos de arranque del proceso (import, calentamiento, primera petición real)
+metricas_arranque = {}
+
+class ClienteDesconectado(Exception):
+    """El cliente de /chat cerró la conexión antes de terminar la respuesta."""
 
 # === Funciones de utilidad ===
 def validate_user_data(nombre, correo, whatsapp):
@@ -93,7 +237,24 @@ def validate_user_data(nombre, correo, whatsapp):
     return True, ""
 
 def cargar_tours():
-    """Carga la información de tours desde el archivo JSON."""
+    """
+    Carga la información de tours.
+    
+    Si existe el catálogo binario compilado (build_catalog.py) y está al día con el
+    JSON, se abre con mmap: carga casi instantánea y páginas compartidas entre workers.
+    """
+    ruta_binario = os.getenv('TOURS_CATALOG_BIN', 'tours_ingles.bin')
+    if os.path.exists(ruta_binario):
+        try:
+            inicio = time.perf_counter()
+            catalogo = CatalogoBinario(ruta_binario)
+            if catalogo.esta_al_dia('tours_ingles.json'):
+                logger.info(f"✅ {len(catalogo)} tours cargados desde {ruta_binario} (mmap) en {(time.perf_counter() - inicio) * 1000:.2f} ms")
+                return catalogo
+            logger.warning(f"⚠️ {ruta_binario} está desactualizado, usando tours_ingles.json (ejecuta build_catalog.py)")
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ No se pudo abrir {ruta_binario}: {str(e)}")
+    
     try:
         with open('tours_ingles.json', 'r', encoding='utf-8') as f:
             tours_data = json.load(f)
@@ -107,6 +268,23 @@ def cargar_tours():
         return []
 
 tours_data_loaded = cargar_tours()
+resumenes_tours = precalcular_resumenes(tours_data_loaded)
+indice_catalogo = IndiceCatalogo(tours_data_loaded, resumenes_tours)
+indice_precios = IndicePrecios(tours_data_loaded)
+
+def cargar_assets_widget():
+    """Assets construidos por build_assets.py, si existen y están al día con static/index.html."""
+    try:
+        assets = AssetsWidget()
+        if assets.esta_al_dia(os.path.join('static', 'index.html')):
+            logger.info(f"✅ Assets del widget cargados ({assets.manifiesto['js']}, {assets.manifiesto['css']})")
+            return assets
+        logger.warning("⚠️ Assets del widget desactualizados, /app sirve static/index.html (ejecuta build_assets.py)")
+    except FileNotFoundError:
+        logger.info("ℹ️ Sin assets construidos, /app sirve static/index.html")
+    return None
+
+assets_widget = cargar_assets_widget()
 # === Configuraciones por idioma actualizadas ===
 LANGUAGE_CONFIGS = {
     'es': {
@@ -149,18 +327,24 @@ LANGUAGE_CONFIGS = {
         'error_message': "Lo siento, ocurrió un error en el servidor. Por favor, intenta más tarde o contáctanos al +51982769453 😔",
         'no_tours_message': "No encontré información específica para esa consulta, pero puedo ayudarte con nuestros tours en Puno y Lago Titicaca 🌊",
         'general_response_template': (
-            "¡Perfecto! 🎉 Como especialistas en Puno y Lago Titicaca, tenemos las mejores experiencias:\n\n"
-            "🌊 **PUNO - LAGO TITICACA** (Nuestra especialidad):\n"
+            "¡Perfecto! 🎉 Como especialistas en Puno y Lago Titicaca, tenemos las mejores experiencias ({total_tours} tours disponibles):\n\n"
+            "🌊 **PUNO - LAGO TITICACA** (Nuestra especialidad, {tours_puno} tours):\n"
             "• Islas Flotantes de los Uros - Experiencia única en totora 🛶\n"
             "• Isla Taquile - Cultura viva y textilería ancestral 🧵\n"
             "• Isla Amantani - Homestays auténticos con familias locales 🏠\n"
             "• Tours de 2d1n para experiencias completas\n"
             "*Altitud: 3,812 msnm - Recomendamos 1 día de aclimatación*\n\n"
             "🌟 **Otros destinos disponibles**:\n"
-            "🧂 Bolivia: Salar de Uyuni | 🌋 Arequipa: Cañón del Colca | 🏛️ Cusco: Machu Picchu\n\n"
+            "🧂 Bolivia: Salar de Uyuni ({tours_uyuni}) | 🌋 Arequipa: Cañón del Colca ({tours_arequipa}) | 🏛️ Cusco: Machu Picchu ({tours_cusco})\n\n"
             "Para recomendarte la experiencia perfecta: **¿Para qué fecha planeas viajar y cuántas personas van?** 📅👥"
         ),
-        'puno_priority_message': "🌊 Como especialistas en Puno y Lago Titicaca, te recomiendo especialmente nuestros tours a las islas. ¿Te interesan las experiencias en Uros, Taquile o Amantani?"
+        'puno_priority_message': "🌊 Como especialistas en Puno y Lago Titicaca, te recomiendo especialmente nuestros tours a las islas. ¿Te interesan las experiencias en Uros, Taquile o Amantani?",
+        'more_info_label': "Ver más información",
+        'degraded_intro': "Estos son los tours que mejor encajan con tu consulta 🌊:",
+        'degraded_outro': (
+            "Para recomendarte la experiencia perfecta: **¿Para qué fecha planeas viajar y cuántas personas van?** 📅👥\n"
+            "Si lo prefieres, escríbenos a nuestro WhatsApp +51982769453 📞"
+        )
     },
     'en': {
         'stopwords': {'the', 'a', 'an', 'and', 'or', 'but', 'with', 'for', 'what', 'want', 'have', 'is', 'are', 'to', 'of', 'in', 'on', 'at'},
@@ -202,18 +386,24 @@ LANGUAGE_CONFIGS = {
         'error_message': "Sorry, a server error occurred. Please try again later or contact us at +51982769453 😔",
         'no_tours_message': "I couldn't find specific information for that query, but I can help you with our Puno and Lake Titicaca tours 🌊",
         'general_response_template': (
-            "Perfect! 🎉 As specialists in Puno and Lake Titicaca, we have the best experiences:\n\n"
-            "🌊 **PUNO - LAKE TITICACA** (Our specialty):\n"
+            "Perfect! 🎉 As specialists in Puno and Lake Titicaca, we have the best experiences ({total_tours} tours available):\n\n"
+            "🌊 **PUNO - LAKE TITICACA** (Our specialty, {tours_puno} tours):\n"
             "• Floating Islands of Uros - Unique totora reed experience 🛶\n"
             "• Taquile Island - Living culture and ancestral textiles 🧵\n"
             "• Amantani Island - Authentic homestays with local families 🏠\n"
             "• 2d1n tours for complete experiences\n"
             "*Altitude: 3,812 masl - We recommend 1 day acclimatization*\n\n"
             "🌟 **Other available destinations**:\n"
-            "🧂 Bolivia: Uyuni Salt Flats | 🌋 Arequipa: Colca Canyon | 🏛️ Cusco: Machu Picchu\n\n"
+            "🧂 Bolivia: Uyuni Salt Flats ({tours_uyuni}) | 🌋 Arequipa: Colca Canyon ({tours_arequipa}) | 🏛️ Cusco: Machu Picchu ({tours_cusco})\n\n"
             "To recommend the perfect experience: **What date are you planning to travel and how many people are going?** 📅👥"
         ),
-        'puno_priority_message': "🌊 As specialists in Puno and Lake Titicaca, I especially recommend our island tours. Are you interested in experiences at Uros, Taquile or Amantani?"
+        'puno_priority_message': "🌊 As specialists in Puno and Lake Titicaca, I especially recommend our island tours. Are you interested in experiences at Uros, Taquile or Amantani?",
+        'more_info_label': "More information",
+        'degraded_intro': "These are the tours that best match your query 🌊:",
+        'degraded_outro': (
+            "To recommend the perfect experience: **What date are you planning to travel and how many people are going?** 📅👥\n"
+            "If you prefer, write to our WhatsApp +51982769453 📞"
+        )
     }
 }
 
@@ -262,74 +452,111 @@ def detectar_intencion_consulta(pregunta, language='es'):
     return 'specific'
 
 def obtener_destinos_disponibles():
-    """Extrae los destinos únicos de los tours disponibles."""
-    destinos = set()
-    for tour in tours_data_loaded:
-        titulo = tour.get("titulo_producto", "").lower()
-        tipo = tour.get("tipo_servicio", "").lower()
-        
-        if any(word in titulo + " " + tipo for word in ['puno', 'titicaca', 'uros', 'taquile', 'amantani']):
-            destinos.add('Puno')
-        if any(word in titulo + " " + tipo for word in ['cusco', 'machu picchu', 'sacred valley']):
-            destinos.add('Cusco')
-        if any(word in titulo + " " + tipo for word in ['arequipa', 'colca', 'canyon']):
-            destinos.add('Arequipa')
-        if any(word in titulo + " " + tipo for word in ['uyuni', 'salar', 'bolivia']):
-            destinos.add('Uyuni')
-    
-    return sorted(list(destinos))
+    """Destinos con al menos un tour (precalculados en el índice del catálogo)."""
+    return [d['destination'] for d in indice_catalogo.destinos]
 
 def contar_tours_por_destino(destino):
     """Cuenta cuántos tours hay para un destino específico."""
-    count = 0
-    destino_lower = destino.lower()
-    
-    for tour in tours_data_loaded:
-        titulo = tour.get("titulo_producto", "").lower()
-        tipo = tour.get("tipo_servicio", "").lower()
-        
-        if destino_lower == 'puno' and any(word in titulo + " " + tipo for word in ['puno', 'titicaca', 'uros', 'taquile', 'amantani']):
-            count += 1
-        elif destino_lower == 'cusco' and any(word in titulo + " " + tipo for word in ['cusco', 'machu picchu', 'sacred valley']):
-            count += 1
-        elif destino_lower == 'arequipa' and any(word in titulo + " " + tipo for word in ['arequipa', 'colca', 'canyon']):
-            count += 1
-        elif destino_lower == 'uyuni' and any(word in titulo + " " + tipo for word in ['uyuni', 'salar', 'bolivia']):
-            count += 1
-    
-    return count
+    return indice_catalogo.contar(destino)
+
+def renderizar_respuesta_general(language='es'):
+    """Respuesta local para consultas generales en la primera interacción (sin LLM)."""
+    conteos = {destino.lower(): contar_tours_por_destino(destino) for destino in ['Puno', 'Cusco', 'Arequipa', 'Uyuni']}
+    return LANGUAGE_CONFIGS[language]['general_response_template'].format(
+        total_tours=len(tours_data_loaded),
+        tours_puno=conteos['puno'],
+        tours_cusco=conteos['cusco'],
+        tours_arequipa=conteos['arequipa'],
+        tours_uyuni=conteos['uyuni']
+    )
+
 # === Funciones de Búsqueda y Traducción Contextual ===
+def extraer_keywords(texto, language='es'):
+    """Palabras de 3 o más letras del texto que no son stopwords del idioma."""
+    stopwords = LANGUAGE_CONFIGS[language]['stopwords']
+    palabras = re.findall(r'\b\w{3,}\b', texto)
+    return {palabra for palabra in palabras if palabra not in stopwords}
+
+def texto_usuario_reciente(historial):
+    """Texto de los dos últimos mensajes del usuario en el historial."""
+    user_messages = [h['parts'][0] for h in historial if h['role'] == 'user']
+    return " ".join(user_messages[-2:])
+
 def obtener_keywords_contextuales(historial, pregunta_actual, language='es'):
     """Extrae palabras clave del contexto de la conversación según el idioma."""
-    texto_a_procesar = pregunta_actual.lower()
+    keywords = extraer_keywords(pregunta_actual.lower(), language)
     if historial:
-        user_messages = [h['parts'][0] for h in historial if h['role'] == 'user']
-        texto_a_procesar = " ".join(user_messages[-2:]) + " " + texto_a_procesar
-
-    stopwords = LANGUAGE_CONFIGS[language]['stopwords']
-    palabras = re.findall(r'\b\w{3,}\b', texto_a_procesar)
-    keywords = {palabra for palabra in palabras if palabra not in stopwords}
-    print(f"🔑 Keywords contextuales ({language.upper()}): {keywords}")
+        keywords |= extraer_keywords(texto_usuario_reciente(historial), language)
+    logger.debug(f"🔑 Keywords contextuales ({language.upper()}): {keywords}")
     return list(keywords)
 
-def traducir_keywords_a_ingles(keywords, source_language='es'):
-    """Usa Gemini para traducir keywords al inglés si es necesario."""
+def traducir_keywords_a_ingles(keywords, source_language='es', deadline=None):
+    """
+    Usa Gemini para traducir keywords al inglés si es necesario.
+    
+    Además de la lista completa, cada keyword traducida se guarda por separado:
+    las del historial casi siempre se tradujeron en turnos anteriores y no
+    vuelven a pedirse al modelo (solo van en la llamada las que faltan).
+    
+    Con `deadline` (instante de time.monotonic()) no se espera más allá: si el
+    gobernador sigue en cola o reintentando se devuelven las keywords sin
+    traducir y la llamada termina en segundo plano, dejando el resultado en caché.
+    """
     if not keywords: 
         return []
     
     if source_language == 'en':
-        print(f"🌐 Keywords ya en inglés: {keywords}")
+        logger.debug(f"🌐 Keywords ya en inglés: {keywords}")
         return keywords
     
-    prompt = f"Translate the following Spanish travel keywords to English. Provide only the most relevant, single-word English equivalent for each. Return as a comma-separated list. Keywords: '{', '.join(keywords)}'"
-    try:
-        response = genai.GenerativeModel('gemini-1.5-flash').generate_content(prompt)
-        english_keywords = [kw.strip() for kw in response.text.strip().lower().split(',')]
-        print(f"🌐 Keywords traducidas (EN): {english_keywords}")
+    clave_cache = f"{source_language}:{','.join(keywords)}"
+    traduccion = cache.obtener('traduccion', clave_cache)
+    if traduccion is not None:
+        logger.debug(f"🌐 Keywords traducidas (caché): {traduccion}")
+        return traduccion
+    
+    conocidas = {}
+    for keyword in keywords:
+        traducida = cache.obtener('traduccion_keyword', f"{source_language}:{keyword}")
+        if traducida is not None:
+            conocidas[keyword] = traducida
+    faltantes = [keyword for keyword in keywords if keyword not in conocidas]
+    if not faltantes:
+        logger.debug(f"🌐 Keywords traducidas (caché por keyword): {conocidas}")
+        return [conocidas[keyword] for keyword in keywords]
+    
+    prompt = f"Translate the following Spanish travel keywords to English. Provide only the most relevant, single-word English equivalent for each. Return as a comma-separated list. Keywords: '{', '.join(faltantes)}'"
+    
+    def traducir():
+        try:
+            response = gemini_governor.call(translation_model.generate_content, prompt)
+            english_keywords = [kw.strip() for kw in response.text.strip().lower().split(',')]
+            logger.debug(f"🌐 Keywords traducidas (EN): {english_keywords}")
+        except Exception as e:
+            logger.warning(f"❌ Error en la traducción de keywords: {e}")
+            return [conocidas.get(keyword, keyword) for keyword in keywords]
+        if len(english_keywords) == len(faltantes):
+            # Una traducción por keyword: se pueden reutilizar sueltas en otros turnos
+            for keyword, traducida in zip(faltantes, english_keywords):
+                cache.guardar('traduccion_keyword', f"{source_language}:{keyword}", traducida, CACHE_TTL_TRANSLATION)
+            nuevas = dict(zip(faltantes, english_keywords))
+            english_keywords = [conocidas.get(keyword) or nuevas[keyword] for keyword in keywords]
+        else:
+            english_keywords = [conocidas[keyword] for keyword in keywords if keyword in conocidas] + english_keywords
+        cache.guardar('traduccion', clave_cache, english_keywords, CACHE_TTL_TRANSLATION)
         return english_keywords
-    except Exception as e:
-        print(f"❌ Error en la traducción de keywords: {e}")
-        return keywords
+    
+    if deadline is None:
+        return traducir()
+    
+    resultado = queue.Queue(maxsize=1)
+    threading.Thread(target=logs.con_contexto(lambda: resultado.put(traducir())), daemon=True).start()
+    try:
+        return resultado.get(timeout=max(0.0, deadline - time.monotonic()))
+    except queue.Empty:
+        incrementar_metrica('traducciones_sin_tiempo')
+        logger.warning(f"⏱️ Traducción sin terminar dentro del presupuesto, se usan las keywords originales: {faltantes}")
+        return [conocidas.get(keyword, keyword) for keyword in keywords]
 
 def buscar_tours_relevantes(keywords_en, intencion='specific'):
     """Busca tours priorizando Puno/Titicaca según la especialización."""
@@ -366,12 +593,81 @@ def buscar_tours_relevantes(keywords_en, intencion='specific'):
     
     return [tour for score, tour in scored_tours[:3]]
 
-def formatear_contexto_detallado(tours, language='es'):
+def aplicar_restricciones(tours, restricciones, limite=3):
+    """
+    Deja solo los tours que cumplen presupuesto/grupo/destino (índice NumPy).
+
+    Se conservan primero los encontrados por keywords que cumplen; si no llegan
+    a `limite`, se completa con los mejores del índice (prioridad y precio).
+    """
+    coincidencias = indice_precios.buscar(**restricciones)
+    validos = {indice for indice, _ in coincidencias}
+    seleccion = [tour for tour in tours if indice_catalogo.posicion.get(id(tour)) in validos][:limite]
+    elegidos = {id(tour) for tour in seleccion}
+    for indice, _ in coincidencias:
+        if len(seleccion) >= limite:
+            break
+        tour = tours_data_loaded[indice]
+        if id(tour) not in elegidos:
+            seleccion.append(tour)
+    return seleccion
+
+# === Motores de búsqueda de tours ===
+# Todos reciben (keywords_en, intencion, restricciones) y devuelven hasta 3 tours en orden.
+# benchmarks/eval_retrieval.py mide recall@3, MRR y latencia de cada uno con consultas etiquetadas.
+def buscar_por_keywords(keywords_en, intencion, restricciones):
+    """Coincidencia de keywords en el catálogo y, si hay presupuesto o grupo, filtro de precios."""
+    tours = buscar_tours_relevantes(keywords_en)
+    if filtra_por_precio(restricciones):
+        tours = aplicar_restricciones(tours, restricciones)
+    return tours
+
+def buscar_por_keywords_puno(keywords_en, intencion, restricciones):
+    """Como buscar_por_keywords, pero con la selección por intención (specific_puno)."""
+    tours = buscar_tours_relevantes(keywords_en, intencion)
+    if filtra_por_precio(restricciones):
+        tours = aplicar_restricciones(tours, restricciones)
+    return tours
+
+def buscar_por_catalogo(keywords_en, intencion, restricciones):
+    """Solo el índice de precios y destinos de /tours/search (ignora las keywords)."""
+    return [tours_data_loaded[indice] for indice, _ in indice_precios.buscar(**restricciones, limite=3)]
+
+BACKENDS_BUSQUEDA = {
+    'keywords': buscar_por_keywords,
+    'keywords_puno': buscar_por_keywords_puno,
+    'catalogo': buscar_por_catalogo,
+}
+
+if RETRIEVAL_BACKEND not in BACKENDS_BUSQUEDA:
+    logger.error(f"❌ RETRIEVAL_BACKEND desconocido: {RETRIEVAL_BACKEND}")
+    raise ValueError(f"RETRIEVAL_BACKEND debe ser uno de: {', '.join(BACKENDS_BUSQUEDA)}")
+
+def precio_para_grupo(resumen, personas):
+    """Precio por persona del tramo que corresponde a `personas`, o None."""
+    for d, h, p in resumen['tramos']:
+        try:
+            if int(d) <= personas <= int(h):
+                return p
+        except ValueError:
+            return None
+    return None
+
+def formatear_contexto_detallado(tours, language='es', restricciones=None):
     """Formatea tours con URLs clickeables y prioridad visible."""
     if not tours: 
         return LANGUAGE_CONFIGS[language]['no_tours_message']
     
     resumen_partes = ["--- Relevant Tour Information ---"]
+    if restricciones and filtra_por_precio(restricciones):
+        filtros = []
+        if 'personas' in restricciones:
+            filtros.append(f"group of {restricciones['personas']} people")
+        if 'presupuesto' in restricciones:
+            filtros.append(f"budget up to ${restricciones['presupuesto']:g} USD per person")
+        if 'destino' in restricciones:
+            filtros.append(f"destination {restricciones['destino']}")
+        resumen_partes.append(f"Tours below were filtered from the catalog to match: {', '.join(filtros)}.")
     for tour in tours:
         titulo = tour.get("titulo_producto", "No title")
         descripcion = tour.get("descripcion_tab", "No description")
@@ -379,20 +675,17 @@ def formatear_contexto_detallado(tours, language='es'):
         url = tour.get("url_servicio", "")
         prioridad = tour.get("prioridad", 5)
         
-        precios_formateados = "Price on request."
-        try:
-            precios = json.loads(tour.get("precios_rango", "{}"))
-            if precios and all(k in precios for k in ["desde", "hasta", "precio"]):
-                price_entries = [
-                    f"For {d}-{h} people: ${p} USD" 
-                    for d, h, p in zip(precios["desde"], precios["hasta"], precios["precio"])
-                ]
-                precios_formateados = " | ".join(price_entries)
-        except (json.JSONDecodeError, TypeError):
-            pass
+        # Precios y especialidad precalculados al cargar el catálogo
+        resumen = obtener_resumen(resumenes_tours, tour)
+        precios_formateados = " | ".join(
+            f"For {d}-{h} people: ${p} USD" for d, h, p in resumen['tramos']
+        ) or "Price on request."
         
-        es_puno = any(keyword in titulo.lower() + descripcion.lower() for keyword in ['puno', 'titicaca', 'uros', 'taquile', 'amantani'])
-        especialidad_nota = " ⭐ (NUESTRA ESPECIALIDAD)" if es_puno else ""
+        especialidad_nota = " ⭐ (NUESTRA ESPECIALIDAD)" if resumen['es_puno'] else ""
+        if restricciones and 'personas' in restricciones:
+            precio_grupo = precio_para_grupo(resumen, restricciones['personas'])
+            if precio_grupo is not None:
+                precios_formateados += f" (for {restricciones['personas']} people: ${precio_grupo} USD per person)"
         
         resumen_partes.append(
             f"\n🎯 Tour: {titulo}{especialidad_nota}\n"
@@ -406,6 +699,24 @@ def formatear_contexto_detallado(tours, language='es'):
     
     return "\n".join(resumen_partes)
 
+def formatear_respuesta_degradada(tours, language='es'):
+    """Respuesta estructurada construida solo desde el catálogo, sin llamar al modelo."""
+    config = LANGUAGE_CONFIGS[language]
+    if not tours:
+        return config['no_tours_message']
+    
+    partes = [config['degraded_intro']]
+    for tour in tours:
+        resumen = obtener_resumen(resumenes_tours, tour)
+        especialidad = " ⭐" if resumen['es_puno'] else ""
+        partes.append(
+            f"🎯 **{resumen['titulo']}**{especialidad}\n"
+            f"💰 {resumen['precios_texto'][language]}\n"
+            f"👉 [{config['more_info_label']}]({resumen['url']})"
+        )
+    partes.append(config['degraded_outro'])
+    return "\n\n".join(partes)
+
 def construir_historial_gemini(historial_previo, instruccion_principal, contexto_detallado, pregunta_actual, language='es', intencion='specific'):
     """Construye historial optimizado para especialización en Puno."""
     historial_para_gemini = []
@@ -488,6 +799,147 @@ def construir_historial_gemini(historial_previo, instruccion_principal, contexto
     
     return historial_para_gemini
 
+def obtener_usuario_sesion(session_id):
+    """
+    Usuario de la sesión desde la caché compartida o la BD (cache-aside).
+    
+    La lectura de BD actualiza ultimo_acceso; con la fila en caché se actualiza
+    aparte, en segundo plano y como mucho una vez cada LAST_ACCESS_INTERVAL
+    segundos por sesión (marca compartida entre workers).
+    """
+    usuario = cache.obtener('usuario', session_id)
+    if usuario is None:
+        usuario = db_manager.obtener_usuario_por_session(session_id)
+        cache.guardar('usuario', session_id, usuario, CACHE_TTL_USER)
+        if usuario:
+            cache.guardar('ultimo_acceso', session_id, 1, LAST_ACCESS_INTERVAL)
+    elif cache.guardar_si_ausente('ultimo_acceso', session_id, 1, LAST_ACCESS_INTERVAL):
+        threading.Thread(target=logs.con_contexto(db_manager.registrar_acceso), args=(usuario['id'],), daemon=True).start()
+    return usuario
+
+def obtener_historial_reciente(session_id):
+    """Últimos MAX_HISTORY_TURNS turnos desde la caché compartida o la BD."""
+    historial = cache.obtener('historial', session_id)
+    if historial is None:
+        historial = db_manager.obtener_historial_chat(session_id, MAX_HISTORY_TURNS * 2)
+        cache.guardar('historial', session_id, historial, CACHE_TTL_HISTORY)
+    return historial
+
+def guardar_turno(session_id, usuario_id, pregunta, respuesta, idioma=None, historial=None):
+    """
+    Guarda pregunta y respuesta y actualiza las estadísticas.
+    
+    Con el spool activo el turno solo se escribe en disco (durable tras el
+    fsync agrupado) y el reproductor lo inserta en MySQL después: el chat no
+    espera a la base de datos ni pierde turnos si está caída. Sin spool, o si
+    falla el disco, se guarda directamente en BD (transaccional).
+    
+    Con `historial` (el que se usó para responder) la caché se actualiza con el
+    turno nuevo (write-through), así el siguiente mensaje no lee la BD aunque
+    lo atienda otro worker ni espera a que se reproduzca el spool.
+    """
+    turno_id, fecha = uuid.uuid4().hex, datetime.now()
+    en_spool = False
+    if spool.SPOOL_ENABLED:
+        reproductor_spool.asegurar_iniciado()
+        try:
+            en_spool = spool.escritor.agregar({
+                'turno_id': turno_id,
+                'ts': fecha.isoformat(timespec='microseconds'),
+                'session_id': session_id,
+                'usuario_id': usuario_id,
+                'pregunta': pregunta,
+                'respuesta': respuesta,
+                'idioma': idioma
+            })
+            if not en_spool:
+                logger.warning("⚠️ El spool no confirmó el fsync a tiempo; se guarda también en BD")
+        except OSError as e:
+            logger.error(f"❌ No se pudo escribir en el spool, se guarda en BD: {str(e)}")
+    
+    # Mismo turno_id: si el registro del spool llegó a disco, su reproducción no lo duplica
+    if not en_spool and not db_manager.guardar_mensajes_transaccionales(
+        session_id=session_id,
+        usuario_id=usuario_id,
+        pregunta=pregunta,
+        respuesta=respuesta,
+        idioma=idioma,
+        turno_id=turno_id,
+        fecha=fecha
+    ):
+        logger.error("Error al guardar mensajes en BD")
+        cache.borrar('historial', session_id)
+        return False
+    
+    if historial is None:
+        cache.borrar('historial', session_id)
+    else:
+        nuevo = historial + [{'role': 'user', 'parts': [pregunta]}, {'role': 'model', 'parts': [respuesta]}]
+        cache.guardar('historial', session_id, nuevo[-MAX_HISTORY_TURNS * 2:], CACHE_TTL_HISTORY)
+    logger.info(f"Mensajes guardados para sesión: {session_id}")
+    return True
+
+def etapas_pregeneracion(pregunta, language, cargar_usuario, cargar_historial, buscar_tours=None, deadline=None):
+    """
+    Grafo de etapas previas a la generación de /chat (ver pipeline.ejecutar_grafo).
+    
+    Las lecturas de BD, la intención y la traducción de las keywords de la
+    pregunta corren en paralelo. Las keywords del historial se traducen aparte
+    cuando llega el historial; casi siempre salen de la caché por keyword (ver
+    traducir_keywords_a_ingles), así que un turno hace una sola llamada. `cargar_usuario` y `cargar_historial` son
+    funciones sin argumentos: /chat lee la caché o la BD y replay_traffic.py
+    usa el historial exportado. `buscar_tours` es uno de BACKENDS_BUSQUEDA
+    (por defecto el de RETRIEVAL_BACKEND). `deadline` limita la espera de la
+    traducción (ver traducir_keywords_a_ingles).
+    """
+    buscar_tours = buscar_tours or BACKENDS_BUSQUEDA[RETRIEVAL_BACKEND]
+    
+    def etapa_keywords_historial(historial, keywords_actuales):
+        """Keywords del historial reciente que no están ya en la pregunta actual."""
+        return sorted(extraer_keywords(texto_usuario_reciente(historial), language) - set(keywords_actuales))
+
+    def etapa_traduccion(intencion, keywords):
+        if intencion == 'general':
+            return []
+        return traducir_keywords_a_ingles(keywords, language, deadline=deadline)
+
+    def etapa_intencion(restricciones):
+        intencion = detectar_intencion_consulta(pregunta, language)
+        # Una consulta con presupuesto o tamaño de grupo se responde con tours concretos
+        if intencion == 'general' and filtra_por_precio(restricciones):
+            return 'specific'
+        return intencion
+
+    def etapa_tours(intencion, traduccion_actual, traduccion_historial, restricciones):
+        if intencion == 'general':
+            return []
+        keywords_en = traduccion_actual + [kw for kw in traduccion_historial if kw not in traduccion_actual]
+        return buscar_tours(list(dict.fromkeys(keywords_en)), intencion, restricciones)
+
+    def etapa_contexto(intencion, tours, restricciones):
+        if intencion == 'general':
+            return ""
+        return formatear_contexto_detallado(tours, language, restricciones)
+
+    return {
+        'usuario': (cargar_usuario, []),
+        'historial': (cargar_historial, []),
+        'restricciones': (lambda: extraer_restricciones(pregunta), []),
+        'intencion': (etapa_intencion, ['restricciones']),
+        'keywords_actuales': (lambda: sorted(extraer_keywords(pregunta.lower(), language)), []),
+        'keywords_historial': (etapa_keywords_historial, ['historial', 'keywords_actuales']),
+        'traduccion_actual': (
+            lambda intencion, keywords_actuales: etapa_traduccion(intencion, keywords_actuales),
+            ['intencion', 'keywords_actuales']
+        ),
+        'traduccion_historial': (
+            lambda intencion, keywords_historial: etapa_traduccion(intencion, keywords_historial),
+            ['intencion', 'keywords_historial']
+        ),
+        'tours': (etapa_tours, ['intencion', 'traduccion_actual', 'traduccion_historial', 'restricciones']),
+        'contexto': (etapa_contexto, ['intencion', 'tours', 'restricciones']),
+    }
+
 # === Ruta Principal del Chat ===
 # === Endpoints de la API ===
 @app.route('/register_user', methods=['POST'])
@@ -528,12 +980,17 @@ def register_user():
         if usuario_existente:
             # Actualizar datos existentes
             logger.info(f"Actualizando usuario existente: {correo}")
-            if db_manager.actualizar_usuario(
+            actualizado = db_manager.actualizar_usuario(
                 usuario_existente['id'],
                 nombre=nombre,
                 whatsapp=whatsapp,
                 session_id=session_id
-            ):
+            )
+            # La fila cacheada de la sesión anterior y de la nueva ya no es válida
+            cache.borrar('usuario', session_id)
+            if usuario_existente.get('session_id'):
+                cache.borrar('usuario', usuario_existente['session_id'])
+            if actualizado:
                 return jsonify({
                     "success": True,
                     "message": "Datos de usuario actualizados",
@@ -554,6 +1011,7 @@ def register_user():
         )
         
         if usuario_id:
+            cache.borrar('usuario', session_id)
             return jsonify({
                 "success": True,
                 "message": "Usuario registrado exitosamente",
@@ -577,13 +1035,21 @@ def chat():
     - message: Texto del mensaje del usuario
     - session_id: ID de sesión existente
     - language: (Opcional) Idioma de la conversación (es/en)
+    - idempotency_key: (Opcional) Clave del mensaje; también vía cabecera Idempotency-Key.
+      Un reintento con la misma clave reanuda o repite la respuesta original,
+      aunque llegue a otro worker (ver idempotency.RegistroCompartido).
     
     Returns:
     - Streaming de la respuesta del asistente
     - 400: Mensaje vacío o datos inválidos
     - 500: Error interno del servidor
     """
+    # Clave de idempotencia reservada por esta petición, hasta que una respuesta se hace cargo de ella
+    reservada = None
     try:
+        # El presupuesto de latencia cuenta desde que llega la petición
+        deadline = time.monotonic() + CHAT_FIRST_TOKEN_BUDGET
+        
         data = request.get_json()
         if not data:
             return jsonify({"error": "No se proporcionaron datos"}), 400
@@ -600,97 +1066,331 @@ def chat():
         if not pregunta:
             return jsonify({"error": "El mensaje no puede estar vacío"}), 400
 
-        # Verificar y obtener usuario
-        usuario = db_manager.obtener_usuario_por_session(session_id)
+        # Idempotencia: la clave se reserva antes del pipeline, así un reintento no repite
+        # lecturas de BD ni traducción y se engancha a la generación existente
+        clave_idempotencia = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+        if clave_idempotencia:
+            clave_registro = f"{session_id}:{clave_idempotencia}"
+            generacion, nueva = registro_idempotencia.reservar(clave_registro)
+            if not nueva:
+                reenganche = not generacion.terminada
+                incrementar_metrica('idempotencia_reenganches' if reenganche else 'idempotencia_repeticiones')
+                logger.info(f"♻️ Reintento idempotente ({'reenganche' if reenganche else 'repetición'}) - Sesión: {session_id}")
+                return Response(generacion.seguir(), mimetype='text/event-stream')
+            entrada = registro_compartido.reservar(clave_registro)
+            if entrada is not None:
+                return Response(seguir_generacion_remota(clave_registro, generacion, entrada, language),
+                                mimetype='text/event-stream')
+            reservada = clave_registro
+            generacion.sincronizar = registro_compartido.sincronizador(clave_registro)
+        else:
+            clave_registro = None
+            generacion = Generacion()
+
+        # Etapas previas a la generación como grafo de dependencias: las lecturas de BD,
+        # la intención y la traducción de las keywords de la pregunta corren en paralelo
+        etapas = etapas_pregeneracion(
+            pregunta, language,
+            cargar_usuario=lambda: obtener_usuario_sesion(session_id),
+            cargar_historial=lambda: obtener_historial_reciente(session_id),
+            # La traducción pasa por la cola y los reintentos del gobernador: no puede
+            # consumir más que el presupuesto del primer token
+            deadline=deadline
+        )
+        resultados, tiempos = ejecutar_grafo(etapas)
+        metricas_etapas.registrar(tiempos)
+        logger.debug("Etapas /chat (ms): " + ", ".join(f"{nombre}={t['duration_ms']}" for nombre, t in tiempos.items()),
+                     extra={'stages_ms': {nombre: t['duration_ms'] for nombre, t in tiempos.items()}})
+        
+        # Verificar usuario
+        usuario = resultados['usuario']
         if not usuario:
             logger.warning(f"Sesión no registrada: {session_id}")
+            liberar_reserva_idempotencia(reservada)
             return jsonify({"error": "Por favor regístrate primero"}), 401
-
-        # Cargar historial desde base de datos
-        historial = db_manager.obtener_historial_chat(session_id, MAX_HISTORY_TURNS * 2)
+        
+        historial = resultados['historial']
         logger.info(f"Historial cargado: {len(historial)} mensajes")
         
-        # Procesar intención y contexto
-        intencion = detectar_intencion_consulta(pregunta, language)
+        intencion = resultados['intencion']
         logger.info(f"Intención detectada: {intencion}")
+        incrementar_metrica('peticiones')
         
-        contexto_detallado = ""
-        if intencion != 'general':
-            keywords = obtener_keywords_contextuales(historial, pregunta, language)
-            keywords_en = traducir_keywords_a_ingles(keywords, language)
-            tours_relevantes = buscar_tours_relevantes(keywords_en)
-            contexto_detallado = formatear_contexto_detallado(tours_relevantes, language)
-
         config = LANGUAGE_CONFIGS[language]
+        # Eventos para el orquestador: chunks de Gemini, fin, error o cancelación del cliente
+        cola = queue.Queue()
+        cancelado = threading.Event()
+        upstream = {}
+        
+        def cancelar_generacion():
+            """Corta el stream de Gemini de inmediato (no espera al siguiente chunk)."""
+            cancelado.set()
+            if 'respuesta' in upstream:
+                cancelar_respuesta(upstream['respuesta'])
+        
+        def al_abandonar():
+            """El último lector se desconectó: con clave de idempotencia se espera un posible reintento."""
+            def verificar():
+                if generacion.lectores > 0 or generacion.terminada:
+                    return
+                if clave_registro and registro_compartido.hay_lector_remoto(clave_registro):
+                    # Un reintento en otro worker sigue esta generación desde la caché compartida
+                    threading.Timer(max(IDEMPOTENCY_REATTACH_GRACE, 1), logs.con_contexto(verificar)).start()
+                    return
+                cola.put(('cancelado', None))
+            if clave_idempotencia and IDEMPOTENCY_REATTACH_GRACE > 0:
+                threading.Timer(IDEMPOTENCY_REATTACH_GRACE, logs.con_contexto(verificar)).start()
+            else:
+                verificar()
+        
+        # Camino rápido: saludo / consulta general en el primer turno se responde con la plantilla
+        if LOCAL_FAST_PATH and intencion == 'general' and len(historial) == 0:
+            respuesta_local = renderizar_respuesta_general(language)
+            incrementar_metrica('respuestas_locales')
+            logger.info(f"Respuesta local (plantilla general) - Sesión: {session_id}")
+            
+            def producir_respuesta_local():
+                generacion.publicar(respuesta_local)
+                generacion.terminar()
+                guardar_turno(session_id, usuario['id'], pregunta, respuesta_local, language, historial)
+            
+            reservada = None
+            threading.Thread(target=logs.con_contexto(producir_respuesta_local), daemon=True).start()
+            return Response(generacion.seguir(), mimetype='text/event-stream')
+        
+        contexto_detallado = resultados['contexto']
+        tours_relevantes = resultados['tours']
+
         historial_para_gemini = construir_historial_gemini(
             historial, config['system_instruction'], contexto_detallado, pregunta, language, intencion
         )
 
-        def stream_response():
-            nonlocal historial
+        def generar_con_gemini():
+            """Consume el stream de Gemini en un hilo aparte y pasa los chunks a la cola."""
+            def iniciar_stream():
+                respuesta = gemini_model.generate_content(historial_para_gemini, stream=True)
+                upstream['respuesta'] = respuesta
+                if cancelado.is_set():
+                    cancelar_respuesta(respuesta)
+                return respuesta
+            
+            try:
+                # Generar respuesta con Gemini (a través del gobernador)
+                response_stream = gemini_governor.stream(iniciar_stream, cancelado=cancelado)
+                try:
+                    for chunk in response_stream:
+                        if cancelado.is_set():
+                            break
+                        if chunk.text:
+                            cola.put(('chunk', chunk.text))
+                finally:
+                    response_stream.close()
+                cola.put(('fin', None))
+            except Exception as e:
+                cola.put(('error', e))
+
+        def guardar(respuesta):
+            """Guarda el turno; un fallo aquí se registra pero no toca la respuesta del cliente."""
+            try:
+                guardar_turno(session_id, usuario['id'], pregunta, respuesta, language, historial)
+            except Exception as e:
+                logger.error(f"❌ Error guardando el turno - Sesión: {session_id}: {str(e)}", exc_info=True)
+        
+        def terminar_con_error():
+            """Publica el mensaje de error sin dejarlo como resultado de la clave: un reintento genera de nuevo."""
+            generacion.sincronizar = None
+            generacion.publicar(config['error_message'])
+            liberar_reserva_idempotencia(clave_registro)
+            generacion.terminar()
+
+        def producir_respuesta():
+            """Orquesta la respuesta (modelo o modo degradado), la publica en `generacion` y la guarda."""
             respuesta_completa = ""
+            threading.Thread(target=logs.con_contexto(generar_con_gemini), daemon=True).start()
             
             try:
-                # Generar respuesta con Gemini
-                response_stream = gemini_model.generate_content(
-                    historial_para_gemini, stream=True
-                )
+                try:
+                    tipo, valor = cola.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    tipo, valor = 'timeout', None
                 
-                for chunk in response_stream:
-                    if chunk.text:
-                        respuesta_completa += chunk.text
-                        yield chunk.text
-                        time.sleep(0.01)
+                if tipo == 'cancelado':
+                    raise ClienteDesconectado()
+                if tipo in ('timeout', 'error'):
+                    # Sin primer token a tiempo (o upstream caído): responder desde el catálogo
+                    cancelar_generacion()
+                    if tipo == 'timeout':
+                        logger.warning(f"⏱️ Sin primer token en {CHAT_FIRST_TOKEN_BUDGET}s, modo degradado - Sesión: {session_id}")
+                    elif isinstance(valor, UpstreamNoDisponible):
+                        logger.warning(f"Gemini no disponible, modo degradado: {str(valor)}")
+                    else:
+                        logger.error(f"Error en Gemini, modo degradado: {str(valor)}", exc_info=valor)
+                    incrementar_metrica('respuestas_degradadas')
+                    tours_degradados = tours_relevantes or buscar_tours_relevantes(['puno', 'titicaca'], 'specific_puno')
+                    respuesta_completa = formatear_respuesta_degradada(tours_degradados, language)
+                    generacion.publicar(respuesta_completa)
+                else:
+                    incrementar_metrica('respuestas_modelo')
+                    while tipo == 'chunk':
+                        respuesta_completa += valor
+                        generacion.publicar(valor)
+                        tipo, valor = cola.get()
+                    if tipo == 'cancelado':
+                        raise ClienteDesconectado()
+                    if tipo == 'error':
+                        # Gemini falló a mitad de la respuesta: se guarda lo recibido como truncado
+                        logger.error(f"Error en Gemini a mitad de la respuesta: {str(valor)}", exc_info=valor)
+                        incrementar_metrica('respuestas_interrumpidas')
+                        guardar(respuesta_completa + MARCA_RESPUESTA_INTERRUMPIDA)
+                        terminar_con_error()
+                        return
                 
-                # Guardar en base de datos (transaccional)
-                if not db_manager.guardar_mensajes_transaccionales(
-                    session_id=session_id,
-                    usuario_id=usuario['id'],
-                    pregunta=pregunta,
-                    respuesta=respuesta_completa
-                ):
-                    logger.error("Error al guardar mensajes en BD")
-                
-                logger.info(f"Mensajes guardados para sesión: {session_id}")
+                # Guardado antes del fin del stream: el siguiente mensaje ya encuentra el turno en el historial
+                guardar(respuesta_completa)
+                generacion.terminar()
 
+            except ClienteDesconectado:
+                # El cliente cerró el widget: cortar Gemini y guardar lo que alcanzó a recibir
+                cancelar_generacion()
+                incrementar_metrica('cancelaciones_cliente')
+                logger.info(f"🔌 Cliente desconectado, generación cancelada - Sesión: {session_id}")
+                generacion.terminar()
+                guardar(respuesta_completa + MARCA_RESPUESTA_TRUNCADA)
             except Exception as e:
                 logger.error(f"Error en Gemini: {str(e)}", exc_info=True)
-                yield config['error_message']
+                terminar_con_error()
+            finally:
+                generacion.terminar()
 
-        return Response(stream_response(), mimetype='text/event-stream')
+        # Los lectores que se reenganchan también cuentan para cancelar por abandono
+        generacion.al_abandonar = al_abandonar
+        reservada = None
+        threading.Thread(target=logs.con_contexto(producir_respuesta), daemon=True).start()
+        return Response(generacion.seguir(), mimetype='text/event-stream')
     
     except Exception as e:
         logger.error(f"Error en endpoint /chat: {str(e)}", exc_info=True)
+        liberar_reserva_idempotencia(reservada)
         return jsonify({"error": "Error interno del servidor"}), 500
 
+def liberar_reserva_idempotencia(clave_registro):
+    """Suelta una clave reservada que no llegó a generar respuesta, para que el reintento empiece de cero."""
+    if clave_registro:
+        registro_idempotencia.liberar(clave_registro)
+        registro_compartido.liberar(clave_registro)
+
+def seguir_generacion_remota(clave_registro, generacion, entrada, language):
+    """
+    Reintento cuya clave es de otro worker: repite su respuesta o la sigue desde la caché compartida.
+
+    No llama al modelo ni guarda el turno; eso lo hace el dueño de la clave.
+    """
+    if entrada.get('estado') == 'terminada':
+        incrementar_metrica('idempotencia_repeticiones')
+        logger.info("♻️ Reintento idempotente (repetición desde la caché compartida)")
+        generacion.publicar(entrada.get('texto', ''))
+        generacion.terminar()
+        return generacion.seguir()
+    
+    incrementar_metrica('idempotencia_reenganches_remotos')
+    logger.info("♻️ Reintento idempotente (reenganche a otro worker)")
+    detenido = threading.Event()
+    generacion.al_abandonar = detenido.set
+    
+    def seguir():
+        try:
+            if not registro_compartido.seguir(clave_registro, generacion, detenido) and not detenido.is_set():
+                logger.warning(f"⚠️ El dueño de la clave de idempotencia dejó de avanzar: {clave_registro}")
+                generacion.publicar(LANGUAGE_CONFIGS[language]['error_message'])
+        finally:
+            generacion.terminar()
+    
+    threading.Thread(target=logs.con_contexto(seguir), daemon=True).start()
+    return generacion.seguir()
+
 @app.route('/session/<session_id>/history', methods=['GET'])
 def get_session_history(session_id):
     """
-    Obtiene el historial de chat para una sesión específica.
+    Obtiene el historial de chat para una sesión específica, por páginas.
     
     Parámetros:
     - session_id: ID de la sesión
     
+    Query params:
+    - since: id del último mensaje que ya tiene el cliente; devuelve solo los posteriores
+    - before: id del mensaje más antiguo cargado; devuelve los anteriores
+    - limit: Máximo de mensajes (default: 50, máximo 200)
+    Sin since ni before se devuelven los mensajes más recientes.
+    
+    El ETag cambia con cada mensaje nuevo: con If-None-Match un cliente que se
+    reconecta sin novedades recibe 304 sin que se lean los mensajes.
+    
     Returns:
-    - 200: Historial de mensajes
+    - 200: Historial de mensajes y cursor para la siguiente petición
+    - 304: No hay cambios desde el ETag indicado
+    - 400: Parámetros inválidos
     - 404: Sesión no encontrada
     - 500: Error interno
     """
+    try:
+        since = request.args.get('since', type=int)
+        before = request.args.get('before', type=int)
+        limit = min(int(request.args.get('limit', HISTORY_PAGE_DEFAULT)), HISTORY_PAGE_MAX)
+    except ValueError:
+        return jsonify({"error": "limit debe ser entero"}), 400
+    if limit < 1 or (since is not None and before is not None):
+        return jsonify({"error": "limit debe ser >= 1 y since/before no se combinan"}), 400
+    
     try:
         # Verificar si la sesión existe
-        usuario = db_manager.obtener_usuario_por_session(session_id)
+        usuario = obtener_usuario_sesion(session_id)
         if not usuario:
             return jsonify({"error": "Sesión no encontrada"}), 404
         
-        historial = db_manager.obtener_historial_chat(session_id)
+        estado = db_manager.estado_historial(session_id)
+        etag = None
+        if estado is not None:
+            primer_id, ultimo_id, total = estado
+            etag = f"{ultimo_id}-{total}-{since or ''}-{before or ''}-{limit}"
+            if request.if_none_match.contains_weak(etag):
+                respuesta = Response(status=304)
+                respuesta.set_etag(etag)
+                respuesta.headers['Cache-Control'] = "private, no-cache"
+                return respuesta
+            # El mensaje del cursor ya no existe (posterior al último o anterior al
+            # primero que queda): se limpió la sesión y el cliente debe recargar
+            reset = since is not None and (since > ultimo_id or (total > 0 and since < primer_id))
+        else:
+            total, reset = None, False
         
-        return jsonify({
-            "success": True,
-            "session_id": session_id,
-            "usuario_id": usuario['id'],
-            "historial": historial,
-            "count": len(historial)
-        })
+        if reset:
+            since = None
+        historial, hay_mas = db_manager.obtener_pagina_historial(
+            session_id, desde_id=since, antes_de_id=before, limite=limit
+        )
+        
+        if historial:
+            cursor = {"first_id": historial[0]['id'], "last_id": historial[-1]['id']}
+        else:
+            cursor = {"first_id": before, "last_id": since}
+        if since is not None:
+            cursor["has_more"] = hay_mas
+            cursor["has_more_before"] = None
+        else:
+            # Página más reciente o hacia atrás: lo que queda está antes
+            cursor["has_more"] = False
+            cursor["has_more_before"] = hay_mas
+        
+        # El array se serializa por trozos: no se construye el documento completo en memoria
+        respuesta = respuesta_json_stream(
+            {"success": True, "session_id": session_id, "usuario_id": usuario['id'], "reset": reset},
+            "historial", historial,
+            pie=lambda count: {"count": count, "total": total, "cursor": cursor}
+        )
+        if etag is not None:
+            respuesta.set_etag(etag)
+        respuesta.headers['Cache-Control'] = "private, no-cache"
+        return respuesta
     except Exception as e:
         logger.error(f"Error obteniendo historial: {str(e)}", exc_info=True)
         return jsonify({"error": "Error interno del servidor"}), 500
@@ -709,7 +1409,9 @@ def clear_session(session_id):
     - 500: Error interno
     """
     try:
-        if not db_manager.limpiar_historial_sesion(session_id):
+        limpiado = db_manager.limpiar_historial_sesion(session_id)
+        cache.borrar('historial', session_id)
+        if not limpiado:
             return jsonify({"error": "Sesión no encontrada"}), 404
         
         return jsonify({
@@ -720,6 +1422,21 @@ def clear_session(session_id):
         logger.error(f"Error limpiando sesión: {str(e)}", exc_info=True)
         return jsonify({"error": "Error interno del servidor"}), 500
 
+def respuesta_catalogo(construir):
+    """
+    Respuesta cacheable de la API de catálogo.
+
+    El ETag es la versión del catálogo: si el cliente ya la tiene se responde 304
+    sin construir el cuerpo.
+    """
+    if request.if_none_match.contains_weak(indice_catalogo.version):
+        respuesta = Response(status=304)
+    else:
+        respuesta = jsonify(construir())
+    respuesta.set_etag(indice_catalogo.version)
+    respuesta.headers['Cache-Control'] = f"public, max-age={CATALOG_CACHE_MAX_AGE}, stale-while-revalidate={CATALOG_CACHE_SWR}"
+    return respuesta
+
 @app.route('/destinations', methods=['GET'])
 def get_destinations():
     """
@@ -727,54 +1444,194 @@ def get_destinations():
     
     Returns:
     - 200: Lista de destinos
-    - 500: Error interno
+    - 304: El cliente ya tiene esta versión del catálogo
+    """
+    return respuesta_catalogo(lambda: {
+        "success": True,
+        "destinations": indice_catalogo.destinos,
+        "total": len(indice_catalogo.destinos),
+        "catalog_version": indice_catalogo.version
+    })
+
+@app.route('/tours', methods=['GET'])
+def get_tours():
+    """
+    Lista los tours del catálogo, ordenados por prioridad.
+    
+    Query params:
+    - destination: Filtrar por destino (Puno, Cusco, Arequipa, Uyuni)
+    - limit: Máximo de tours (default: 50, máximo 200)
+    - offset: Desplazamiento para paginación (default: 0)
+    
+    Returns:
+    - 200: Lista de tours
+    - 304: El cliente ya tiene esta versión del catálogo
+    - 400: Parámetros inválidos
     """
     try:
-        destinos = obtener_destinos_disponibles()
-        destinos_con_conteo = [
-            {"destination": destino, "tour_count": contar_tours_por_destino(destino)}
-            for destino in destinos
-        ]
-        
-        return jsonify({
+        limit = min(int(request.args.get('limit', 50)), CATALOG_PAGE_MAX)
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "limit y offset deben ser enteros"}), 400
+    if limit < 1 or offset < 0:
+        return jsonify({"error": "limit debe ser >= 1 y offset >= 0"}), 400
+    destino = request.args.get('destination')
+
+    def construir():
+        tours = indice_catalogo.listar(destino)
+        return {
             "success": True,
-            "destinations": destinos_con_conteo,
-            "total": len(destinos)
-        })
-    except Exception as e:
-        logger.error(f"Error obteniendo destinos: {str(e)}", exc_info=True)
-        return jsonify({"error": "Error interno del servidor"}), 500
+            "tours": tours[offset:offset + limit],
+            "total": len(tours),
+            "limit": limit,
+            "offset": offset,
+            "catalog_version": indice_catalogo.version
+        }
+    return respuesta_catalogo(construir)
+
+@app.route('/tours/search', methods=['GET'])
+def search_tours():
+    """
+    Busca tours por presupuesto, tamaño de grupo y destino (máscaras NumPy, sin LLM).
+    
+    Query params:
+    - budget: Precio máximo por persona en USD
+    - group_size: Número de personas (se usa el tramo de precio de ese grupo)
+    - destination: Destino (Puno, Cusco, Arequipa, Uyuni)
+    - q: (Opcional) Texto libre del que extraer los filtros anteriores
+    - limit: Máximo de tours (default: 10, máximo 200)
+    
+    Returns:
+    - 200: Tours que cumplen, ordenados por prioridad y precio
+    - 304: El cliente ya tiene esta versión del catálogo
+    - 400: Parámetros inválidos
+    """
+    restricciones = extraer_restricciones(request.args.get('q', ''))
+    try:
+        if request.args.get('budget'):
+            restricciones['presupuesto'] = float(request.args['budget'])
+        if request.args.get('group_size'):
+            restricciones['personas'] = int(request.args['group_size'])
+        limit = min(int(request.args.get('limit', 10)), CATALOG_PAGE_MAX)
+    except ValueError:
+        return jsonify({"error": "budget, group_size y limit deben ser numéricos"}), 400
+    if request.args.get('destination'):
+        restricciones['destino'] = request.args['destination']
+    if limit < 1 or restricciones.get('personas', 1) < 1:
+        return jsonify({"error": "limit y group_size deben ser >= 1"}), 400
+
+    tiempos = {}
+    def construir():
+        inicio = time.perf_counter()
+        coincidencias = indice_precios.buscar(limite=limit, **restricciones)
+        tiempos['search_us'] = (time.perf_counter() - inicio) * 1e6
+        tours = []
+        for indice, precio in coincidencias:
+            registro = dict(indice_catalogo.registros[indice])
+            registro['price_per_person_usd'] = precio
+            if precio is not None and 'personas' in restricciones:
+                registro['total_usd'] = round(precio * restricciones['personas'], 2)
+            tours.append(registro)
+        return {
+            "success": True,
+            "filters": {
+                "budget": restricciones.get('presupuesto'),
+                "group_size": restricciones.get('personas'),
+                "destination": restricciones.get('destino')
+            },
+            "tours": tours,
+            "total": len(tours),
+            "catalog_version": indice_catalogo.version
+        }
+    respuesta = respuesta_catalogo(construir)
+    if 'search_us' in tiempos:
+        respuesta.headers['Server-Timing'] = f"search;dur={tiempos['search_us'] / 1000:.3f}"
+    return respuesta
+
+@app.route('/tours/<int:tour_id>', methods=['GET'])
+def get_tour(tour_id):
+    """
+    Detalle de un tour (incluye descripción, itinerario y qué incluye).
+    
+    Returns:
+    - 200: Tour
+    - 304: El cliente ya tiene esta versión del catálogo
+    - 404: Tour no encontrado
+    """
+    detalle = indice_catalogo.detalle(tour_id)
+    if detalle is None:
+        return jsonify({"error": "Tour no encontrado"}), 404
+    return respuesta_catalogo(lambda: {"success": True, "tour": detalle})
+
+def comprobar_gemini():
+    """Comprueba el acceso a la API de Gemini (lo ejecuta el probador, nunca una petición)."""
+    if LLM_PROVIDER == 'fake':
+        return True
+    if gemini_governor.estado_circuito == 'open':
+        return False
+    obtener_genai().get_model('models/gemini-1.5-pro-latest', request_options={'timeout': HEALTH_PROBE_TIMEOUT})
+    return True
+
+probador_salud = ProbadorSalud({
+    'database': db_manager.verificar_conexion,
+    'tours_loaded': lambda: len(tours_data_loaded) > 0,
+    'gemini_api': comprobar_gemini,
+}, intervalo=HEALTH_PROBE_INTERVAL)
+
+@app.route('/livez', methods=['GET'])
+def liveness():
+    """
+    Liveness: el proceso está vivo y atiende peticiones. No hace ninguna comprobación.
+    
+    Returns:
+    - 200: Proceso vivo
+    """
+    return jsonify({"status": "alive", "pid": os.getpid()})
+
+@app.route('/readyz', methods=['GET'])
+def readiness():
+    """
+    Readiness desde la caché del probador de salud (sin E/S en la petición).
+    Gemini no es requisito salvo READY_REQUIRES_LLM=1: sin él se sirve el modo degradado.
+    
+    Returns:
+    - 200: Listo para recibir tráfico
+    - 503: No listo (BD o catálogo caídos, o caché de salud vencida)
+    """
+    probador_salud.asegurar_iniciado()
+    estado = probador_salud.estado()
+    requeridos = ['database', 'tours_loaded'] + (['gemini_api'] if READY_REQUIRES_LLM else [])
+    listo = not estado['stale'] and all(
+        estado['checks'].get(nombre, {}).get('ok', False) for nombre in requeridos
+    )
+    estado['status'] = "ready" if listo else "not_ready"
+    return jsonify(estado), 200 if listo else 503
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """
-    Endpoint de health check para monitoreo.
+    Endpoint de health check para monitoreo (servido desde la caché del probador).
     
     Returns:
     - 200: Estado de salud de la aplicación
     - 503: Servicio no disponible
     """
     try:
-        # Verificar conexión a la base de datos
-        db_status = db_manager.verificar_conexion()
+        probador_salud.asegurar_iniciado()
+        estado = probador_salud.estado()
+        checks = estado['checks']
         
-        # Verificar tours cargados
-        tours_loaded = len(tours_data_loaded) > 0
-        
-        # Verificar API de Gemini
-        gemini_status = False
-        try:
-            genai.get_model('models/gemini-1.5-pro-latest')
-            gemini_status = True
-        except Exception:
-            pass
+        db_status = checks.get('database', {}).get('ok', False)
+        tours_loaded = checks.get('tours_loaded', {}).get('ok', False)
+        gemini_status = checks.get('gemini_api', {}).get('ok', False)
         
         status = {
-            "status": "healthy" if all([db_status, tours_loaded, gemini_status]) else "degraded",
+            "status": "healthy" if all([db_status, tours_loaded, gemini_status]) and not estado['stale'] else "degraded",
             "timestamp": datetime.utcnow().isoformat(),
             "database": db_status,
             "tours_loaded": tours_loaded,
             "gemini_api": gemini_status,
+            "checks_age_seconds": estado['age_seconds'],
             "version": "3.1.0"
         }
         
@@ -788,7 +1645,150 @@ def health_check():
             "error": str(e)
         }), 503
 
+@app.route('/admin/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Métricas internas del proceso (worker) que atiende la petición.
+    
+    Returns:
+    - 200: Métricas del gobernador de upstream y del endpoint /chat
+    """
+    chat_metrics = snapshot_metricas()
+    peticiones = chat_metrics.get('peticiones', 0)
+    chat_metrics['local_share'] = round(chat_metrics.get('respuestas_locales', 0) / peticiones, 4) if peticiones else 0.0
+    return jsonify({
+        "success": True,
+        "pid": os.getpid(),
+        "upstream": gemini_governor.metrics(),
+        "chat": chat_metrics,
+        "pipeline": metricas_etapas.snapshot(),
+        "idempotency_keys": len(registro_idempotencia),
+        "startup": metricas_arranque,
+        "logging": logs.metricas_logging(),
+        "json_serializer": SERIALIZADOR,
+        "cache": cache.metricas(),
+        "database": db_manager.metricas_enrutado(),
+        "spool": {
+            **spool.estado_spool(),
+            "enabled": spool.SPOOL_ENABLED,
+            "writer": spool.escritor.metricas(),
+            "replayer": reproductor_spool.metricas()
+        }
+    })
+
+def requiere_token_admin(vista):
+    """Exige `Authorization: Bearer <ADMIN_TOKEN>`; sin ADMIN_TOKEN configurado el endpoint no existe."""
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({"error": "Endpoint no encontrado"}), 404
+        esquema, _, token = request.headers.get('Authorization', '').partition(' ')
+        if esquema.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode(), ADMIN_TOKEN.encode()):
+            return jsonify({"error": "No autorizado"}), 401
+        return vista(*args, **kwargs)
+    return envoltura
+
+@app.route('/admin/profile', methods=['POST'])
+@requiere_token_admin
+def start_profile():
+    """
+    Perfila este worker por muestreo: las próximas N peticiones a /chat o T segundos.
+    
+    Parámetros (JSON):
+    - requests: número de peticiones a /chat que se perfilan (1-1000)
+    - seconds: duración; sin requests se muestrean todos los hilos (límite PROFILER_MAX_SECONDS)
+    - interval_ms: (Opcional) intervalo de muestreo (default PROFILER_INTERVAL_MS)
+    
+    Returns:
+    - 202: id de la sesión; el resultado se consulta en /admin/profile/<id> desde cualquier worker
+    - 400: parámetros inválidos
+    - 409: ya hay una sesión en curso en este worker
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        peticiones = int(data['requests']) if data.get('requests') is not None else None
+        segundos = float(data['seconds']) if data.get('seconds') is not None else None
+        intervalo = float(data['interval_ms']) if data.get('interval_ms') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "requests, seconds e interval_ms deben ser números"}), 400
+    if peticiones is None and segundos is None:
+        return jsonify({"error": "Indica requests o seconds"}), 400
+    if (peticiones is not None and not 1 <= peticiones <= PROFILER_MAX_REQUESTS) or (segundos is not None and segundos <= 0):
+        return jsonify({"error": f"requests debe estar entre 1 y {PROFILER_MAX_REQUESTS} y seconds ser positivo"}), 400
+    try:
+        sesion = perfilador.iniciar(peticiones, segundos, intervalo)
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    logger.info(f"🔬 Perfilado iniciado: {sesion.id} ({sesion.resumen()['mode']})")
+    return jsonify({"success": True, "profile": sesion.resumen(), "result": f"/admin/profile/{sesion.id}"}), 202
+
+@app.route('/admin/profile/<id_sesion>', methods=['GET'])
+@requiere_token_admin
+def get_profile(id_sesion):
+    """
+    Resultado de una sesión de perfilado.
+    
+    Query params:
+    - format: collapsed (default, text/plain "hilo;f1;f2 N" para flamegraph.pl/speedscope) o json
+      (resumen con las funciones con más muestras propias y totales)
+    
+    Returns:
+    - 200: collapsed stacks o resumen
+    - 202: la sesión sigue en curso
+    - 404: sesión desconocida
+    """
+    estado = perfilador.estado(id_sesion)
+    if estado is None:
+        return jsonify({"error": "Sesión de perfilado no encontrada"}), 404
+    if estado['status'] != 'done':
+        return jsonify({"success": True, "profile": estado}), 202
+    collapsed = perfilador.collapsed(id_sesion) or ""
+    if request.args.get('format') == 'json':
+        return jsonify({"success": True, "profile": estado, "functions": funciones_principales(collapsed)})
+    return Response(collapsed, mimetype='text/plain', headers={
+        'Content-Disposition': f'inline; filename="profile-{id_sesion}.collapsed"'
+    })
+
+@app.route('/admin/memory', methods=['GET', 'POST', 'DELETE'])
+@requiere_token_admin
+def memory_snapshot():
+    """
+    tracemalloc en el worker que atiende la petición.
+    
+    - POST: activa tracemalloc (JSON opcional: frames, profundidad de las trazas)
+    - GET: top de memoria retenida y crecimiento desde la activación
+      (query params: top, default 20; group, lineno | filename | traceback)
+    - DELETE: desactiva tracemalloc
+    
+    Con varios workers cada uno tiene su propio estado: la respuesta incluye
+    el pid y un GET a un worker sin tracemalloc activo devuelve 409.
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            marcos = int(data.get('frames', 1))
+        except (TypeError, ValueError):
+            return jsonify({"error": "frames debe ser un número"}), 400
+        iniciado = memoria.iniciar(marcos)
+        return jsonify({"success": True, "pid": os.getpid(), "tracing": True, "started": iniciado})
+    if request.method == 'DELETE':
+        return jsonify({"success": True, "pid": os.getpid(), "tracing": False, "stopped": memoria.detener()})
+    
+    agrupar = request.args.get('group', 'lineno')
+    if agrupar not in ('lineno', 'filename', 'traceback'):
+        return jsonify({"error": "group debe ser lineno, filename o traceback"}), 400
+    limite = min(max(request.args.get('top', 20, type=int), 1), 200)
+    instantanea = memoria.instantanea(limite, agrupar)
+    if instantanea is None:
+        return jsonify({"error": "tracemalloc no está activo en este worker", "pid": os.getpid()}), 409
+    return jsonify({"success": True, **instantanea})
+
 # === Manejo de errores ===
+@app.teardown_request
+def limpiar_correlacion(error=None):
+    perfilador.terminar_peticion(g.pop('marca_perfil', None))
+    logs.terminar_peticion()
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({"error": "Endpoint no encontrado"}), 404
@@ -801,7 +1801,66 @@ def method_not_allowed(error):
 def internal_error(error):
     return jsonify({"error": "Error interno del servidor"}), 500
 
+@app.before_request
+def marcar_inicio_peticion():
+    g.inicio_peticion = time.perf_counter()
+    # Id de correlación: el del proxy/cliente si lo envía, si no uno nuevo
+    g.request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex[:16]
+    logs.iniciar_peticion(g.request_id)
+    # Sesión de perfilado por peticiones: solo /chat, y solo si hay una en curso
+    if perfilador.activo and request.endpoint == 'chat':
+        g.marca_perfil = perfilador.iniciar_peticion()
+
+@app.after_request
+def comprimir_respuestas_grandes(response):
+    # br/gzip negociado para JSON/texto por encima de COMPRESS_MIN_BYTES (ver responses.py)
+    return comprimir_respuesta(response, request.accept_encodings)
+
+@app.after_request
+def registrar_primera_peticion(response):
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    # Solo la primera petición real del proceso (no la de calentamiento)
+    if 'first_request_ms' not in metricas_arranque and not request.headers.get('X-Warmup'):
+        metricas_arranque['first_request_ms'] = round((time.perf_counter() - g.inicio_peticion) * 1000, 2)
+        metricas_arranque['first_request_path'] = request.path
+        logger.info(f"⏱️ Primera petición ({request.path}) en {metricas_arranque['first_request_ms']} ms")
+    return response
+
 # === Inicialización ===
+def calentar_worker():
+    """
+    Calienta el proceso antes de aceptar tráfico: crea su pool de BD, resuelve una
+    petición interna y ejercita la búsqueda de tours (sin llamar al modelo).
+    """
+    inicio = time.perf_counter()
+    try:
+        # Primera ronda de salud síncrona: el worker entra con estado conocido
+        probador_salud.refrescar()
+        probador_salud.asegurar_iniciado()
+        # Turnos pendientes de un arranque anterior: se reproducen sin esperar al primer chat
+        if spool.SPOOL_ENABLED:
+            reproductor_spool.asegurar_iniciado()
+        # Petición interna directa a la app WSGI: app.test_client() depende de
+        # werkzeug.__version__, que Werkzeug 3.1 ya no expone
+        entorno = EnvironBuilder(path='/destinations', headers={'X-Warmup': '1'}).get_environ()
+        respuesta = app.wsgi_app(entorno, lambda estado, cabeceras, exc_info=None: (lambda datos: None))
+        try:
+            for _ in respuesta:
+                pass
+        finally:
+            if hasattr(respuesta, 'close'):
+                respuesta.close()
+    except Exception as e:
+        logger.warning(f"⚠️ Error en el calentamiento del worker: {str(e)}")
+    # La búsqueda se calienta aunque falle la petición interna
+    try:
+        keywords = sorted(extraer_keywords('tour uros taquile amantani', 'es'))
+        formatear_contexto_detallado(buscar_tours_relevantes(keywords), 'es')
+    except Exception as e:
+        logger.warning(f"⚠️ Error calentando la búsqueda de tours: {str(e)}")
+    metricas_arranque['warmup_ms'] = round((time.perf_counter() - inicio) * 1000, 2)
+    logger.info(f"🔥 Worker {os.getpid()} calentado en {metricas_arranque['warmup_ms']} ms")
+
 def initialize_app():
     """Inicializa la aplicación y verifica dependencias."""
     logger.info("🚀 Iniciando IncaLake Chatbot API")
@@ -818,12 +1877,13 @@ def initialize_app():
         logger.error(f"❌ Error inicializando base de datos: {str(e)}", exc_info=True)
         raise
     
-    # Verificar API de Gemini
+    # Crear los clientes de Gemini (no contacta la API: la salud del upstream la mide el probador)
     try:
-        genai.GenerativeModel('gemini-1.5-pro-latest')
-        logger.info("✅ Conexión con Gemini API verificada")
+        gemini_model.cargar()
+        translation_model.cargar()
+        logger.info("✅ Clientes de Gemini creados")
     except Exception as e:
-        logger.error(f"❌ Error verificando Gemini API: {str(e)}", exc_info=True)
+        logger.error(f"❌ Error creando los clientes de Gemini: {str(e)}", exc_info=True)
         raise
     
     logger.info("✅ Inicialización completada")
@@ -838,27 +1898,64 @@ def root():
         "timestamp": datetime.utcnow().isoformat(),
         "endpoints": [
             "/health",
+            "/livez",
+            "/readyz",
             "/register_user", 
             "/chat",
             "/destinations",
+            "/tours",
+            "/tours/search",
+            "/tours/<tour_id>",
             "/session/<session_id>/history",
             "/session/<session_id>/clear",
             "/admin/conversations",
             "/admin/conversation/<session_id>/full", 
             "/admin/conversations/search",
-            "/admin/stats"
+            "/admin/export",
+            "/admin/stats",
+            "/admin/stats/series",
+            "/admin/metrics",
+            "/admin/profile",
+            "/admin/memory"
         ]
     })
 
+def respuesta_asset(encontrado, etag, cache_control):
+    """Respuesta de un asset precomprimido, con 304 si el cliente ya tiene esa variante."""
+    cuerpo, codificacion, tipo = encontrado
+    # Cada codificación es una representación distinta: su propio ETag fuerte
+    etag = f"{etag}-{codificacion}" if codificacion else etag
+    if request.if_none_match.contains(etag):
+        respuesta = Response(status=304)
+    else:
+        respuesta = Response(cuerpo, content_type=tipo)
+        if codificacion:
+            respuesta.headers['Content-Encoding'] = codificacion
+    respuesta.set_etag(etag)
+    respuesta.headers['Cache-Control'] = cache_control
+    respuesta.headers['Vary'] = 'Accept-Encoding'
+    return respuesta
+
 @app.route('/app')
 def serve_app():
-    """Sirve la aplicación web desde static/index.html"""
+    """Sirve la aplicación web: shell con assets versionados, o static/index.html si no están construidos"""
+    if assets_widget is not None:
+        # El shell se revalida siempre (no-cache + ETag); los assets que referencia son inmutables
+        return respuesta_asset(assets_widget.shell(request.accept_encodings), assets_widget.shell_etag, "no-cache")
     try:
         from flask import send_from_directory
         return send_from_directory('static', 'index.html')
     except Exception:
         return jsonify({"error": "Frontend no encontrado"}), 404
 
+@app.route('/assets/<nombre>')
+def serve_asset(nombre):
+    """JS/CSS del widget con hash de contenido en el nombre (variante br/gzip según Accept-Encoding)"""
+    if assets_widget is None or not assets_widget.es_asset(nombre):
+        return jsonify({"error": "Asset no encontrado"}), 404
+    huella_nombre = nombre.split('.')[1]
+    return respuesta_asset(assets_widget.obtener(nombre, request.accept_encodings), huella_nombre, CACHE_INMUTABLE)
+
 
 @app.route('/admin/conversations', methods=['GET'])
 def get_all_conversations():
@@ -979,10 +2076,17 @@ def get_full_conversation(session_id):
             "modified": datetime.fromtimestamp(file_stats.st_mtime).isoformat()
         }
         
-        return jsonify({
-            "success": True,
-            "session_data": session_data
-        })
+        # El historial (lo que crece) se emite por trozos, dentro de session_data como en el archivo
+        history = session_data.pop('history', None)
+        if not isinstance(history, list):
+            if history is not None:
+                session_data['history'] = history
+            return jsonify({"success": True, "session_data": session_data})
+        return respuesta_json_stream(
+            {"success": True, "session_data": session_data},
+            "history", history,
+            dentro_de="session_data"
+        )
         
     except json.JSONDecodeError:
         return jsonify({"error": "Error al leer el archivo JSON"}), 500
@@ -1072,62 +2176,144 @@ def search_conversations():
         logger.error(f"Error en búsqueda: {str(e)}", exc_info=True)
         return jsonify({"error": "Error interno del servidor"}), 500
 
+@app.route('/admin/export', methods=['GET'])
+@requiere_token_admin
+def export_data():
+    """
+    Exporta todos los leads o mensajes de la base de datos en streaming.
+    
+    Recorre las tablas por id en lotes de EXPORT_BATCH filas (sin OFFSET ni
+    cargar todo en memoria), así que sirve igual para cientos que para millones
+    de filas. Contiene datos personales: requiere ADMIN_TOKEN.
+    
+    Query params:
+    - type: 'leads' (usuarios_chatbot) o 'messages' (mensajes_chatbot) (default: messages)
+    - format: 'ndjson' o 'csv' (default: ndjson)
+    - from / to: rango de fechas ISO (to incluye el día completo si no lleva hora)
+    - after: id a partir del cual continuar una exportación interrumpida
+    
+    Returns:
+    - 200: Archivo NDJSON o CSV (Content-Disposition: attachment)
+    - 400: Parámetros inválidos
+    - 401: Token inválido (404 si no hay ADMIN_TOKEN configurado)
+    """
+    tipo = request.args.get('type', 'messages')
+    formato = request.args.get('format', 'ndjson')
+    if tipo not in COLUMNAS or formato not in FORMATOS:
+        return jsonify({"error": f"type debe ser {list(COLUMNAS)} y format {list(FORMATOS)}"}), 400
+    try:
+        desde = parsear_fecha(request.args.get('from'))
+        hasta = parsear_fecha(request.args.get('to'), fin=True)
+        despues_de = int(request.args.get('after', 0))
+    except ValueError:
+        return jsonify({"error": "from/to deben ser fechas ISO y after un entero"}), 400
+    
+    filas = db_manager.exportar_filas(tipo, desde=desde, hasta=hasta, despues_de_id=despues_de, lote=EXPORT_BATCH)
+    logger.info(f"📤 Exportando {tipo} en {formato} (from={desde}, to={hasta}, after={despues_de})")
+    respuesta = Response(exportar(filas, tipo, formato), mimetype=FORMATOS[formato])
+    nombre = f"incalake_{tipo}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{formato}"
+    respuesta.headers['Content-Disposition'] = f'attachment; filename="{nombre}"'
+    respuesta.headers['Cache-Control'] = 'no-store'
+    return respuesta
+
 @app.route('/admin/stats', methods=['GET'])
 def get_conversation_stats():
     """
     Obtiene estadísticas generales de todas las conversaciones.
+    
+    Se leen de los rollups que se actualizan al guardar cada turno (stats.py):
+    unas pocas filas por clave primaria, sin importar cuántos mensajes haya.
+    
+    Returns:
+    - 200: Totales generales y por idioma
+    - 500: Error interno
     """
-    try:
-        session_files = glob.glob('chatsessions/session_*.json')
-        
-        total_conversations = len(session_files)
-        total_messages = 0
-        total_users = set()
-        date_range = {"earliest": None, "latest": None}
-        
-        for file_path in session_files:
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    session_data = json.load(f)
-                
-                user_info = session_data.get('user', {})
-                history = session_data.get('history', [])
-                
-                total_messages += len(history)
-                if user_info.get('correo'):
-                    total_users.add(user_info.get('correo'))
-                
-                # Actualizar rango de fechas
-                for msg in history:
-                    timestamp = msg.get('timestamp')
-                    if timestamp:
-                        if not date_range["earliest"] or timestamp < date_range["earliest"]:
-                            date_range["earliest"] = timestamp
-                        if not date_range["latest"] or timestamp > date_range["latest"]:
-                            date_range["latest"] = timestamp
-                            
-            except (json.JSONDecodeError, IOError):
-                continue
-        
-        return jsonify({
-            "success": True,
-            "stats": {
-                "total_conversations": total_conversations,
-                "total_messages": total_messages,
-                "unique_users": len(total_users),
-                "average_messages_per_conversation": round(total_messages / max(total_conversations, 1), 2),
-                "date_range": date_range
+    resumen = db_manager.resumen_estadisticas()
+    if resumen is None:
+        return jsonify({"error": "Error interno del servidor"}), 500
+    
+    total = resumen.pop(IDIOMA_TODOS, None) or {
+        "mensajes": 0, "turnos": 0, "sesiones": 0, "usuarios": 0, "primer_mensaje": None, "ultimo_mensaje": None
+    }
+    return jsonify({
+        "success": True,
+        "stats": {
+            "total_conversations": total["sesiones"],
+            "total_messages": total["mensajes"],
+            "total_turns": total["turnos"],
+            "unique_users": total["usuarios"],
+            "average_messages_per_conversation": round(total["mensajes"] / max(total["sesiones"], 1), 2),
+            "date_range": {"earliest": total["primer_mensaje"], "latest": total["ultimo_mensaje"]},
+            "by_language": {
+                idioma: {
+                    "conversations": fila["sesiones"],
+                    "messages": fila["mensajes"],
+                    "turns": fila["turnos"],
+                    "unique_users": fila["usuarios"]
+                }
+                for idioma, fila in sorted(resumen.items())
             }
-        })
-        
-    except Exception as e:
-        logger.error(f"Error obteniendo estadísticas: {str(e)}", exc_info=True)
+        }
+    })
+
+@app.route('/admin/stats/series', methods=['GET'])
+def get_stats_series():
+    """
+    Serie temporal de estadísticas para gráficos.
+    
+    Query params:
+    - bucket: 'day', 'week' o 'month' (default: day)
+    - from / to: rango de fechas ISO, to incluido (default: los últimos 30 días)
+    - language: 'es', 'en' o '*' para todos (default: *)
+    
+    En buckets semanales o mensuales, conversations y unique_users son la suma
+    de los valores diarios.
+    
+    Returns:
+    - 200: Lista de puntos {period, messages, turns, conversations, unique_users}
+    - 400: Parámetros inválidos
+    - 500: Error interno
+    """
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in STATS_BUCKETS:
+        return jsonify({"error": f"bucket debe ser uno de {list(STATS_BUCKETS)}"}), 400
+    try:
+        hasta = parsear_fecha(request.args.get('to'), fin=True) or (datetime.now() + timedelta(days=1))
+        desde = parsear_fecha(request.args.get('from')) or (hasta - timedelta(days=STATS_SERIES_DEFAULT_DAYS))
+    except ValueError:
+        return jsonify({"error": "from/to deben ser fechas ISO"}), 400
+    if desde >= hasta or (hasta - desde).days > STATS_SERIES_MAX_DAYS:
+        return jsonify({"error": f"El rango debe ser positivo y de como máximo {STATS_SERIES_MAX_DAYS} días"}), 400
+    idioma = request.args.get('language', IDIOMA_TODOS)
+    
+    serie = db_manager.serie_estadisticas(desde.date(), hasta.date(), bucket, idioma)
+    if serie is None:
         return jsonify({"error": "Error interno del servidor"}), 500
+    return jsonify({
+        "success": True,
+        "bucket": bucket,
+        "language": idioma,
+        "from": desde.date().isoformat(),
+        "to": (hasta - timedelta(days=1)).date().isoformat(),
+        "series": [
+            {
+                "period": punto["periodo"],
+                "messages": punto["mensajes"],
+                "turns": punto["turnos"],
+                "conversations": punto["sesiones"],
+                "unique_users": punto["usuarios"]
+            }
+            for punto in serie
+        ]
+    })
+
+metricas_arranque['import_ms'] = round((time.perf_counter() - _INICIO_IMPORT) * 1000, 2)
 
 # En app.py, reemplaza la sección if __name__ == '__main__': con este código:
 
 if __name__ == '__main__':
     initialize_app()
+    calentar_worker()
     
     # Para Easypanel - usar el puerto exacto de la variable de entorno
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,281 @@
+"""
+assets.py - Pipeline de assets estáticos del widget
+
+static/index.html sigue siendo la fuente (CSS y JS en línea). build_assets.py
+lo separa en un CSS y un JS minificados con el hash del contenido en el nombre
+(widget.<hash>.css / .js) más sus variantes gzip y brotli precomprimidas, y
+deja un HTML "shell" pequeño que los referencia. Los assets con hash se
+sirven con caché inmutable; el shell se revalida con ETag.
+
+Los minificadores son conservadores (sin dependencias de Node): quitan
+comentarios y espacios sin tocar strings, template literals ni regex, y
+mantienen los saltos de línea del JS para no alterar la inserción automática
+de punto y coma.
+"""
+
+import os
+import re
+import gzip
+import json
+import hashlib
+
+try:
+    import brotli
+except ImportError:  # opcional: sin brotli solo se generan variantes gzip
+    brotli = None
+
+DIR_ASSETS = os.getenv('WIDGET_ASSETS_DIR', os.path.join('static', 'dist'))
+MANIFIESTO = 'manifest.json'
+# Extensión de cada variante precomprimida (Content-Encoding -> sufijo)
+VARIANTES = {'br': '.br', 'gzip': '.gz'}
+TIPOS = {
+    '.js': 'application/javascript; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.html': 'text/html; charset=utf-8',
+}
+
+_PUNTUACION_CSS = re.compile(r'\s*([{};,>])\s*')
+_STRING_CSS = re.compile(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')')
+_PUNTUACION_JS = set('{}()[];,:=<>&|!?')
+_PALABRAS_ANTES_DE_REGEX = {'return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new',
+                            'delete', 'void', 'throw', 'yield', 'await', 'instanceof'}
+
+
+def huella(datos):
+    return hashlib.sha256(datos).hexdigest()[:12]
+
+
+# === Minificadores ===
+def minificar_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    # Las posiciones impares son strings ("..." o '...'), que se dejan intactas
+    partes = _STRING_CSS.split(css)
+    for i in range(0, len(partes), 2):
+        parte = re.sub(r'\s+', ' ', partes[i])
+        parte = _PUNTUACION_CSS.sub(r'\1', parte)
+        partes[i] = re.sub(r':\s+', ':', parte)  # solo el espacio después: "a :hover" no equivale a "a:hover"
+    return ''.join(partes).replace(';}', '}').strip()
+
+
+def minificar_js(js):
+    """Quita comentarios, sangría y espacios redundantes respetando strings, templates y regex."""
+    salida = []
+    pila = []  # 'template' o profundidad de llaves dentro de una sustitución ${...}
+    ultimo = ''  # último token significativo emitido (para distinguir regex de división)
+    i, n = 0, len(js)
+
+    def espacio_necesario(siguiente):
+        anterior = salida[-1][-1] if salida and salida[-1] else '\n'
+        return not (anterior in '\n ' or anterior in _PUNTUACION_JS or siguiente in _PUNTUACION_JS)
+
+    while i < n:
+        c = js[i]
+        if pila and pila[-1] == 'template':
+            # Dentro de un template literal todo se copia tal cual
+            if c == '\\':
+                salida.append(js[i:i + 2])
+                i += 2
+            elif c == '`':
+                pila.pop()
+                salida.append(c)
+                ultimo = '`'
+                i += 1
+            elif js.startswith('${', i):
+                pila.append(0)
+                salida.append('${')
+                ultimo = '{'
+                i += 2
+            else:
+                salida.append(c)
+                i += 1
+            continue
+
+        if c in '\'"':
+            fin = i + 1
+            while fin < n and js[fin] != c:
+                fin += 2 if js[fin] == '\\' else 1
+            salida.append(js[i:fin + 1])
+            ultimo = c
+            i = fin + 1
+        elif c == '`':
+            pila.append('template')
+            salida.append(c)
+            i += 1
+        elif js.startswith('//', i):
+            fin = js.find('\n', i)
+            i = n if fin == -1 else fin
+        elif js.startswith('/*', i):
+            fin = js.find('*/', i + 2)
+            comentario = js[i:n if fin == -1 else fin + 2]
+            i = n if fin == -1 else fin + 2
+            if '\n' in comentario:
+                salida.append('\n')
+            elif espacio_necesario(js[i:i + 1] or ';'):
+                salida.append(' ')
+        elif c == '/' and (not ultimo or ultimo in '(,=:[!&|?{};+-*%<>~^\n' or ultimo in _PALABRAS_ANTES_DE_REGEX):
+            # Literal de expresión regular
+            fin, en_clase = i + 1, False
+            while fin < n and (js[fin] != '/' or en_clase):
+                if js[fin] == '\\':
+                    fin += 1
+                elif js[fin] == '[':
+                    en_clase = True
+                elif js[fin] == ']':
+                    en_clase = False
+                fin += 1
+            fin += 1
+            while fin < n and js[fin].isalpha():
+                fin += 1
+            salida.append(js[i:fin])
+            ultimo = '/'
+            i = fin
+        elif c == '\n' or c == '\r':
+            while salida and salida[-1] == ' ':
+                salida.pop()
+            if salida and salida[-1] != '\n':
+                salida.append('\n')
+            i += 1
+            while i < n and js[i] in ' \t':
+                i += 1
+        elif c in ' \t':
+            while i < n and js[i] in ' \t':
+                i += 1
+            if i < n and js[i] not in '\r\n' and espacio_necesario(js[i]):
+                salida.append(' ')
+        else:
+            if c == '{' and pila:
+                pila[-1] += 1
+            elif c == '}' and pila:
+                if pila[-1] == 0:
+                    pila.pop()  # fin de la sustitución: se vuelve al template
+                else:
+                    pila[-1] -= 1
+            if c.isalnum() or c in '_$':
+                fin = i
+                while fin < n and (js[fin].isalnum() or js[fin] in '_$'):
+                    fin += 1
+                ultimo = js[i:fin]
+                salida.append(ultimo)
+                i = fin
+            else:
+                salida.append(c)
+                ultimo = c
+                i += 1
+    return ''.join(salida).strip() + '\n'
+
+
+def minificar_html(html):
+    html = re.sub(r'<!--(?!\[).*?-->', '', html, flags=re.S)
+    lineas = (linea.strip() for linea in html.splitlines())
+    return '\n'.join(linea for linea in lineas if linea)
+
+
+# === Construcción ===
+def _escribir_con_variantes(ruta, datos):
+    """Escribe el archivo y sus variantes precomprimidas. Devuelve {codificación: bytes}."""
+    tamanos = {'identity': len(datos)}
+    with open(ruta, 'wb') as f:
+        f.write(datos)
+    comprimidos = {'gzip': gzip.compress(datos, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        comprimidos['br'] = brotli.compress(datos, quality=11)
+    for codificacion, contenido in comprimidos.items():
+        with open(ruta + VARIANTES[codificacion], 'wb') as f:
+            f.write(contenido)
+        tamanos[codificacion] = len(contenido)
+    return tamanos
+
+
+def construir_assets(ruta_html=os.path.join('static', 'index.html'), dir_salida=DIR_ASSETS, prefijo_url='/assets/'):
+    """Separa, minifica y versiona el widget. Devuelve el manifiesto."""
+    with open(ruta_html, 'rb') as f:
+        fuente = f.read()
+    html = fuente.decode('utf-8')
+
+    estilos = re.findall(r'<style>(.*?)</style>', html, flags=re.S)
+    scripts = re.findall(r'<script>(.*?)</script>', html, flags=re.S)
+    css = minificar_css('\n'.join(estilos)).encode('utf-8')
+    js = minificar_js('\n;\n'.join(scripts)).encode('utf-8')
+
+    os.makedirs(dir_salida, exist_ok=True)
+    for nombre in os.listdir(dir_salida):
+        if nombre.startswith('widget.'):
+            os.remove(os.path.join(dir_salida, nombre))
+
+    archivos = {}
+    nombre_css = f"widget.{huella(css)}.css"
+    nombre_js = f"widget.{huella(js)}.js"
+    archivos[nombre_css] = _escribir_con_variantes(os.path.join(dir_salida, nombre_css), css)
+    archivos[nombre_js] = _escribir_con_variantes(os.path.join(dir_salida, nombre_js), js)
+
+    # Shell: CSS enlazado en <head>; scripts diferidos (no bloquean el parseo) y en orden
+    shell = re.sub(r'<style>.*?</style>', '', html, flags=re.S)
+    # El JS se ejecuta al final (después de marked), pero se descarga desde el <head>
+    shell = shell.replace('</head>', f'<link rel="stylesheet" href="{prefijo_url}{nombre_css}">\n'
+                                     f'<link rel="preload" as="script" href="{prefijo_url}{nombre_js}">\n</head>', 1)
+    shell = re.sub(r'<script>.*?</script>', '', shell, flags=re.S)
+    shell = re.sub(r'<script src="([^"]+)"></script>', r'<script src="\1" defer></script>', shell)
+    shell = shell.replace('</body>', f'<script src="{prefijo_url}{nombre_js}" defer></script>\n</body>', 1)
+    shell = minificar_html(shell).encode('utf-8')
+    archivos['index.html'] = _escribir_con_variantes(os.path.join(dir_salida, 'widget.index.html'), shell)
+
+    manifiesto = {
+        'source_sha': huella(fuente),
+        'source_bytes': len(fuente),
+        'shell': 'widget.index.html',
+        'shell_etag': huella(shell),
+        'css': nombre_css,
+        'js': nombre_js,
+        'bytes': archivos,
+    }
+    with open(os.path.join(dir_salida, MANIFIESTO), 'w', encoding='utf-8') as f:
+        json.dump(manifiesto, f, indent=2)
+    return manifiesto
+
+
+# === Servicio ===
+class AssetsWidget:
+    """Assets construidos, cargados en memoria (son unos pocos KB) con sus variantes."""
+
+    def __init__(self, dir_salida=DIR_ASSETS):
+        with open(os.path.join(dir_salida, MANIFIESTO), encoding='utf-8') as f:
+            self.manifiesto = json.load(f)
+        self.shell_etag = self.manifiesto['shell_etag']
+        self._archivos = {}
+        for nombre in (self.manifiesto['shell'], self.manifiesto['css'], self.manifiesto['js']):
+            ruta = os.path.join(dir_salida, nombre)
+            variantes = {}
+            with open(ruta, 'rb') as f:
+                variantes['identity'] = f.read()
+            for codificacion, sufijo in VARIANTES.items():
+                if os.path.exists(ruta + sufijo):
+                    with open(ruta + sufijo, 'rb') as f:
+                        variantes[codificacion] = f.read()
+            self._archivos[nombre] = variantes
+
+    def esta_al_dia(self, ruta_html):
+        """True si static/index.html no cambió desde que se construyeron los assets."""
+        with open(ruta_html, 'rb') as f:
+            return huella(f.read()) == self.manifiesto['source_sha']
+
+    def obtener(self, nombre, accept_encoding=None):
+        """
+        Devuelve (cuerpo, codificación, content_type) de un asset, o None si no existe.
+
+        `accept_encoding` es un objeto con calidad por codificación (request.accept_encodings).
+        """
+        variantes = self._archivos.get(nombre)
+        if variantes is None:
+            return None
+        tipo = TIPOS.get(os.path.splitext(nombre)[1], 'application/octet-stream')
+        if accept_encoding is not None:
+            for codificacion in VARIANTES:
+                if codificacion in variantes and accept_encoding[codificacion] > 0:
+                    return variantes[codificacion], codificacion, tipo
+        return variantes['identity'], None, tipo
+
+    def shell(self, accept_encoding=None):
+        return self.obtener(self.manifiesto['shell'], accept_encoding)
+
+    def es_asset(self, nombre):
+        return nombre in (self.manifiesto['css'], self.manifiesto['js'])
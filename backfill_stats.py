@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+backfill_stats.py - Reconstruye los rollups de estadísticas desde mensajes_chatbot
+
+Necesario una vez al desplegar los rollups (los turnos anteriores no están
+contados) y para corregir desvíos si alguna actualización incremental falló.
+Procesa un día por transacción usando el índice por fecha, así que se puede
+ejecutar con la app en marcha (los totales históricos se calculan al leer).
+Los mensajes anteriores a la columna idioma se cuentan como idioma 'und'.
+Las filas del esquema original (pregunta y respuesta en la misma fila) cuentan
+como dos mensajes y un turno, igual que al guardarlas.
+
+Uso: python backfill_stats.py [--from 2024-01-01] [--to 2024-12-31]
+"""
+
+import sys
+import time
+import argparse
+from datetime import date
+
+from database import db_manager
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Reconstruye los rollups de /admin/stats")
+    parser.add_argument('--from', dest='desde', type=date.fromisoformat, help="primer día (por defecto el primer mensaje)")
+    parser.add_argument('--to', dest='hasta', type=date.fromisoformat, help="último día, incluido (por defecto el último mensaje)")
+    args = parser.parse_args(argv[1:])
+
+    db_manager.create_tables()
+    inicio = time.perf_counter()
+    dias = db_manager.reconstruir_estadisticas(
+        desde=args.desde, hasta=args.hasta,
+        progreso=lambda dia: print(f"   {dia.isoformat()} ✔", file=sys.stderr) if dia.day == 1 else None
+    )
+    print(f"✅ Estadísticas reconstruidas: {dias} días en {time.perf_counter() - inicio:.1f} s")
+    resumen = db_manager.resumen_estadisticas() or {}
+    for idioma, fila in sorted(resumen.items()):
+        print(f"   {idioma:4s} mensajes={fila['mensajes']} turnos={fila['turnos']} "
+              f"sesiones={fila['sesiones']} usuarios={fila['usuarios']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
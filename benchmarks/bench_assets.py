@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+bench_assets.py - Bytes transferidos y tiempo hasta widget interactivo: index.html en línea vs assets
+
+Construye los assets en un directorio temporal y compara, para la primera
+visita y para visitas repetidas:
+- antes: static/index.html completo (sin compresión, revalidado por fecha)
+- después: shell + CSS + JS en su mejor variante (br o gzip)
+
+El tiempo hasta widget interactivo se estima con un modelo de red (RTT y
+ancho de banda por perfil): una ida y vuelta por cada nivel de dependencias
+(HTML -> CSS/JS en paralelo) más los bytes de cada nivel. marked.js y
+reCAPTCHA se cargan igual en ambos casos y quedan fuera.
+
+Uso: python benchmarks/bench_assets.py
+"""
+
+import os
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from assets import construir_assets  # noqa: E402
+
+# nombre -> (RTT en s, ancho de banda en bytes/s)
+PERFILES = {
+    '3G lento': (0.400, 400_000 / 8),
+    '4G': (0.085, 9_000_000 / 8),
+    'cable': (0.020, 50_000_000 / 8),
+}
+# Tamaño aproximado de una respuesta 304 (solo cabeceras)
+BYTES_304 = 250
+
+
+def mejor(tamanos):
+    return min(tamanos.values())
+
+
+def tiempo(niveles, rtt, ancho):
+    """Cada nivel: bytes descargados tras una ida y vuelta (los recursos del nivel van en paralelo)."""
+    return sum(rtt + bytes_nivel / ancho for bytes_nivel in niveles if bytes_nivel is not None)
+
+
+def main():
+    ruta_html = os.path.join(RAIZ, 'static', 'index.html')
+    with tempfile.TemporaryDirectory() as tmp:
+        manifiesto = construir_assets(ruta_html, tmp)
+    tamanos = manifiesto['bytes']
+    shell = mejor(tamanos['index.html'])
+    css = mejor(tamanos[manifiesto['css']])
+    js = mejor(tamanos[manifiesto['js']])
+    original = manifiesto['source_bytes']
+
+    casos = {
+        'antes, 1ª visita': [original],
+        'antes, repetida': [BYTES_304],
+        'después, 1ª visita': [shell, css + js],
+        'después, repetida': [BYTES_304],  # CSS/JS inmutables: servidos desde la caché sin petición
+    }
+
+    print(f"Fuente static/index.html: {original} bytes")
+    for nombre, variantes in tamanos.items():
+        print(f"  {nombre:28s} " + "  ".join(f"{c}={t}" for c, t in variantes.items()))
+    print()
+    print(f"{'caso':22s} {'bytes':>8s} " + " ".join(f"{perfil:>12s}" for perfil in PERFILES))
+    for caso, niveles in casos.items():
+        tiempos = " ".join(f"{tiempo(niveles, rtt, ancho) * 1000:10.0f}ms" for rtt, ancho in PERFILES.values())
+        print(f"{caso:22s} {sum(niveles):8d} {tiempos}")
+
+
+if __name__ == '__main__':
+    main()
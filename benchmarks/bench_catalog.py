@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+bench_catalog.py - Tiempo de carga y RSS por worker: JSON vs catálogo binario (mmap)
+
+Genera catálogos sintéticos (replicando tours_ingles.json) y mide, en un
+proceso limpio por caso, el tiempo de carga y la memoria residente: RssAnon
+(privada del worker) y RssFile (páginas del archivo, compartidas entre workers).
+
+Uso: python benchmarks/bench_catalog.py [tamaños...]   (por defecto: 94 50000)
+"""
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from catalog import compilar_catalogo  # noqa: E402
+
+HIJO = r'''
+import sys, time, json
+sys.path.insert(0, {raiz!r})
+
+def rss():
+    campos = {{}}
+    with open('/proc/self/status') as f:
+        for linea in f:
+            if linea.startswith(('RssAnon', 'RssFile')):
+                clave, valor = linea.split(':')
+                campos[clave] = int(valor.split()[0])
+    return campos
+
+from catalog import CatalogoBinario
+antes = rss()
+inicio = time.perf_counter()
+if {formato!r} == 'json':
+    with open({ruta!r}, encoding='utf-8') as f:
+        tours = json.load(f)
+else:
+    tours = CatalogoBinario({ruta!r})
+carga_ms = (time.perf_counter() - inicio) * 1000
+# Un recorrido típico de búsqueda: títulos y prioridades de todos los tours
+inicio = time.perf_counter()
+total = sum(len(t.get('titulo_producto', '')) + t.get('prioridad', 5) for t in tours)
+recorrido_ms = (time.perf_counter() - inicio) * 1000
+despues = rss()
+print(json.dumps({{
+    'load_ms': round(carga_ms, 2),
+    'scan_ms': round(recorrido_ms, 2),
+    'rss_anon_kb': despues.get('RssAnon', 0) - antes.get('RssAnon', 0),
+    'rss_file_kb': despues.get('RssFile', 0) - antes.get('RssFile', 0),
+}}))
+'''
+
+
+def generar_tours(base, n):
+    tours = []
+    for i in range(n):
+        tour = dict(base[i % len(base)])
+        if i >= len(base):
+            tour['titulo_producto'] = f"{tour['titulo_producto']} #{i}"
+            tour['url_servicio'] = f"{tour['url_servicio']}-{i}"
+        tours.append(tour)
+    return tours
+
+
+def medir(formato, ruta):
+    codigo = HIJO.format(raiz=RAIZ, formato=formato, ruta=ruta)
+    salida = subprocess.run([sys.executable, '-c', codigo], capture_output=True, text=True, check=True)
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+
+def main(argv):
+    tamanos = [int(x) for x in argv[1:]] or [94, 50000]
+    with open(os.path.join(RAIZ, 'tours_ingles.json'), encoding='utf-8') as f:
+        base = json.load(f)
+
+    print(f"{'tours':>8} {'formato':>8} {'archivo KB':>11} {'carga ms':>9} {'recorrido ms':>13} {'RssAnon KB':>11} {'RssFile KB':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in tamanos:
+            tours = generar_tours(base, n)
+            ruta_json = os.path.join(tmp, f'tours_{n}.json')
+            ruta_bin = os.path.join(tmp, f'tours_{n}.bin')
+            with open(ruta_json, 'w', encoding='utf-8') as f:
+                json.dump(tours, f, ensure_ascii=False)
+            compilar_catalogo(tours, ruta_bin, ruta_fuente=ruta_json)
+            for formato, ruta in (('json', ruta_json), ('bin', ruta_bin)):
+                r = medir(formato, ruta)
+                print(f"{n:>8} {formato:>8} {os.path.getsize(ruta) // 1024:>11} {r['load_ms']:>9} "
+                      f"{r['scan_ms']:>13} {r['rss_anon_kb']:>11} {r['rss_file_kb']:>11}")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
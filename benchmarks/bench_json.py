@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+bench_json.py - Serialización y compresión de conversaciones largas
+
+Genera conversaciones sintéticas (por defecto 10.000 mensajes) con la forma de
+/session/<id>/history y mide:
+- tiempo de serialización: json de la stdlib (como jsonify, con sort_keys) vs
+  el serializador de responses.py (msgspec si está instalado)
+- tamaño y tiempo de compresión: sin comprimir, gzip y brotli a los niveles
+  que usa comprimir_respuesta
+- memoria pico (tracemalloc): documento completo vs respuesta_json_stream
+
+Uso: python benchmarks/bench_json.py [mensajes...]
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import tracemalloc
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import responses  # noqa: E402
+from responses import dumps, respuesta_json_stream, COMPRESS_GZIP_LEVEL, COMPRESS_BROTLI_QUALITY  # noqa: E402
+
+PALABRAS = ("tour uros taquile amantani titicaca puno precio personas fecha hotel "
+            "recojo guía almuerzo isla lago ¿cuánto cuesta? 🌊 📅 👥 reservar").split()
+
+
+def conversacion(n, semilla=7):
+    rnd = random.Random(semilla)
+    return [
+        {'role': 'user' if i % 2 == 0 else 'model',
+         'parts': [' '.join(rnd.choice(PALABRAS) for _ in range(12 if i % 2 == 0 else 80))]}
+        for i in range(n)
+    ]
+
+
+def medir(funcion, repeticiones=5):
+    mejor = float('inf')
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return resultado, mejor * 1000
+
+
+def pico(funcion):
+    tracemalloc.start()
+    funcion()
+    _, maximo = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return maximo / 1024 / 1024
+
+
+def main(tamanos):
+    print(f"Serializador rápido: {responses.SERIALIZADOR}")
+    for n in tamanos:
+        historial = conversacion(n)
+        documento = {'success': True, 'session_id': 'bench', 'usuario_id': 1, 'historial': historial, 'count': n}
+
+        stdlib, t_stdlib = medir(lambda: json.dumps(documento, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+        rapido, t_rapido = medir(lambda: dumps(documento))
+        print(f"\n{n} mensajes")
+        print(f"  serialización  stdlib json {t_stdlib:8.2f} ms ({len(stdlib)} bytes)   "
+              f"{responses.SERIALIZADOR} {t_rapido:8.2f} ms ({len(rapido)} bytes)   x{t_stdlib / t_rapido:.1f}")
+
+        gz, t_gz = medir(lambda: gzip.compress(rapido, compresslevel=COMPRESS_GZIP_LEVEL), 3)
+        print(f"  gzip-{COMPRESS_GZIP_LEVEL}         {len(gz):9d} bytes ({len(gz) / len(rapido):.1%}) en {t_gz:.2f} ms")
+        if responses.brotli is not None:
+            br, t_br = medir(lambda: responses.brotli.compress(rapido, quality=COMPRESS_BROTLI_QUALITY), 3)
+            print(f"  brotli-{COMPRESS_BROTLI_QUALITY}       {len(br):9d} bytes ({len(br) / len(rapido):.1%}) en {t_br:.2f} ms")
+
+        def completo():
+            dumps(documento)
+
+        def en_stream():
+            for _ in respuesta_json_stream({'success': True}, 'historial', historial,
+                                           pie=lambda total: {'count': total}).response:
+                pass
+        print(f"  memoria pico   documento completo {pico(completo):6.2f} MB   stream {pico(en_stream):6.2f} MB")
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [10000])
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+eval_retrieval.py - Calidad (recall@3, MRR) y latencia de cada motor de búsqueda de tours
+
+Ejecuta las consultas etiquetadas de retrieval_queries.json (español e inglés:
+Uros, Taquile, Amantani, Colca, Uyuni, Machu Picchu, errores de escritura,
+presupuesto y grupo) por el grafo de etapas de /chat con cada motor de
+app.BACKENDS_BUSQUEDA, y compara los tours elegidos con los url_servicio
+esperados de cada consulta:
+
+- recall@3: esperados entre los 3 primeros / min(esperados, 3), así una
+  consulta con 5 tours válidos puede llegar a 1
+- MRR: 1 / posición del primer esperado (0 si no aparece en los 3 primeros)
+- latencia: etapa 'tours' (solo el motor) y total del grafo, con --repeat
+  ejecuciones por consulta
+
+Por defecto la traducción de keywords usa el LLM falso (devuelve las mismas
+keywords), así el resultado es reproducible y sin coste; con --llm gemini se
+usa el modelo real (requiere GEMINI_API_KEY).
+
+Uso: python benchmarks/eval_retrieval.py [--backend keywords ...] [--tag typo] [--repeat 5] [--verbose] [--json informe.json]
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+CONSULTAS = os.path.join(RAIZ, 'benchmarks', 'retrieval_queries.json')
+K = 3
+
+
+def cargar_app(llm):
+    """Importa la app sin BD, caché ni spool reales (la búsqueda no los usa)."""
+    if llm == 'fake':
+        os.environ['LLM_PROVIDER'] = 'fake'
+        os.environ['FAKE_LLM_FIRST_TOKEN_DELAY'] = '0'
+        os.environ['FAKE_LLM_FAILURE_RATE'] = '0'
+    os.environ.update({
+        'DB_ENGINE': 'sqlite',
+        'DB_SQLITE_PATH': os.path.join(tempfile.mkdtemp(prefix='eval-'), 'eval.sqlite3'),
+        'CACHE_URL': 'memory://',
+        'SPOOL_ENABLED': '0',
+        'LOG_FILE': '',
+    })
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    # El catálogo se carga con rutas relativas a la raíz del proyecto
+    os.chdir(RAIZ)
+    import app
+    return app
+
+
+def evaluar_consulta(app, pipeline, consulta, buscar, repeticiones):
+    """Tours elegidos, recall@3, reciprocal rank y tiempos de una consulta."""
+    tiempos_tours, tiempos_total = [], []
+    tours = []
+    for _ in range(repeticiones):
+        etapas = app.etapas_pregeneracion(
+            consulta['query'], consulta['language'],
+            cargar_usuario=lambda: {'id': 0},
+            cargar_historial=lambda: [],
+            buscar_tours=buscar
+        )
+        resultados, tiempos = pipeline.ejecutar_grafo(etapas)
+        tours = resultados['tours']
+        tiempos_tours.append(tiempos['tours']['duration_ms'])
+        tiempos_total.append(tiempos['_total']['duration_ms'])
+
+    # Varios tours comparten url_servicio: cuenta la primera aparición
+    ranking = list(dict.fromkeys(tour.get('url_servicio', '') for tour in tours))[:K]
+    esperados = set(consulta['expected'])
+    aciertos = [url for url in ranking if url in esperados]
+    posicion = next((i for i, url in enumerate(ranking) if url in esperados), None)
+    return {
+        'id': consulta['id'],
+        'intent': resultados['intencion'],
+        'returned': ranking,
+        'hits': aciertos,
+        'recall': len(aciertos) / min(len(esperados), K),
+        'rr': 1 / (posicion + 1) if posicion is not None else 0.0,
+        'tours_ms': sorted(tiempos_tours)[len(tiempos_tours) // 2],
+        'total_ms': sorted(tiempos_total)[len(tiempos_total) // 2],
+        '_muestras_tours': tiempos_tours,
+    }
+
+
+def _percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(p / 100 * len(ordenados)))]
+
+
+def resumir(resultados):
+    muestras = [ms for r in resultados for ms in r['_muestras_tours']]
+    return {
+        'queries': len(resultados),
+        'recall_at_3': round(sum(r['recall'] for r in resultados) / len(resultados), 3),
+        'mrr': round(sum(r['rr'] for r in resultados) / len(resultados), 3),
+        'tours_p50_ms': _percentil(muestras, 50),
+        'tours_p95_ms': _percentil(muestras, 95),
+        'total_p50_ms': _percentil([r['total_ms'] for r in resultados], 50),
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Recall@3, MRR y latencia por motor de búsqueda de tours")
+    parser.add_argument('--backend', action='append', help="motor a evaluar (por defecto todos los registrados)")
+    parser.add_argument('--queries', default=CONSULTAS, help="consultas etiquetadas (JSON)")
+    parser.add_argument('--tag', action='append', help="solo consultas con esta etiqueta (es/en cuentan como etiqueta)")
+    parser.add_argument('--repeat', type=int, default=5, help="ejecuciones por consulta para la latencia")
+    parser.add_argument('--llm', choices=['fake', 'gemini'], default='fake', help="modelo para traducir keywords")
+    parser.add_argument('--verbose', action='store_true', help="mostrar las consultas con fallos")
+    parser.add_argument('--json', dest='salida_json', help="informe completo en JSON")
+    parser.add_argument('--min-recall', type=float, help="salir con código 1 si algún motor queda por debajo")
+    args = parser.parse_args(argv[1:])
+    # cargar_app cambia al directorio raíz: rutas relativas al directorio de trabajo
+    args.queries = os.path.abspath(args.queries)
+    args.salida_json = args.salida_json and os.path.abspath(args.salida_json)
+
+    with open(args.queries, encoding='utf-8') as f:
+        consultas = json.load(f)
+    for consulta in consultas:
+        consulta['tags'] = consulta.get('tags', []) + [consulta['language']]
+    if args.tag:
+        consultas = [c for c in consultas if set(args.tag) & set(c['tags'])]
+    if not consultas:
+        parser.error("ninguna consulta coincide con --tag")
+
+    app = cargar_app(args.llm)
+    import pipeline
+
+    backends = args.backend or list(app.BACKENDS_BUSQUEDA)
+    desconocidos = [nombre for nombre in backends if nombre not in app.BACKENDS_BUSQUEDA]
+    if desconocidos:
+        parser.error(f"motor desconocido: {', '.join(desconocidos)} (registrados: {', '.join(app.BACKENDS_BUSQUEDA)})")
+
+    # Etiquetas que ya no existen en el catálogo harían bajar el recall sin motivo
+    urls_catalogo = {tour.get('url_servicio') for tour in app.tours_data_loaded}
+    obsoletas = sorted({url for c in consultas for url in c['expected'] if url not in urls_catalogo})
+    if obsoletas:
+        print("❌ url_servicio esperados que no están en el catálogo:", file=sys.stderr)
+        for url in obsoletas:
+            print(f"   {url}", file=sys.stderr)
+        return 2
+
+    informe = {}
+    por_consulta = {}
+    for nombre in backends:
+        buscar = app.BACKENDS_BUSQUEDA[nombre]
+        # Calentamiento: primera traducción, cachés y pool de hilos fuera de la medida
+        evaluar_consulta(app, pipeline, consultas[0], buscar, 1)
+        resultados = [evaluar_consulta(app, pipeline, c, buscar, args.repeat) for c in consultas]
+        por_consulta[nombre] = resultados
+        informe[nombre] = resumir(resultados)
+        etiquetas = sorted({t for c in consultas for t in c['tags']})
+        informe[nombre]['by_tag'] = {}
+        for etiqueta in etiquetas:
+            subconjunto = [r for r, c in zip(resultados, consultas) if etiqueta in c['tags']]
+            informe[nombre]['by_tag'][etiqueta] = {
+                'queries': len(subconjunto),
+                'recall_at_3': round(sum(r['recall'] for r in subconjunto) / len(subconjunto), 3),
+                'mrr': round(sum(r['rr'] for r in subconjunto) / len(subconjunto), 3),
+            }
+
+    print(f"\n🔎 {len(consultas)} consultas, {args.repeat} ejecuciones cada una (LLM {args.llm})")
+    print(f"   {'motor':16s} {'recall@3':>9s} {'MRR':>6s} {'tours p50':>10s} {'tours p95':>10s} {'grafo p50':>10s}")
+    for nombre, fila in informe.items():
+        print(f"   {nombre:16s} {fila['recall_at_3']:9.3f} {fila['mrr']:6.3f} {fila['tours_p50_ms']:8.3f}ms "
+              f"{fila['tours_p95_ms']:8.3f}ms {fila['total_p50_ms']:8.3f}ms")
+
+    print("\n   recall@3 por etiqueta")
+    print(f"   {'etiqueta':16s} {'n':>3s} " + " ".join(f"{nombre:>14s}" for nombre in informe))
+    for etiqueta in informe[backends[0]]['by_tag']:
+        n = informe[backends[0]]['by_tag'][etiqueta]['queries']
+        print(f"   {etiqueta:16s} {n:3d} " + " ".join(
+            f"{informe[nombre]['by_tag'][etiqueta]['recall_at_3']:14.3f}" for nombre in informe))
+
+    if args.verbose:
+        for nombre, resultados in por_consulta.items():
+            fallos = [(r, c) for r, c in zip(resultados, consultas) if r['recall'] < 1]
+            print(f"\n❌ {nombre}: {len(fallos)} consultas sin recall completo")
+            for r, c in fallos:
+                print(f"   {c['id']:24s} {c['query']!r} (intención {r['intent']})")
+                print(f"      esperado: {[u.rsplit('/en/', 1)[-1] for u in c['expected']]}")
+                print(f"      devuelto: {[u.rsplit('/en/', 1)[-1] for u in r['returned']]}")
+
+    if args.salida_json:
+        for resultados in por_consulta.values():
+            for r in resultados:
+                del r['_muestras_tours']
+        with open(args.salida_json, 'w', encoding='utf-8') as f:
+            json.dump({'summary': informe, 'queries': por_consulta}, f, ensure_ascii=False, indent=2)
+
+    if args.min_recall is not None and any(fila['recall_at_3'] < args.min_recall for fila in informe.values()):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
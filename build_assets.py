@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+build_assets.py - Construye los assets versionados del widget
+
+Separa el CSS y el JS en línea de static/index.html, los minifica, les pone el
+hash del contenido en el nombre y genera variantes .gz y .br (ver assets.py).
+/app sirve el shell resultante si está al día con static/index.html.
+
+Uso: python build_assets.py [static/index.html] [static/dist]
+"""
+
+import os
+import sys
+import time
+
+from assets import construir_assets, DIR_ASSETS
+
+
+def main(argv):
+    entrada = argv[1] if len(argv) > 1 else os.path.join('static', 'index.html')
+    salida = argv[2] if len(argv) > 2 else DIR_ASSETS
+
+    inicio = time.perf_counter()
+    manifiesto = construir_assets(entrada, salida)
+    print(f"✅ Assets del widget en {salida} en {(time.perf_counter() - inicio) * 1000:.1f} ms "
+          f"(fuente: {manifiesto['source_bytes']} bytes)")
+    for nombre, tamanos in manifiesto['bytes'].items():
+        detalle = ", ".join(f"{codificacion}={tamano}" for codificacion, tamano in tamanos.items())
+        print(f"   {nombre}: {detalle}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
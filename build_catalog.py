@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+build_catalog.py - Compila tours_ingles.json al formato binario del catálogo
+
+El binario (ver catalog.py) se abre con mmap en cada worker: columnas numéricas
+de ancho fijo (prioridad y tramos de precio) y una tabla de offsets a un único
+blob UTF-8. cargar_tours() lo usa automáticamente si está al día con el JSON.
+
+Uso: python build_catalog.py [entrada.json] [salida.bin]
+"""
+
+import sys
+import json
+import time
+
+from catalog import compilar_catalogo, CatalogoBinario
+
+
+def main(argv):
+    entrada = argv[1] if len(argv) > 1 else 'tours_ingles.json'
+    salida = argv[2] if len(argv) > 2 else 'tours_ingles.bin'
+
+    inicio = time.perf_counter()
+    with open(entrada, 'r', encoding='utf-8') as f:
+        tours = json.load(f)
+    tamano = compilar_catalogo(tours, salida, ruta_fuente=entrada)
+
+    # Verificar que el binario reproduce el JSON
+    catalogo = CatalogoBinario(salida)
+    if [dict(tour) for tour in catalogo] != tours:
+        print(f"❌ El catálogo compilado no coincide con {entrada}")
+        return 1
+
+    print(f"✅ {len(tours)} tours compilados en {salida} ({tamano} bytes) en {(time.perf_counter() - inicio) * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
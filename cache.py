@@ -0,0 +1,433 @@
+"""
+cache.py - Caché compartida entre workers y nodos (usuarios, historial, traducciones)
+
+Con varios workers de gunicorn (y varios contenedores) los mensajes seguidos
+de una sesión caen en procesos distintos, así que una caché por proceso casi
+nunca acierta. Esta caché vive fuera del proceso:
+
+- `CacheRedis`: cualquier servidor con protocolo Redis (Redis, Valkey, KeyDB...),
+  con un cliente RESP mínimo sin dependencias. Compartida entre nodos; cada
+  clave lleva TTL y la memoria la acota el servidor (maxmemory + allkeys-lru).
+- `CacheSQLite`: un archivo SQLite en modo WAL compartido por los workers de
+  un mismo contenedor. Acotada a CACHE_MAX_ITEMS filas.
+- `CacheMemoria`: LRU con TTL dentro del proceso (pruebas, un solo worker).
+
+Un fallo de la caché nunca rompe una petición: se registra, cuenta como fallo
+y se lee de la base de datos. Tras un error de conexión la caché se desactiva
+CACHE_RETRY_SECONDS para no añadir un timeout a cada petición.
+
+Variables de entorno:
+- CACHE_URL: redis://[:clave@]host:6379/0, sqlite:///ruta.sqlite3 o memory://
+  (default sqlite en el directorio temporal)
+- CACHE_MAX_ITEMS: entradas máximas en memoria/SQLite (default 20000)
+- CACHE_MAX_VALUE_BYTES: valores más grandes no se guardan (default 262144)
+- CACHE_TIMEOUT: timeout de red/bloqueo en segundos (default 0.25)
+- CACHE_RETRY_SECONDS: pausa tras un error de conexión (default 30)
+- CACHE_PREFIX: prefijo de las claves (default incalake:v1:)
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+from responses import dumps
+
+logger = logging.getLogger(__name__)
+
+CACHE_URL = os.getenv('CACHE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'incalake_cache.sqlite3'))
+CACHE_MAX_ITEMS = int(os.getenv('CACHE_MAX_ITEMS', 20000))
+CACHE_MAX_VALUE_BYTES = int(os.getenv('CACHE_MAX_VALUE_BYTES', 256 * 1024))
+CACHE_TIMEOUT = float(os.getenv('CACHE_TIMEOUT', 0.25))
+CACHE_RETRY_SECONDS = float(os.getenv('CACHE_RETRY_SECONDS', 30))
+CACHE_PREFIX = os.getenv('CACHE_PREFIX', 'incalake:v1:')
+
+
+def _loads(datos):
+    if msgspec is not None:
+        return msgspec.json.decode(datos)
+    return json.loads(datos)
+
+
+class CacheNoDisponible(Exception):
+    """El backend no responde (conexión, timeout, base de datos bloqueada)."""
+
+
+class Cache:
+    """
+    Base común: espacios de nombres, serialización JSON, límites y métricas.
+
+    Los backends implementan _leer(clave) -> bytes | None, _escribir(clave, bytes, ttl),
+    _escribir_si_ausente(clave, bytes, ttl) -> bool y _borrar(clave). None no se
+    puede guardar: representa un fallo de caché.
+    """
+
+    backend = 'base'
+
+    def __init__(self, prefijo=CACHE_PREFIX):
+        self.prefijo = prefijo
+        self._lock = threading.Lock()
+        self._metricas = {}
+        self._errores = 0
+        self._omitidos = 0
+        self._pausada_hasta = 0.0
+
+    def _contar(self, espacio, campo):
+        with self._lock:
+            metricas = self._metricas.setdefault(espacio, {'hits': 0, 'misses': 0, 'sets': 0})
+            metricas[campo] += 1
+
+    def _fallo(self, operacion, error):
+        with self._lock:
+            self._errores += 1
+            self._pausada_hasta = time.monotonic() + CACHE_RETRY_SECONDS
+        logger.warning(f"⚠️ Caché {self.backend} no disponible en {operacion} "
+                       f"(se reintenta en {CACHE_RETRY_SECONDS:.0f}s): {error}")
+
+    def _disponible(self):
+        return time.monotonic() >= self._pausada_hasta
+
+    def obtener(self, espacio, clave):
+        """Valor guardado o None si no está, expiró o la caché no responde."""
+        valor = None
+        if self._disponible():
+            try:
+                datos = self._leer(self.prefijo + espacio + ':' + clave)
+                if datos is not None:
+                    valor = _loads(datos)
+            except CacheNoDisponible as e:
+                self._fallo('lectura', e)
+        self._contar(espacio, 'hits' if valor is not None else 'misses')
+        return valor
+
+    def guardar(self, espacio, clave, valor, ttl):
+        """Guarda un valor serializable a JSON durante `ttl` segundos."""
+        if valor is None or not self._disponible():
+            return False
+        datos = dumps(valor)
+        if len(datos) > CACHE_MAX_VALUE_BYTES:
+            with self._lock:
+                self._omitidos += 1
+            return False
+        try:
+            self._escribir(self.prefijo + espacio + ':' + clave, datos, ttl)
+        except CacheNoDisponible as e:
+            self._fallo('escritura', e)
+            return False
+        self._contar(espacio, 'sets')
+        return True
+
+    def guardar_si_ausente(self, espacio, clave, valor, ttl):
+        """
+        Guarda el valor solo si la clave no existe (atómico entre workers).
+
+        Devuelve False si otro ya la tenía. Sin caché disponible devuelve True:
+        no hay con quién coordinarse y la petición sigue sola.
+        """
+        if not self._disponible():
+            return True
+        try:
+            guardado = self._escribir_si_ausente(self.prefijo + espacio + ':' + clave, dumps(valor), ttl)
+        except CacheNoDisponible as e:
+            self._fallo('escritura', e)
+            return True
+        if guardado:
+            self._contar(espacio, 'sets')
+        return guardado
+
+    def borrar(self, espacio, clave):
+        if not self._disponible():
+            return
+        try:
+            self._borrar(self.prefijo + espacio + ':' + clave)
+        except CacheNoDisponible as e:
+            self._fallo('borrado', e)
+
+    def metricas(self):
+        with self._lock:
+            espacios = {}
+            for espacio, valores in self._metricas.items():
+                consultas = valores['hits'] + valores['misses']
+                espacios[espacio] = {**valores, 'hit_rate': round(valores['hits'] / consultas, 4) if consultas else 0.0}
+            return {
+                'backend': self.backend,
+                'spaces': espacios,
+                'errors': self._errores,
+                'skipped_too_large': self._omitidos,
+                'paused': not self._disponible(),
+            }
+
+    def _leer(self, clave):
+        raise NotImplementedError
+
+    def _escribir(self, clave, datos, ttl):
+        raise NotImplementedError
+
+    def _escribir_si_ausente(self, clave, datos, ttl):
+        raise NotImplementedError
+
+    def _borrar(self, clave):
+        raise NotImplementedError
+
+
+class CacheMemoria(Cache):
+    """LRU con TTL dentro del proceso. No se comparte entre workers."""
+
+    backend = 'memory'
+
+    def __init__(self, max_items=CACHE_MAX_ITEMS, **kwargs):
+        super().__init__(**kwargs)
+        self.max_items = max_items
+        self._datos = OrderedDict()  # clave -> (expira, bytes)
+        self._lock_datos = threading.Lock()
+
+    def _leer(self, clave):
+        with self._lock_datos:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return None
+            if entrada[0] <= time.monotonic():
+                del self._datos[clave]
+                return None
+            self._datos.move_to_end(clave)
+            return entrada[1]
+
+    def _escribir(self, clave, datos, ttl):
+        with self._lock_datos:
+            self._datos[clave] = (time.monotonic() + ttl, datos)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+
+    def _escribir_si_ausente(self, clave, datos, ttl):
+        with self._lock_datos:
+            entrada = self._datos.get(clave)
+            if entrada is not None and entrada[0] > time.monotonic():
+                return False
+            self._datos[clave] = (time.monotonic() + ttl, datos)
+            self._datos.move_to_end(clave)
+            return True
+
+    def _borrar(self, clave):
+        with self._lock_datos:
+            self._datos.pop(clave, None)
+
+
+class CacheSQLite(Cache):
+    """
+    Archivo SQLite compartido por los workers de un contenedor (WAL: lectores sin bloqueo).
+
+    Cada hilo abre su propia conexión (y de nuevo tras un fork). Al superar
+    max_items se borran las entradas expiradas y, si no basta, las que expiran antes.
+    """
+
+    backend = 'sqlite'
+    # Cada cuántas escrituras se comprueba el tamaño de la tabla
+    PURGA_CADA = 500
+
+    def __init__(self, ruta, max_items=CACHE_MAX_ITEMS, **kwargs):
+        super().__init__(**kwargs)
+        self.ruta = ruta
+        self.max_items = max_items
+        self._local = threading.local()
+        self._escrituras = 0
+
+    def _conexion(self):
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None or self._local.pid != os.getpid():
+            try:
+                conexion = sqlite3.connect(self.ruta, timeout=CACHE_TIMEOUT, isolation_level=None,
+                                           check_same_thread=False)
+                conexion.execute("PRAGMA journal_mode=WAL")
+                conexion.execute("PRAGMA synchronous=OFF")  # es una caché: perder escrituras no importa
+                conexion.execute("""
+                    CREATE TABLE IF NOT EXISTS cache (
+                        clave TEXT PRIMARY KEY,
+                        valor BLOB NOT NULL,
+                        expira REAL NOT NULL
+                    )
+                """)
+                conexion.execute("CREATE INDEX IF NOT EXISTS idx_cache_expira ON cache (expira)")
+            except sqlite3.Error as e:
+                raise CacheNoDisponible(str(e)) from e
+            self._local.conexion = conexion
+            self._local.pid = os.getpid()
+        return conexion
+
+    def _leer(self, clave):
+        try:
+            fila = self._conexion().execute(
+                "SELECT valor FROM cache WHERE clave = ? AND expira > ?", (clave, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            raise CacheNoDisponible(str(e)) from e
+        return fila[0] if fila else None
+
+    def _escribir(self, clave, datos, ttl):
+        try:
+            conexion = self._conexion()
+            conexion.execute(
+                "INSERT OR REPLACE INTO cache (clave, valor, expira) VALUES (?, ?, ?)",
+                (clave, datos, time.time() + ttl)
+            )
+            self._escrituras += 1
+            if self._escrituras % self.PURGA_CADA == 0:
+                self._purgar(conexion)
+        except sqlite3.Error as e:
+            raise CacheNoDisponible(str(e)) from e
+
+    def _purgar(self, conexion):
+        conexion.execute("DELETE FROM cache WHERE expira <= ?", (time.time(),))
+        sobrantes = conexion.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_items
+        if sobrantes > 0:
+            conexion.execute(
+                "DELETE FROM cache WHERE clave IN (SELECT clave FROM cache ORDER BY expira LIMIT ?)", (sobrantes,)
+            )
+
+    def _escribir_si_ausente(self, clave, datos, ttl):
+        try:
+            conexion = self._conexion()
+            ahora = time.time()
+            # Una entrada expirada cuenta como ausente
+            conexion.execute("DELETE FROM cache WHERE clave = ? AND expira <= ?", (clave, ahora))
+            cursor = conexion.execute(
+                "INSERT OR IGNORE INTO cache (clave, valor, expira) VALUES (?, ?, ?)",
+                (clave, datos, ahora + ttl)
+            )
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            raise CacheNoDisponible(str(e)) from e
+
+    def _borrar(self, clave):
+        try:
+            self._conexion().execute("DELETE FROM cache WHERE clave = ?", (clave,))
+        except sqlite3.Error as e:
+            raise CacheNoDisponible(str(e)) from e
+
+
+class ErrorRESP(Exception):
+    """Respuesta de error (-ERR ...) del servidor."""
+
+
+class CacheRedis(Cache):
+    """
+    Servidor con protocolo Redis (RESP2). Una conexión por hilo, reabierta tras un fork.
+
+    Solo usa GET, SET ... PX [NX] y DEL: funciona con Redis, Valkey, KeyDB o Dragonfly.
+    """
+
+    backend = 'redis'
+
+    def __init__(self, url, **kwargs):
+        super().__init__(**kwargs)
+        partes = urlparse(url)
+        self.host = partes.hostname or 'localhost'
+        self.puerto = partes.port or 6379
+        self.clave_servidor = unquote(partes.password) if partes.password else None
+        self.usuario = unquote(partes.username) if partes.username else None
+        self.db = int(partes.path.lstrip('/') or 0)
+        self.tls = partes.scheme == 'rediss'
+        self._local = threading.local()
+
+    def _conectar(self):
+        sock = socket.create_connection((self.host, self.puerto), timeout=CACHE_TIMEOUT)
+        if self.tls:
+            import ssl
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.sock = sock
+        self._local.lector = sock.makefile('rb')
+        self._local.pid = os.getpid()
+        if self.clave_servidor:
+            self._enviar(*(['AUTH', self.usuario, self.clave_servidor] if self.usuario else ['AUTH', self.clave_servidor]))
+        if self.db:
+            self._enviar('SELECT', self.db)
+
+    def _cerrar(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def _enviar(self, *argumentos):
+        partes = [b'*%d\r\n' % len(argumentos)]
+        for argumento in argumentos:
+            if not isinstance(argumento, bytes):
+                argumento = str(argumento).encode('utf-8')
+            partes.append(b'$%d\r\n%s\r\n' % (len(argumento), argumento))
+        self._local.sock.sendall(b''.join(partes))
+        return self._respuesta()
+
+    def _respuesta(self):
+        linea = self._local.lector.readline()
+        if not linea:
+            raise ConnectionError("conexión cerrada por el servidor")
+        tipo, contenido = linea[:1], linea[1:-2]
+        if tipo == b'+':
+            return contenido
+        if tipo == b'-':
+            raise ErrorRESP(contenido.decode('utf-8', 'replace'))
+        if tipo == b':':
+            return int(contenido)
+        if tipo == b'$':
+            longitud = int(contenido)
+            if longitud < 0:
+                return None
+            datos = self._local.lector.read(longitud + 2)
+            return datos[:-2]
+        if tipo == b'*':
+            longitud = int(contenido)
+            return None if longitud < 0 else [self._respuesta() for _ in range(longitud)]
+        raise ConnectionError(f"respuesta RESP inesperada: {linea[:20]!r}")
+
+    def comando(self, *argumentos):
+        """Ejecuta un comando; reconecta una vez si la conexión del hilo se cayó."""
+        for intento in (1, 2):
+            try:
+                if getattr(self._local, 'sock', None) is None or self._local.pid != os.getpid():
+                    self._conectar()
+                return self._enviar(*argumentos)
+            except ErrorRESP as e:
+                raise CacheNoDisponible(str(e)) from e
+            except (OSError, ConnectionError, ValueError) as e:
+                self._cerrar()
+                if intento == 2:
+                    raise CacheNoDisponible(str(e)) from e
+
+    def _leer(self, clave):
+        return self.comando('GET', clave)
+
+    def _escribir(self, clave, datos, ttl):
+        self.comando('SET', clave, datos, 'PX', max(1, int(ttl * 1000)))
+
+    def _escribir_si_ausente(self, clave, datos, ttl):
+        return self.comando('SET', clave, datos, 'PX', max(1, int(ttl * 1000)), 'NX') is not None
+
+    def _borrar(self, clave):
+        self.comando('DEL', clave)
+
+
+def crear_cache(url=CACHE_URL):
+    """Backend según la URL: redis://, rediss://, sqlite:///ruta o memory://."""
+    esquema = url.split('://', 1)[0]
+    if esquema in ('redis', 'rediss'):
+        return CacheRedis(url)
+    if esquema == 'sqlite':
+        return CacheSQLite(url[len('sqlite:///'):])
+    if esquema == 'memory':
+        return CacheMemoria()
+    raise ValueError(f"CACHE_URL no soportada: {url}")
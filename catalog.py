@@ -0,0 +1,358 @@
+"""
+catalog.py - Datos precalculados del catálogo de tours
+
+Todo lo que se puede derivar de tours_ingles.json una sola vez (precios
+parseados, textos de precios, marca de especialidad Puno) se calcula al
+cargar el catálogo y no en cada petición. También define el formato binario
+compacto (ver build_catalog.py) que los workers abren con mmap y el índice
+que sirve la API de catálogo (/destinations, /tours) sin recorrer los tours.
+"""
+
+import os
+import json
+import hashlib
+import mmap
+import struct
+from array import array
+from collections.abc import Mapping, Sequence
+
+PUNO_KEYWORDS = ['puno', 'titicaca', 'uros', 'taquile', 'amantani']
+
+# Destino -> palabras que lo identifican en el título (o tipo de servicio) del tour
+DESTINOS = {
+    'Puno': PUNO_KEYWORDS,
+    'Cusco': ['cusco', 'machu picchu', 'sacred valley'],
+    'Arequipa': ['arequipa', 'colca', 'canyon'],
+    'Uyuni': ['uyuni', 'salar', 'bolivia'],
+}
+
+FORMATO_PRECIO = {
+    'es': "{d}-{h} personas: ${p} USD",
+    'en': "{d}-{h} people: ${p} USD",
+}
+PRECIO_A_CONSULTAR = {
+    'es': "Precio a consultar",
+    'en': "Price on request",
+}
+
+
+def parsear_precios(tour):
+    """Devuelve la lista de tramos (desde, hasta, precio) de `precios_rango`, o []."""
+    try:
+        precios = json.loads(tour.get("precios_rango", "{}") or "{}")
+        if precios and all(k in precios for k in ["desde", "hasta", "precio"]):
+            return list(zip(precios["desde"], precios["hasta"], precios["precio"]))
+    except (json.JSONDecodeError, TypeError):
+        pass
+    return []
+
+
+def es_tour_puno(tour):
+    texto = (tour.get("titulo_producto", "") + tour.get("descripcion_tab", "")).lower()
+    return any(keyword in texto for keyword in PUNO_KEYWORDS)
+
+
+def destinos_de_tour(tour):
+    """Destinos a los que pertenece un tour (puede ser más de uno)."""
+    texto = (tour.get("titulo_producto", "") + " " + tour.get("tipo_servicio", "")).lower()
+    return [destino for destino, palabras in DESTINOS.items() if any(p in texto for p in palabras)]
+
+
+def formatear_precios(tramos, language='es'):
+    if not tramos:
+        return PRECIO_A_CONSULTAR.get(language, PRECIO_A_CONSULTAR['es'])
+    formato = FORMATO_PRECIO.get(language, FORMATO_PRECIO['es'])
+    return " | ".join(formato.format(d=d, h=h, p=p) for d, h, p in tramos)
+
+
+def precalcular_resumenes(tours):
+    """
+    Precalcula un resumen por tour, indexado por id() del dict del tour.
+
+    Los dicts de tours viven durante toda la vida del proceso, así que su id()
+    es estable y permite ir de un resultado de búsqueda a su resumen en O(1).
+    """
+    resumenes = {}
+    for tour in tours:
+        tramos = parsear_precios(tour)
+        resumenes[id(tour)] = {
+            "titulo": tour.get("titulo_producto", ""),
+            "url": tour.get("url_servicio", ""),
+            "prioridad": tour.get("prioridad", 5),
+            "es_puno": es_tour_puno(tour),
+            "tramos": tramos,
+            "precios_texto": {lang: formatear_precios(tramos, lang) for lang in FORMATO_PRECIO},
+        }
+    return resumenes
+
+
+def obtener_resumen(resumenes, tour):
+    """Resumen precalculado del tour (o calculado al vuelo si no está indexado)."""
+    resumen = resumenes.get(id(tour))
+    if resumen is None:
+        resumen = precalcular_resumenes([tour])[id(tour)]
+    return resumen
+
+
+# === Formato binario compacto del catálogo (mmap, sin copias) ===
+#
+# Cabecera | prioridad int32[n] | inicio_tramos uint32[n+1] | desde uint32[t] |
+# hasta uint32[t] | precio float64[t] | offsets uint32[n*F*2] | blob UTF-8
+#
+# Los campos de texto de cada tour son pares (offset, longitud) dentro de un
+# único blob UTF-8; longitud CAMPO_AUSENTE indica que el tour no tiene ese campo.
+
+MAGIC = b'ILCATv1\x00'
+CABECERA = struct.Struct('<8sIIIIQd')  # magic, n_tours, n_tramos, n_campos, long_nombres, tamaño_fuente, mtime_fuente
+CAMPO_AUSENTE = 0xFFFFFFFF
+CAMPO_NUMERICO = 'prioridad'
+
+
+def _alinear(n, a=8):
+    return (n + a - 1) // a * a
+
+
+def tramos_numericos(tour):
+    """Tramos de precio como (desde, hasta, precio) numéricos; [] si no se pueden parsear."""
+    try:
+        return [(int(d), int(h), float(p)) for d, h, p in parsear_precios(tour)]
+    except (TypeError, ValueError):
+        return []
+
+
+def compilar_catalogo(tours, ruta_salida, ruta_fuente=None):
+    """Compila una lista de tours al formato binario. Devuelve el tamaño en bytes."""
+    campos = sorted({clave for tour in tours for clave in tour if clave != CAMPO_NUMERICO})
+    for tour in tours:
+        for clave in campos:
+            if clave in tour and not isinstance(tour[clave], str):
+                raise ValueError(f"Campo no soportado en el formato binario: {clave} ({type(tour[clave]).__name__})")
+
+    prioridades = array('i', (int(tour.get(CAMPO_NUMERICO, 5)) for tour in tours))
+    inicio_tramos = array('I', [0])
+    desde, hasta, precio = array('I'), array('I'), array('d')
+    for tour in tours:
+        for d, h, p in tramos_numericos(tour):
+            desde.append(d)
+            hasta.append(h)
+            precio.append(p)
+        inicio_tramos.append(len(precio))
+
+    blob = bytearray()
+    offsets = array('I')
+    for tour in tours:
+        for clave in campos:
+            if clave in tour:
+                datos = tour[clave].encode('utf-8')
+                offsets.extend((len(blob), len(datos)))
+                blob.extend(datos)
+            else:
+                offsets.extend((0, CAMPO_AUSENTE))
+
+    nombres = json.dumps(campos).encode('utf-8')
+    tamano_fuente, mtime_fuente = 0, 0.0
+    if ruta_fuente and os.path.exists(ruta_fuente):
+        estado = os.stat(ruta_fuente)
+        tamano_fuente, mtime_fuente = estado.st_size, estado.st_mtime
+
+    secciones = [prioridades, inicio_tramos, desde, hasta, precio, offsets]
+    ruta_tmp = f"{ruta_salida}.tmp"
+    with open(ruta_tmp, 'wb') as f:
+        f.write(CABECERA.pack(MAGIC, len(tours), len(precio), len(campos), len(nombres), tamano_fuente, mtime_fuente))
+        f.write(nombres)
+        for seccion in secciones:
+            f.write(b'\0' * (_alinear(f.tell()) - f.tell()))
+            f.write(seccion.tobytes())
+        f.write(blob)
+        tamano = f.tell()
+    os.replace(ruta_tmp, ruta_salida)
+    return tamano
+
+
+class TourRegistro(Mapping):
+    """Vista de solo lectura de un tour dentro del catálogo binario (se decodifica al acceder)."""
+
+    __slots__ = ('_catalogo', '_indice')
+
+    def __init__(self, catalogo, indice):
+        self._catalogo = catalogo
+        self._indice = indice
+
+    def __getitem__(self, clave):
+        return self._catalogo.campo(self._indice, clave)
+
+    def __iter__(self):
+        return iter(self._catalogo.claves(self._indice))
+
+    def __len__(self):
+        return len(self._catalogo.claves(self._indice))
+
+    def __repr__(self):
+        return f"TourRegistro({self._indice}, {self.get('titulo_producto', '')!r})"
+
+
+class CatalogoBinario(Sequence):
+    """
+    Catálogo de tours respaldado por un archivo mapeado en memoria.
+
+    Todos los workers que abren el mismo archivo comparten sus páginas (page
+    cache); solo se materializan los strings que realmente se leen.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._archivo = open(ruta, 'rb')
+        self._mmap = mmap.mmap(self._archivo.fileno(), 0, access=mmap.ACCESS_READ)
+        vista = memoryview(self._mmap)
+
+        magic, n, t, n_campos, long_nombres, self.tamano_fuente, self.mtime_fuente = CABECERA.unpack_from(vista, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{ruta} no es un catálogo binario válido")
+        pos = CABECERA.size
+        self.campos = json.loads(str(vista[pos:pos + long_nombres], 'utf-8'))
+        self._indice_campo = {clave: i for i, clave in enumerate(self.campos)}
+        pos += long_nombres
+
+        def seccion(formato, cantidad, tamano_item):
+            nonlocal pos
+            pos = _alinear(pos)
+            inicio, pos = pos, pos + cantidad * tamano_item
+            return vista[inicio:pos].cast(formato)
+
+        self.prioridades = seccion('i', n, 4)
+        self.inicio_tramos = seccion('I', n + 1, 4)
+        self.desde = seccion('I', t, 4)
+        self.hasta = seccion('I', t, 4)
+        self.precio = seccion('d', t, 8)
+        self._offsets = seccion('I', n * n_campos * 2, 4)
+        self._blob = vista[pos:]
+        self._n = n
+        # Un registro por tour, creado bajo demanda y reutilizado (id() estable)
+        self._registros = [None] * n
+
+    def esta_al_dia(self, ruta_fuente):
+        """True si el JSON de origen no cambió desde que se compiló el binario."""
+        if not os.path.exists(ruta_fuente):
+            return True
+        estado = os.stat(ruta_fuente)
+        return estado.st_size == self.tamano_fuente and estado.st_mtime == self.mtime_fuente
+
+    def campo(self, indice, clave):
+        if clave == CAMPO_NUMERICO:
+            return self.prioridades[indice]
+        i = self._indice_campo.get(clave)
+        if i is None:
+            raise KeyError(clave)
+        base = (indice * len(self.campos) + i) * 2
+        offset, longitud = self._offsets[base], self._offsets[base + 1]
+        if longitud == CAMPO_AUSENTE:
+            raise KeyError(clave)
+        return str(self._blob[offset:offset + longitud], 'utf-8')
+
+    def claves(self, indice):
+        base = indice * len(self.campos) * 2
+        presentes = [
+            clave for i, clave in enumerate(self.campos)
+            if self._offsets[base + i * 2 + 1] != CAMPO_AUSENTE
+        ]
+        return presentes + [CAMPO_NUMERICO]
+
+    def tramos(self, indice):
+        """Tramos numéricos (desde, hasta, precio) del tour, leídos de las columnas fijas."""
+        return [
+            (self.desde[j], self.hasta[j], self.precio[j])
+            for j in range(self.inicio_tramos[indice], self.inicio_tramos[indice + 1])
+        ]
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, indice):
+        if isinstance(indice, slice):
+            return [self[i] for i in range(*indice.indices(self._n))]
+        if indice < 0:
+            indice += self._n
+        if not 0 <= indice < self._n:
+            raise IndexError(indice)
+        registro = self._registros[indice]
+        if registro is None:
+            registro = self._registros[indice] = TourRegistro(self, indice)
+        return registro
+
+
+# === Índice para la API de catálogo ===
+def huella_catalogo(tours):
+    """Versión del catálogo: hash del contenido, estable entre workers y reinicios."""
+    h = hashlib.blake2b(digest_size=8)
+    if isinstance(tours, CatalogoBinario):
+        # Todo menos la cabecera, que guarda el mtime del JSON de origen
+        h.update(memoryview(tours._mmap)[CABECERA.size:])
+    else:
+        h.update(json.dumps(tours, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return h.hexdigest()
+
+
+class IndiceCatalogo:
+    """
+    Registros públicos de los tours y conteos por destino, calculados al cargar.
+
+    El id de un tour es su posición en el catálogo (url_servicio no es única).
+    `version` cambia solo si cambia el contenido y sirve de ETag fuerte.
+    """
+
+    CAMPOS_DETALLE = {
+        'descripcion_tab': 'description',
+        'itinerario_ta': 'itinerary',
+        'incluye_tab': 'includes',
+    }
+
+    def __init__(self, tours, resumenes):
+        self.tours = tours
+        self.version = huella_catalogo(tours)
+        self.registros = []
+        self.por_destino = {destino: [] for destino in DESTINOS}
+        # id() del dict del tour -> posición (los dicts viven todo el proceso)
+        self.posicion = {}
+        for indice, tour in enumerate(tours):
+            self.posicion[id(tour)] = indice
+            resumen = obtener_resumen(resumenes, tour)
+            tramos = tramos_numericos(tour)
+            destinos = destinos_de_tour(tour)
+            self.registros.append({
+                'id': indice,
+                'title': resumen['titulo'],
+                'url': resumen['url'],
+                'priority': resumen['prioridad'],
+                'destinations': destinos,
+                'is_puno_specialty': resumen['es_puno'],
+                'prices': [{'from': d, 'to': h, 'price_usd': p} for d, h, p in tramos],
+                'price_from_usd': min((p for _, _, p in tramos), default=None),
+            })
+            for destino in destinos:
+                self.por_destino[destino].append(indice)
+        # Orden de listado: prioridad (1 = máxima) y luego posición en el catálogo
+        self.orden = sorted(range(len(self.registros)), key=lambda i: (self.registros[i]['priority'], i))
+        self.destinos = [
+            {'destination': destino, 'tour_count': len(self.por_destino[destino])}
+            for destino in sorted(self.por_destino) if self.por_destino[destino]
+        ]
+
+    def contar(self, destino):
+        return len(self.por_destino.get(destino.capitalize(), []))
+
+    def listar(self, destino=None):
+        """Registros en orden de listado, opcionalmente filtrados por destino."""
+        if destino is None:
+            return [self.registros[i] for i in self.orden]
+        miembros = set(self.por_destino.get(destino.capitalize(), []))
+        return [self.registros[i] for i in self.orden if i in miembros]
+
+    def detalle(self, indice):
+        """Registro con los textos completos del tour, o None si el id no existe."""
+        if not 0 <= indice < len(self.registros):
+            return None
+        tour = self.tours[indice]
+        detalle = dict(self.registros[indice])
+        for campo, nombre in self.CAMPOS_DETALLE.items():
+            detalle[nombre] = tour.get(campo, "")
+        return detalle
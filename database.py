@@ -1,9 +1,12 @@
 import os
 import logging
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import mysql.connector
-from mysql.connector import pooling, errorcode
+from storage import crear_almacen, ErrorBD
+import migrations
+from stats import RollupsEstadisticas, IDIOMA_TODOS
+from replicas import EnrutadorLecturas, parsear_hosts, DB_REPLICA_HOSTS
 
 # Cargar .env
 load_dotenv()
@@ -14,39 +17,29 @@ logger = logging.getLogger(__name__)
 
 class DatabaseManager:
     def __init__(self):
+        # El pool se crea en la primera conexión: así no se hereda a través de fork()
+        # cuando gunicorn precarga la app en el proceso master
         self.connection_pool = None
-        self.create_connection_pool()
+        self._pool_lock = threading.Lock()
+        # Motor de almacenamiento (DB_ENGINE): MySQL o SQLite embebido
+        self.almacen = crear_almacen()
+        # Columnas de mensajes_chatbot, leídas una vez (el esquema solo cambia al migrar)
+        self._columnas_mensajes = None
+        self.rollups = RollupsEstadisticas()
+        # Réplicas de lectura opcionales (DB_REPLICA_HOSTS); sin ellas todo va al primario
+        hosts_replicas = parsear_hosts(DB_REPLICA_HOSTS) if self.almacen.admite_replicas else []
+        self.enrutador = EnrutadorLecturas(hosts_replicas, opciones={
+            'user': os.getenv("DB_REPLICA_USER", os.getenv("DB_USER")),
+            'password': os.getenv("DB_REPLICA_PASSWORD", os.getenv("DB_PASSWORD")),
+            'database': os.getenv("DB_NAME"),
+            'autocommit': True,
+            'ssl_disabled': False,
+        })
 
     def create_connection_pool(self):
         try:
-            # Opciones de SSL - Intenta verificar el certificado del servidor
-            ssl_config = {
-                'ssl_disabled': False,
-                # 'ssl_verify_cert': True, # Puedes activar esto si tienes problemas de certificado
-                # 'ssl_verify_identity': True, # Puedes activar esto si tienes problemas de certificado
-                # 'ssl_ca': '/path/to/ca-cert.pem', # Si necesitas un certificado CA específico
-            }
-
-            self.connection_pool = pooling.MySQLConnectionPool(
-                pool_name="incalake_pool",
-                pool_size=5,
-                host=os.getenv("DB_HOST"),
-                user=os.getenv("DB_USER"),
-                password=os.getenv("DB_PASSWORD"),
-                database=os.getenv("DB_NAME"),
-                port=int(os.getenv("DB_PORT", 3306)),
-                autocommit=True,
-                # ssl_disabled=True, # <-- ELIMINA esta línea
-                **ssl_config # <-- AÑADE esta línea
-            )
-            logger.info("✅ Pool de conexiones MySQL creado")
-        except mysql.connector.Error as err:
-            if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-                logger.error("❌ Error de autenticación con MySQL")
-            elif err.errno == errorcode.ER_BAD_DB_ERROR:
-                logger.error("❌ La base de datos no existe")
-            else:
-                logger.error(f"❌ Error de conexión a MySQL: {err}")
+            self.connection_pool = self.almacen.crear_pool()
+        except ErrorBD:
             raise
         except Exception as e:
             logger.error(f"❌ Error inesperado: {str(e)}")
@@ -54,11 +47,53 @@ class DatabaseManager:
 
     def get_connection(self):
         try:
+            if self.connection_pool is None:
+                with self._pool_lock:
+                    if self.connection_pool is None:
+                        self.create_connection_pool()
             return self.connection_pool.get_connection()
         except Exception as e:
             logger.error(f"❌ Error obteniendo conexión: {str(e)}")
             raise
 
+    def get_read_connection(self, session_id=None):
+        """
+        Conexión para una lectura: una réplica sana si hay, salvo que la sesión
+        acabe de escribir (read-your-writes). Si no, el primario.
+        """
+        replica, motivo = self.enrutador.elegir(session_id)
+        if replica is not None:
+            try:
+                conn = replica.get_connection()
+                self.enrutador.registrar('replica', replica.nombre)
+                return conn
+            except Exception as e:
+                self.enrutador.descartar(replica, e)
+                motivo = 'replica_error'
+        self.enrutador.registrar('primary', motivo)
+        return self.get_connection()
+
+    def metricas_enrutado(self):
+        return {'engine': self.almacen.nombre, **self.enrutador.metricas()}
+
+    def cerrar_pool(self):
+        """Cierra las conexiones libres del pool (p. ej. en el master antes de hacer fork)."""
+        with self._pool_lock:
+            pool = self.connection_pool
+            self.connection_pool = None
+        if pool is not None:
+            try:
+                pool._remove_connections()
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo cerrar el pool: {str(e)}")
+        self.enrutador.cerrar()
+
+    def reiniciar_tras_fork(self):
+        """Descarta (sin cerrar) un pool heredado del proceso padre; el hijo crea el suyo."""
+        self._pool_lock = threading.Lock()
+        self.connection_pool = None
+        self.enrutador.reiniciar_tras_fork()
+
     def release_connection(self, connection):
         try:
             connection.close()
@@ -66,96 +101,37 @@ class DatabaseManager:
             logger.error(f"❌ Error liberando conexión: {str(e)}")
 
     def verificar_y_migrar_esquema(self):
-        """Verifica y migra el esquema existente para agregar columnas faltantes."""
+        """
+        Pone el esquema al día con las migraciones versionadas (migrations.py).
+        
+        Si la versión ya es la última, el arranque cuesta una sola consulta.
+        Si no, un único proceso migra bajo el lock de migraciones; los demás
+        esperan y encuentran el trabajo hecho.
+        """
         conn = None
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            # Verificar y agregar columna session_id a usuarios_chatbot si no existe
-            cursor.execute("""
-                SELECT COUNT(*) 
-                FROM information_schema.columns 
-                WHERE table_schema = %s 
-                AND table_name = 'usuarios_chatbot' 
-                AND column_name = 'session_id'
-            """, (os.getenv("DB_NAME"),))
-            
-            if cursor.fetchone()[0] == 0:
-                logger.info("📝 Agregando columna 'session_id' a usuarios_chatbot...")
-                cursor.execute("""
-                    ALTER TABLE usuarios_chatbot 
-                    ADD COLUMN session_id VARCHAR(255) UNIQUE
-                """)
-                logger.info("✅ Columna 'session_id' agregada")
-            
-            # Verificar y agregar columna ultimo_acceso si no existe
-            cursor.execute("""
-                SELECT COUNT(*) 
-                FROM information_schema.columns 
-                WHERE table_schema = %s 
-                AND table_name = 'usuarios_chatbot' 
-                AND column_name = 'ultimo_acceso'
-            """, (os.getenv("DB_NAME"),))
-            
-            if cursor.fetchone()[0] == 0:
-                logger.info("📝 Agregando columna 'ultimo_acceso' a usuarios_chatbot...")
-                cursor.execute("""
-                    ALTER TABLE usuarios_chatbot 
-                    ADD COLUMN ultimo_acceso TIMESTAMP NULL
-                """)
-                logger.info("✅ Columna 'ultimo_acceso' agregada")
-            
-            # Verificar y agregar columnas faltantes a mensajes_chatbot
-            cursor.execute("""
-                SELECT COUNT(*) 
-                FROM information_schema.columns 
-                WHERE table_schema = %s 
-                AND table_name = 'mensajes_chatbot' 
-                AND column_name = 'session_id'
-            """, (os.getenv("DB_NAME"),))
-            
-            if cursor.fetchone()[0] == 0:
-                logger.info("📝 Agregando columna 'session_id' a mensajes_chatbot...")
-                cursor.execute("""
-                    ALTER TABLE mensajes_chatbot 
-                    ADD COLUMN session_id VARCHAR(255) NOT NULL DEFAULT ''
-                """)
-                logger.info("✅ Columna 'session_id' agregada a mensajes_chatbot")
-            
-            cursor.execute("""
-                SELECT COUNT(*) 
-                FROM information_schema.columns 
-                WHERE table_schema = %s 
-                AND table_name = 'mensajes_chatbot' 
-                AND column_name = 'rol'
-            """, (os.getenv("DB_NAME"),))
-            
-            if cursor.fetchone()[0] == 0:
-                logger.info("📝 Agregando columna 'rol' a mensajes_chatbot...")
-                cursor.execute("""
-                    ALTER TABLE mensajes_chatbot 
-                    ADD COLUMN rol ENUM('user', 'model') NOT NULL DEFAULT 'user'
-                """)
-                logger.info("✅ Columna 'rol' agregada a mensajes_chatbot")
+            version = migrations.version_actual(cursor)
+            if version >= migrations.VERSION_ESQUEMA:
+                if version > migrations.VERSION_ESQUEMA:
+                    logger.warning(f"⚠️ El esquema (v{version}) es más nuevo que este código "
+                                   f"(v{migrations.VERSION_ESQUEMA})")
+                logger.info(f"✅ Esquema en la versión {version}")
+                return
+            
+            logger.info(f"🔒 Esquema en la versión {version}, esperando el lock de migraciones...")
+            with self.almacen.bloqueo_migraciones(cursor, migrations.DB_MIGRATION_LOCK_TIMEOUT):
+                aplicadas = migrations.migrar(cursor, self.almacen)
+            if aplicadas:
+                logger.info(f"✅ Migraciones aplicadas: {aplicadas}")
+            else:
+                logger.info("✅ Otro proceso ya migró el esquema")
             
-            cursor.execute("""
-                SELECT COUNT(*) 
-                FROM information_schema.columns 
-                WHERE table_schema = %s 
-                AND table_name = 'mensajes_chatbot' 
-                AND column_name = 'contenido'
-            """, (os.getenv("DB_NAME"),))
-            
-            if cursor.fetchone()[0] == 0:
-                logger.info("📝 Agregando columna 'contenido' a mensajes_chatbot...")
-                cursor.execute("""
-                    ALTER TABLE mensajes_chatbot 
-                    ADD COLUMN contenido TEXT
-                """)
-                logger.info("✅ Columna 'contenido' agregada a mensajes_chatbot")
+            self._columnas_mensajes = None
                 
-        except mysql.connector.Error as err:
+        except ErrorBD as err:
             logger.error(f"❌ Error en migración de esquema: {err}")
             raise
         finally:
@@ -197,7 +173,7 @@ class DatabaseManager:
                 usuario['whatsapp'] = usuario.get('telefono', '')  # telefono -> whatsapp
                 
             return usuario
-        except mysql.connector.Error as err:
+        except ErrorBD as err:
             logger.error(f"❌ Error al obtener usuario por correo: {err}")
             return None
         finally:
@@ -223,17 +199,32 @@ class DatabaseManager:
                         "UPDATE usuarios_chatbot SET ultimo_acceso = NOW() WHERE id = %s", 
                         (usuario['id'],)
                     )
-                except mysql.connector.Error:
+                except ErrorBD:
                     pass  # Ignorar si la columna ultimo_acceso no existe aún
                 
             return usuario
-        except mysql.connector.Error as err:
+        except ErrorBD as err:
             logger.error(f"❌ Error al obtener usuario por session: {err}")
             return None
         finally:
             if conn:
                 self.release_connection(conn)
 
+    def registrar_acceso(self, usuario_id):
+        """Actualiza ultimo_acceso sin leer el usuario (sesiones servidas desde la caché)."""
+        conn = None
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute("UPDATE usuarios_chatbot SET ultimo_acceso = NOW() WHERE id = %s", (usuario_id,))
+            return True
+        except ErrorBD as err:
+            logger.warning(f"⚠️ No se pudo actualizar ultimo_acceso del usuario {usuario_id}: {err}")
+            return False
+        finally:
+            if conn:
+                self.release_connection(conn)
+
     def crear_usuario(self, nombre, correo, whatsapp, session_id):
         """Crea un nuevo usuario adaptado al esquema actual."""
         conn = None
@@ -247,8 +238,9 @@ class DatabaseManager:
                 VALUES (%s, %s, %s, %s, NOW())
             """, (nombre, correo, whatsapp, session_id))
             
+            self.enrutador.marcar_escritura(session_id)
             return cursor.lastrowid
-        except mysql.connector.Error as err:
+        except ErrorBD as err:
             logger.error(f"❌ Error al crear usuario: {err}")
             return None
         finally:
@@ -294,8 +286,9 @@ class DatabaseManager:
             query += " WHERE id = %s"
             
             cursor.execute(query, params)
+            self.enrutador.marcar_escritura(session_id)
             return cursor.rowcount > 0
-        except mysql.connector.Error as err:
+        except ErrorBD as err:
             logger.error(f"❌ Error al actualizar usuario: {err}")
             return False
         finally:
@@ -310,7 +303,7 @@ class DatabaseManager:
         """Obtiene historial adaptado al esquema actual."""
         conn = None
         try:
-            conn = self.get_connection()
+            conn = self.get_read_connection(session_id)
             cursor = conn.cursor()  # NO usar dictionary=True para DESCRIBE
             
             # Verificar qué columnas existen
@@ -332,7 +325,17 @@ class DatabaseManager:
                     ORDER BY fecha ASC
                 """
                 if limite:
-                    query += f" LIMIT {limite}"
+                    # Los `limite` mensajes más recientes, en orden cronológico
+                    query = f"""
+                        SELECT rol, contenido, fecha FROM (
+                            SELECT id, rol, contenido, fecha 
+                            FROM mensajes_chatbot 
+                            WHERE session_id = %s 
+                            ORDER BY id DESC 
+                            LIMIT {int(limite)}
+                        ) recientes 
+                        ORDER BY id ASC
+                    """
                 
                 cursor.execute(query, (session_id,))
                 mensajes = cursor.fetchall()
@@ -353,7 +356,19 @@ class DatabaseManager:
                     ORDER BY fecha ASC
                 """
                 if limite:
-                    query += f" LIMIT {limite//2}"  # Dividir por 2 porque cada fila son 2 mensajes
+                    # Dividir por 2 porque cada fila son 2 mensajes; las más recientes
+                    query = f"""
+                        SELECT mensaje_usuario, respuesta_bot, fecha FROM (
+                            SELECT id, mensaje_usuario, respuesta_bot, fecha 
+                            FROM mensajes_chatbot 
+                            WHERE usuario_id IN (
+                                SELECT id FROM usuarios_chatbot WHERE session_id = %s
+                            )
+                            ORDER BY id DESC 
+                            LIMIT {int(limite) // 2}
+                        ) recientes 
+                        ORDER BY id ASC
+                    """
                 
                 cursor.execute(query, (session_id,))
                 mensajes = cursor.fetchall()
@@ -371,13 +386,207 @@ class DatabaseManager:
                         })
             
             return historial_gemini
-        except mysql.connector.Error as err:
+        except ErrorBD as err:
             logger.error(f"❌ Error al obtener historial: {err}")
             return []
         finally:
             if conn:
                 self.release_connection(conn)
 
+    def _columnas_historial(self, conn):
+        """Columnas de mensajes_chatbot (DESCRIBE solo la primera vez)."""
+        if self._columnas_mensajes is None:
+            cursor = conn.cursor()
+            cursor.execute("DESCRIBE mensajes_chatbot")
+            self._columnas_mensajes = [row[0] for row in cursor.fetchall()]
+        return self._columnas_mensajes
+
+    def estado_historial(self, session_id):
+        """
+        (primer_id, ultimo_id, total) de los mensajes de una sesión, sin leer su contenido.
+        
+        Cambia con cada mensaje nuevo o al limpiar la sesión: sirve como ETag.
+        Devuelve None si falla la consulta.
+        """
+        conn = None
+        try:
+            conn = self.get_read_connection(session_id)
+            columnas = self._columnas_historial(conn)
+            cursor = conn.cursor()
+            
+            if 'rol' in columnas and 'contenido' in columnas:
+                cursor.execute("""
+                    SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0), COUNT(*) 
+                    FROM mensajes_chatbot 
+                    WHERE session_id = %s
+                """, (session_id,))
+            else:
+                cursor.execute("""
+                    SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0), COUNT(*) 
+                    FROM mensajes_chatbot 
+                    WHERE usuario_id IN (
+                        SELECT id FROM usuarios_chatbot WHERE session_id = %s
+                    )
+                """, (session_id,))
+            primer_id, ultimo_id, total = cursor.fetchone()
+            return int(primer_id), int(ultimo_id), int(total)
+        except ErrorBD as err:
+            logger.error(f"❌ Error al obtener estado del historial: {err}")
+            return None
+        finally:
+            if conn:
+                self.release_connection(conn)
+
+    def obtener_pagina_historial(self, session_id, desde_id=None, antes_de_id=None, limite=50):
+        """
+        Página del historial paginada por id (keyset, nunca OFFSET).
+        
+        - desde_id: mensajes con id > desde_id, los más antiguos primero (incremental)
+        - antes_de_id: los `limite` mensajes anteriores a ese id (hacia atrás)
+        - ninguno: los `limite` mensajes más recientes
+        
+        Devuelve (mensajes, hay_mas) con mensajes [{'id', 'role', 'parts'}] en orden
+        cronológico. hay_mas indica que quedan filas en la dirección pedida.
+        En el esquema original cada fila son 2 mensajes con el mismo id y el
+        límite se aplica a filas.
+        """
+        conn = None
+        try:
+            conn = self.get_read_connection(session_id)
+            columnas = self._columnas_historial(conn)
+            cursor = conn.cursor(dictionary=True)
+            
+            if 'rol' in columnas and 'contenido' in columnas:
+                campos = "id, rol, contenido"
+                filtro = "session_id = %s"
+            else:
+                campos = "id, mensaje_usuario, respuesta_bot"
+                filtro = "usuario_id IN (SELECT id FROM usuarios_chatbot WHERE session_id = %s)"
+            
+            parametros = [session_id]
+            if desde_id is not None:
+                filtro += " AND id > %s"
+                parametros.append(desde_id)
+                orden = "ASC"
+            else:
+                if antes_de_id is not None:
+                    filtro += " AND id < %s"
+                    parametros.append(antes_de_id)
+                orden = "DESC"
+            parametros.append(limite + 1)  # una fila extra para saber si hay más
+            
+            cursor.execute(f"""
+                SELECT {campos} 
+                FROM mensajes_chatbot 
+                WHERE {filtro} 
+                ORDER BY id {orden} 
+                LIMIT %s
+            """, tuple(parametros))
+            filas = cursor.fetchall()
+            
+            hay_mas = len(filas) > limite
+            filas = filas[:limite]
+            if orden == "DESC":
+                filas.reverse()
+            
+            mensajes = []
+            for fila in filas:
+                if 'rol' in fila:
+                    mensajes.append({'id': fila['id'], 'role': fila['rol'], 'parts': [fila['contenido']]})
+                    continue
+                if fila['mensaje_usuario']:
+                    mensajes.append({'id': fila['id'], 'role': 'user', 'parts': [fila['mensaje_usuario']]})
+                if fila['respuesta_bot']:
+                    mensajes.append({'id': fila['id'], 'role': 'model', 'parts': [fila['respuesta_bot']]})
+            return mensajes, hay_mas
+        except ErrorBD as err:
+            logger.error(f"❌ Error al obtener página del historial: {err}")
+            return [], False
+        finally:
+            if conn:
+                self.release_connection(conn)
+
+    def exportar_filas(self, tipo, desde=None, hasta=None, despues_de_id=0, lote=1000):
+        """
+        Recorre usuarios ('leads') o mensajes ('messages') en orden de id, por lotes.
+        
+        Paginación keyset (id > último id leído, nunca OFFSET): cada lote cuesta
+        lo mismo aunque la tabla tenga millones de filas, y cada uno usa su propia
+        conexión del pool, así que una exportación lenta no retiene una conexión
+        mientras el cliente descarga. desde/hasta filtran por fecha (hasta es
+        exclusivo). Genera dicts; los errores se propagan (no se trunca en silencio).
+        """
+        if tipo == 'leads':
+            consulta = """
+                SELECT u.id, u.nombre, u.correo, u.telefono AS whatsapp, u.session_id,
+                       u.fecha_registro, u.ultimo_acceso,
+                       (SELECT COUNT(*) FROM mensajes_chatbot m WHERE m.usuario_id = u.id) AS mensajes,
+                       (SELECT MAX(m.fecha) FROM mensajes_chatbot m WHERE m.usuario_id = u.id) AS ultimo_mensaje
+                FROM usuarios_chatbot u
+                WHERE u.id > %s {filtro}
+                ORDER BY u.id
+                LIMIT %s
+            """
+            columna_fecha = "u.fecha_registro"
+        else:
+            conn = self.get_read_connection()
+            try:
+                columnas = self._columnas_historial(conn)
+            finally:
+                self.release_connection(conn)
+            esquema_nuevo = 'rol' in columnas and 'contenido' in columnas
+            campos = ("m.session_id, m.rol, m.contenido" if esquema_nuevo
+                      else "u.session_id, m.mensaje_usuario, m.respuesta_bot")
+            if 'idioma' in columnas:
+                campos += ", m.idioma"
+            consulta = f"""
+                SELECT m.id, {campos}, m.usuario_id, u.nombre, u.correo,
+                       u.telefono AS whatsapp, m.fecha
+                FROM mensajes_chatbot m
+                LEFT JOIN usuarios_chatbot u ON u.id = m.usuario_id
+                WHERE m.id > %s {{filtro}}
+                ORDER BY m.id
+                LIMIT %s
+            """
+            columna_fecha = "m.fecha"
+        
+        filtro, parametros_fecha = "", []
+        if desde is not None:
+            filtro += f" AND {columna_fecha} >= %s"
+            parametros_fecha.append(desde)
+        if hasta is not None:
+            filtro += f" AND {columna_fecha} < %s"
+            parametros_fecha.append(hasta)
+        consulta = consulta.format(filtro=filtro)
+        
+        ultimo_id = despues_de_id or 0
+        while True:
+            conn = self.get_read_connection()
+            try:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute(consulta, (ultimo_id, *parametros_fecha, lote))
+                filas = cursor.fetchall()
+            except ErrorBD as err:
+                logger.error(f"❌ Error exportando {tipo} después del id {ultimo_id}: {err}")
+                raise
+            finally:
+                self.release_connection(conn)
+            
+            for fila in filas:
+                if tipo == 'leads' or 'rol' in fila:
+                    yield fila
+                    continue
+                # Esquema original: cada fila son 2 mensajes con el mismo id
+                base = {k: v for k, v in fila.items() if k not in ('mensaje_usuario', 'respuesta_bot')}
+                if fila['mensaje_usuario']:
+                    yield {**base, 'rol': 'user', 'contenido': fila['mensaje_usuario']}
+                if fila['respuesta_bot']:
+                    yield {**base, 'rol': 'model', 'contenido': fila['respuesta_bot']}
+            
+            if len(filas) < lote:
+                return
+            ultimo_id = filas[-1]['id']
+
     def guardar_mensaje(self, session_id, usuario_id, rol, contenido):
         """Guarda un mensaje individual (esquema nuevo)."""
         conn = None
@@ -395,20 +604,28 @@ class DatabaseManager:
                     INSERT INTO mensajes_chatbot (session_id, usuario_id, rol, contenido, fecha)
                     VALUES (%s, %s, %s, %s, NOW())
                 """, (session_id, usuario_id, rol, contenido))
+                self.enrutador.marcar_escritura(session_id)
                 return True
             else:
                 logger.warning("⚠️ Esquema antiguo detectado, usa guardar_mensajes_transaccionales")
                 return False
                 
-        except mysql.connector.Error as err:
+        except ErrorBD as err:
             logger.error(f"❌ Error al guardar mensaje: {err}")
             return False
         finally:
             if conn:
                 self.release_connection(conn)
 
-    def guardar_mensajes_transaccionales(self, session_id, usuario_id, pregunta, respuesta):
-        """Guarda pregunta y respuesta adaptado al esquema actual."""
+    def guardar_mensajes_transaccionales(self, session_id, usuario_id, pregunta, respuesta, idioma=None,
+                                         turno_id=None, fecha=None):
+        """
+        Guarda pregunta y respuesta adaptado al esquema actual, y actualiza las estadísticas.
+
+        Con turno_id (turnos que llegan del spool) la inserción es idempotente:
+        si el turno ya estaba guardado no se duplica ni se vuelve a contar.
+        fecha conserva el momento del turno en lugar de NOW().
+        """
         conn = None
         try:
             conn = self.get_connection()
@@ -422,26 +639,49 @@ class DatabaseManager:
             conn.start_transaction()
             
             if 'rol' in columnas and 'contenido' in columnas:
-                # Usar esquema nuevo
-                cursor.execute("""
-                    INSERT INTO mensajes_chatbot (session_id, usuario_id, rol, contenido, fecha)
-                    VALUES (%s, %s, 'user', %s, NOW())
-                """, (session_id, usuario_id, pregunta))
-                
-                cursor.execute("""
-                    INSERT INTO mensajes_chatbot (session_id, usuario_id, rol, contenido, fecha)
-                    VALUES (%s, %s, 'model', %s, NOW())
-                """, (session_id, usuario_id, respuesta))
+                # Usar esquema nuevo (con idioma y turno_id si ya se migraron las columnas)
+                nombres = ['session_id', 'usuario_id', 'rol', 'contenido']
+                extra = []
+                if 'idioma' in columnas:
+                    nombres.append('idioma')
+                    extra.append(idioma)
+                idempotente = turno_id is not None and 'turno_id' in columnas
+                if idempotente:
+                    nombres.append('turno_id')
+                    extra.append(turno_id)
+                nombres.append('fecha')
+                fila = "(%s, %s, %s, %s" + ", %s" * len(extra) + ", COALESCE(%s, NOW()))"
+                cursor.execute(f"""
+                    INSERT {'IGNORE ' if idempotente else ''}INTO mensajes_chatbot ({', '.join(nombres)})
+                    VALUES {fila}, {fila}
+                """, (session_id, usuario_id, 'user', pregunta, *extra, fecha,
+                      session_id, usuario_id, 'model', respuesta, *extra, fecha))
+                if idempotente and cursor.rowcount == 0:
+                    # Ya guardado en una reproducción anterior del spool
+                    conn.commit()
+                    return True
             else:
                 # Usar esquema original
                 cursor.execute("""
                     INSERT INTO mensajes_chatbot (usuario_id, mensaje_usuario, respuesta_bot, fecha)
-                    VALUES (%s, %s, %s, NOW())
-                """, (usuario_id, pregunta, respuesta))
+                    VALUES (%s, %s, %s, COALESCE(%s, NOW()))
+                """, (usuario_id, pregunta, respuesta, fecha))
+            
+            # Rollups en la misma transacción; si fallan, el turno se guarda igual
+            vistos = []
+            cursor.execute("SAVEPOINT rollups")
+            try:
+                vistos = self.rollups.registrar_turno(cursor, session_id, usuario_id, idioma, momento=fecha)
+            except ErrorBD as err:
+                logger.warning(f"⚠️ No se actualizaron las estadísticas (ejecuta backfill_stats.py): {err}")
+                cursor.execute("ROLLBACK TO SAVEPOINT rollups")
+                vistos = []
             
             conn.commit()
+            self.rollups.confirmar(vistos)
+            self.enrutador.marcar_escritura(session_id)
             return True
-        except mysql.connector.Error as err:
+        except ErrorBD as err:
             logger.error(f"❌ Error al guardar mensajes (transacción): {err}")
             if conn:
                 conn.rollback()
@@ -473,13 +713,78 @@ class DatabaseManager:
                     )
                 """, (session_id,))
             
+            self.enrutador.marcar_escritura(session_id)
             return cursor.rowcount > 0
-        except mysql.connector.Error as err:
+        except ErrorBD as err:
             logger.error(f"❌ Error al limpiar historial: {err}")
             return False
         finally:
             if conn:
                 self.release_connection(conn)
 
+    def resumen_estadisticas(self):
+        """Totales históricos por idioma desde los rollups ('*' = todos), o None si falla."""
+        conn = None
+        try:
+            conn = self.get_read_connection()
+            return self.rollups.resumen(conn.cursor())
+        except ErrorBD as err:
+            logger.error(f"❌ Error al leer estadísticas: {err}")
+            return None
+        finally:
+            if conn:
+                self.release_connection(conn)
+
+    def serie_estadisticas(self, desde, hasta, bucket='day', idioma=IDIOMA_TODOS):
+        """Serie temporal de los rollups diarios (ver RollupsEstadisticas.serie), o None si falla."""
+        conn = None
+        try:
+            conn = self.get_read_connection()
+            return self.rollups.serie(conn.cursor(), desde, hasta, bucket, idioma)
+        except ErrorBD as err:
+            logger.error(f"❌ Error al leer la serie de estadísticas: {err}")
+            return None
+        finally:
+            if conn:
+                self.release_connection(conn)
+
+    def reconstruir_estadisticas(self, desde=None, hasta=None, progreso=None):
+        """
+        Reconstruye los rollups desde mensajes_chatbot, un día por transacción,
+        y después los totales. desde/hasta son fechas (hasta incluido); por
+        defecto todo el rango con mensajes. Devuelve los días procesados.
+        """
+        conn = None
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            rango = self.rollups.rango_mensajes(cursor)
+            if rango is None:
+                dias = []
+            else:
+                desde = max(desde or rango[0], rango[0])
+                hasta = min(hasta or rango[1], rango[1])
+                dias = [desde + timedelta(days=i) for i in range((hasta - desde).days + 1)]
+            
+            for dia in dias:
+                conn.start_transaction()
+                self.rollups.reconstruir_dia(cursor, dia)
+                conn.commit()
+                if progreso:
+                    progreso(dia)
+            
+            conn.start_transaction()
+            self.rollups.reconstruir_totales(cursor)
+            conn.commit()
+            return len(dias)
+        except ErrorBD as err:
+            logger.error(f"❌ Error reconstruyendo estadísticas: {err}")
+            if conn:
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                self.release_connection(conn)
+
 # Instancia global
 db_manager = DatabaseManager()
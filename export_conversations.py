@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+export_conversations.py - Exporta leads o mensajes de la base de datos (NDJSON o CSV)
+
+Misma exportación que /admin/export, pero directamente contra MySQL (usa las
+variables DB_* del .env). Recorre la tabla por id en lotes de EXPORT_BATCH
+filas con memoria constante; si se interrumpe, --after con el último id
+escrito continúa donde se quedó.
+
+Uso:
+  python export_conversations.py leads --format csv -o leads.csv
+  python export_conversations.py messages --from 2024-01-01 --to 2024-06-30 -o mensajes.ndjson
+  python export_conversations.py messages --after 1500000 >> mensajes.ndjson
+"""
+
+import sys
+import time
+import argparse
+
+from database import db_manager
+from exports import exportar, parsear_fecha, FORMATOS, COLUMNAS, EXPORT_BATCH
+
+
+class Progreso:
+    """Cuenta las filas que pasan y recuerda el último id (para --after)."""
+
+    def __init__(self, filas, cada=100_000):
+        self.filas = filas
+        self.cada = cada
+        self.total = 0
+        self.ultimo_id = None
+        self.inicio = time.perf_counter()
+
+    def __iter__(self):
+        for fila in self.filas:
+            self.total += 1
+            self.ultimo_id = fila['id']
+            if self.total % self.cada == 0:
+                print(f"   ... {self.total} filas (último id {self.ultimo_id}, "
+                      f"{self.total / (time.perf_counter() - self.inicio):.0f} filas/s)", file=sys.stderr)
+            yield fila
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Exporta leads o mensajes en NDJSON o CSV")
+    parser.add_argument('tipo', choices=list(COLUMNAS))
+    parser.add_argument('--format', dest='formato', choices=list(FORMATOS), default='ndjson')
+    parser.add_argument('--from', dest='desde', help="fecha ISO inicial (incluida)")
+    parser.add_argument('--to', dest='hasta', help="fecha ISO final (incluye el día completo si no lleva hora)")
+    parser.add_argument('--after', type=int, default=0, help="continuar después de este id")
+    parser.add_argument('--batch', type=int, default=EXPORT_BATCH, help="filas por consulta")
+    parser.add_argument('-o', '--output', help="archivo de salida (por defecto stdout)")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        desde = parsear_fecha(args.desde)
+        hasta = parsear_fecha(args.hasta, fin=True)
+    except ValueError as e:
+        parser.error(f"fecha inválida: {e}")
+
+    filas = Progreso(db_manager.exportar_filas(args.tipo, desde=desde, hasta=hasta,
+                                               despues_de_id=args.after, lote=args.batch))
+    salida = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    escrito = args.after  # último id cuyo trozo ya está en la salida
+    try:
+        for trozo in exportar(filas, args.tipo, args.formato, lote=args.batch):
+            salida.write(trozo)
+            escrito = filas.ultimo_id
+    except BaseException:
+        print(f"❌ Exportación interrumpida tras {filas.total} filas; "
+              f"continúa con --after {escrito}", file=sys.stderr)
+        raise
+    finally:
+        if args.output:
+            salida.close()
+        else:
+            salida.flush()
+
+    duracion = time.perf_counter() - filas.inicio
+    print(f"✅ {filas.total} filas de {args.tipo} exportadas en {duracion:.1f} s "
+          f"(último id {filas.ultimo_id})", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
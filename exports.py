@@ -0,0 +1,109 @@
+"""
+exports.py - Exportación masiva de leads y mensajes en NDJSON o CSV
+
+Convierte el generador de filas de DatabaseManager.exportar_filas (keyset por
+id, un lote por consulta) en trozos de bytes listos para una respuesta en
+streaming o un archivo. La memoria no depende del tamaño de la exportación:
+como mucho un lote de filas y un trozo de salida.
+
+Lo usan /admin/export y export_conversations.py.
+
+Variables de entorno:
+- EXPORT_BATCH: filas por consulta a la base de datos (default 1000)
+"""
+
+import io
+import os
+import re
+import csv
+from datetime import datetime, date, timedelta
+
+from responses import dumps
+
+EXPORT_BATCH = int(os.getenv('EXPORT_BATCH', 1000))
+
+FORMATOS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# Columnas (y orden) de cada tipo de exportación
+COLUMNAS = {
+    'leads': ['id', 'nombre', 'correo', 'whatsapp', 'session_id', 'fecha_registro',
+              'ultimo_acceso', 'mensajes', 'ultimo_mensaje'],
+    'messages': ['id', 'session_id', 'usuario_id', 'nombre', 'correo', 'whatsapp',
+                 'rol', 'contenido', 'idioma', 'fecha'],
+}
+
+# Caracteres con los que una celda se interpretaría como fórmula en Excel/Sheets
+_INICIO_FORMULA = ('=', '+', '-', '@', '\t', '\r')
+# ...salvo teléfonos como "+51 951 234 567": solo números, no pueden llamar funciones
+_TELEFONO = re.compile(r'[+\d\s()-]+')
+
+
+def parsear_fecha(valor, fin=False):
+    """
+    Fecha ISO ('2024-05-01' o '2024-05-01T10:00') -> datetime, o None si viene vacía.
+
+    Con fin=True una fecha sin hora incluye el día completo (el límite es
+    exclusivo: se devuelve el día siguiente a las 00:00). ValueError si no es válida.
+    """
+    if not valor:
+        return None
+    fecha = datetime.fromisoformat(valor)
+    if fin and len(valor) == 10:
+        fecha += timedelta(days=1)
+    return fecha
+
+
+def _celda(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if isinstance(valor, str) and valor.startswith(_INICIO_FORMULA) and not _TELEFONO.fullmatch(valor):
+        return "'" + valor
+    return valor
+
+
+def _trozos_ndjson(filas, columnas, lote):
+    pendientes = []
+    for fila in filas:
+        pendientes.append(dumps({c: fila.get(c) for c in columnas}))
+        if len(pendientes) >= lote:
+            yield b'\n'.join(pendientes) + b'\n'
+            pendientes = []
+    if pendientes:
+        yield b'\n'.join(pendientes) + b'\n'
+
+
+def _trozos_csv(filas, columnas, lote):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(columnas)
+    pendientes = 0
+    for fila in filas:
+        escritor.writerow([_celda(fila.get(c)) for c in columnas])
+        pendientes += 1
+        if pendientes >= lote:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            pendientes = 0
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def exportar(filas, tipo, formato, lote=None):
+    """
+    Serializa `filas` (cualquier iterable de dicts) como NDJSON o CSV.
+
+    Devuelve un generador de trozos de bytes, uno cada `lote` filas.
+    """
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato no soportado: {formato}")
+    columnas = COLUMNAS[tipo]
+    lote = lote or EXPORT_BATCH
+    if formato == 'csv':
+        return _trozos_csv(filas, columnas, lote)
+    return _trozos_ndjson(filas, columnas, lote)
@@ -0,0 +1,130 @@
+"""
+fake_llm.py - Proveedor local que imita la interfaz de google.generativeai
+
+Se activa con LLM_PROVIDER=fake. Permite ejecutar y probar la app sin
+GEMINI_API_KEY, con latencia configurable e inyección de fallos (429/5xx)
+para ejercitar el gobernador de upstream.
+
+Variables de entorno:
+- FAKE_LLM_FIRST_TOKEN_DELAY: segundos hasta el primer chunk (default 0.2)
+- FAKE_LLM_CHUNK_DELAY: segundos entre chunks (default 0.02)
+- FAKE_LLM_FAILURE_RATE: probabilidad de fallo por llamada (default 0)
+- FAKE_LLM_FAILURE_CODE: código HTTP del fallo inyectado (default 429)
+"""
+
+import os
+import time
+import random
+import threading
+from collections import deque
+
+
+class FakeUpstreamError(Exception):
+    """Error simulado del upstream con atributo `code` como las excepciones de google.api_core."""
+
+    def __init__(self, code, message=None):
+        self.code = code
+        super().__init__(message or f"Fallo simulado del proveedor fake ({code})")
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class _Respuesta:
+    def __init__(self, text):
+        self.text = text
+
+
+class _StreamFake:
+    """Iterable de chunks que se puede cancelar desde otro hilo, como un stream gRPC."""
+
+    def __init__(self, texto):
+        self._texto = texto
+        self._cancelado = threading.Event()
+
+    def cancel(self):
+        self._cancelado.set()
+
+    def _esperar(self, segundos):
+        if self._cancelado.wait(segundos):
+            raise FakeUpstreamError(499, "Stream cancelado por el cliente")
+
+    def __iter__(self):
+        self._esperar(float(os.getenv('FAKE_LLM_FIRST_TOKEN_DELAY', 0.2)))
+        retardo = float(os.getenv('FAKE_LLM_CHUNK_DELAY', 0.02))
+        palabras = self._texto.split(' ')
+        for i in range(0, len(palabras), 4):
+            if i:
+                self._esperar(retardo)
+            yield _Chunk(' '.join(palabras[i:i + 4]) + ' ')
+
+
+# Fallos encolados explícitamente (tienen prioridad sobre FAKE_LLM_FAILURE_RATE)
+_fallos_programados = deque()
+_lock = threading.Lock()
+
+
+def inyectar_fallos(n=1, code=429):
+    """Programa `n` fallos consecutivos con el código indicado."""
+    with _lock:
+        _fallos_programados.extend([code] * n)
+
+
+def limpiar_fallos():
+    with _lock:
+        _fallos_programados.clear()
+
+
+def _siguiente_fallo():
+    with _lock:
+        if _fallos_programados:
+            return _fallos_programados.popleft()
+    tasa = float(os.getenv('FAKE_LLM_FAILURE_RATE', 0))
+    if tasa > 0 and random.random() < tasa:
+        return int(os.getenv('FAKE_LLM_FAILURE_CODE', 429))
+    return None
+
+
+def _ultimo_texto(contents):
+    """Extrae el último mensaje del usuario, tanto de un string como de un historial."""
+    if isinstance(contents, str):
+        return contents
+    for mensaje in reversed(list(contents or [])):
+        if isinstance(mensaje, dict) and mensaje.get('role') == 'user':
+            partes = mensaje.get('parts') or ['']
+            return str(partes[-1])
+    return ''
+
+
+class FakeGenerativeModel:
+    """Sustituto de genai.GenerativeModel con respuestas deterministas."""
+
+    def __init__(self, model_name='fake', generation_config=None, safety_settings=None, **kwargs):
+        self.model_name = model_name
+        self.generation_config = generation_config or {}
+
+    def _texto_respuesta(self, contents):
+        pregunta = _ultimo_texto(contents)
+        if 'Translate the following' in pregunta and "Keywords: '" in pregunta:
+            # Devolver las mismas keywords como "traducción"
+            return pregunta.split("Keywords: '", 1)[1].rstrip("'")
+        pregunta = pregunta.rsplit('User Question:', 1)[-1].strip()
+        return (
+            f"Respuesta simulada ({self.model_name}) para: {pregunta[:200]}\n\n"
+            "🌊 Te recomiendo nuestros tours en Puno y el Lago Titicaca. "
+            "¿Para qué fecha planeas viajar y cuántas personas van? 📅👥"
+        )
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        codigo = _siguiente_fallo()
+        if codigo is not None:
+            time.sleep(float(os.getenv('FAKE_LLM_FIRST_TOKEN_DELAY', 0.2)) / 4)
+            raise FakeUpstreamError(codigo)
+
+        texto = self._texto_respuesta(contents)
+        if stream:
+            return _StreamFake(texto)
+        time.sleep(float(os.getenv('FAKE_LLM_FIRST_TOKEN_DELAY', 0.2)))
+        return _Respuesta(texto)
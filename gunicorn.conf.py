@@ -0,0 +1,47 @@
+"""
+gunicorn.conf.py - Perfil de arranque para producción
+
+La app (catálogo de tours, índices, módulos pesados) se carga una sola vez en
+el master y los workers la heredan copy-on-write. Los pools de MySQL se crean
+después del fork y cada worker hace una petición de calentamiento antes de
+aceptar tráfico.
+
+Uso: gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+import gc
+import os
+import time
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+timeout = 120
+accesslog = '-'
+errorlog = '-'
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') != '0'
+
+
+def when_ready(server):
+    # Los objetos precargados pasan a la generación permanente: el GC de los
+    # workers no los recorre y no ensucia las páginas compartidas
+    gc.freeze()
+
+
+def pre_fork(server, worker):
+    # El master no debe pasar sockets de MySQL abiertos a los hijos
+    from database import db_manager
+    db_manager.cerrar_pool()
+
+
+def post_fork(server, worker):
+    from database import db_manager
+    db_manager.reiniciar_tras_fork()
+    worker.inicio_boot = time.perf_counter()
+
+
+def post_worker_init(worker):
+    from app import calentar_worker, metricas_arranque
+    calentar_worker()
+    metricas_arranque['preloaded'] = worker.cfg.preload_app
+    metricas_arranque['worker_boot_ms'] = round((time.perf_counter() - worker.inicio_boot) * 1000, 2)
+    worker.log.info(f"Worker {worker.pid} listo en {metricas_arranque['worker_boot_ms']} ms")
@@ -0,0 +1,92 @@
+"""
+health.py - Estado de salud cacheado, refrescado en segundo plano
+
+Un hilo por proceso ejecuta las comprobaciones (BD, LLM, catálogo) cada
+`intervalo` segundos y guarda el resultado. Los endpoints /livez, /readyz y
+/health solo leen esa caché: cuestan microsegundos y nunca tocan la red.
+"""
+
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class ProbadorSalud:
+    """Ejecuta comprobaciones periódicas y cachea su último resultado."""
+
+    def __init__(self, comprobaciones, intervalo=15.0):
+        # comprobaciones: dict nombre -> callable que devuelve True/False
+        self.comprobaciones = comprobaciones
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._resultados = {}
+        self._ultima_ronda = None
+        self._hilo = None
+        self._pid = None
+        self._parar = threading.Event()
+
+    def refrescar(self):
+        """Ejecuta todas las comprobaciones una vez y actualiza la caché."""
+        for nombre, comprobacion in self.comprobaciones.items():
+            inicio = time.perf_counter()
+            try:
+                ok = bool(comprobacion())
+                error = None
+            except Exception as e:
+                ok, error = False, str(e)
+            resultado = {
+                'ok': ok,
+                'latency_ms': round((time.perf_counter() - inicio) * 1000, 2),
+                'checked_at': datetime.utcnow().isoformat(),
+            }
+            if error:
+                resultado['error'] = error
+            with self._lock:
+                anterior = self._resultados.get(nombre)
+                self._resultados[nombre] = resultado
+            if anterior is not None and anterior['ok'] != ok:
+                logger.warning(f"{'🟢' if ok else '🔴'} Comprobación '{nombre}' cambió a {'OK' if ok else 'FALLO'}")
+        with self._lock:
+            self._ultima_ronda = time.monotonic()
+
+    def _bucle(self):
+        # Primera ronda al arrancar el hilo (salvo que se acabe de hacer una síncrona):
+        # sin ella /readyz respondería "stale" durante todo el primer intervalo
+        with self._lock:
+            reciente = self._ultima_ronda is not None and time.monotonic() - self._ultima_ronda < self.intervalo
+        espera = self.intervalo if reciente else 0
+        while not self._parar.wait(espera):
+            try:
+                self.refrescar()
+            except Exception as e:
+                logger.error(f"❌ Error en el probador de salud: {str(e)}")
+            espera = self.intervalo
+
+    def asegurar_iniciado(self):
+        """Arranca el hilo si no corre en este proceso (los hilos no sobreviven a fork())."""
+        if self._pid == os.getpid() and self._hilo is not None and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._hilo is not None and self._hilo.is_alive():
+                return
+            self._pid = os.getpid()
+            self._parar = threading.Event()
+            self._hilo = threading.Thread(target=self._bucle, name='health-prober', daemon=True)
+            self._hilo.start()
+
+    def estado(self):
+        """Snapshot cacheado: resultados por comprobación y antigüedad de la última ronda."""
+        with self._lock:
+            resultados = {nombre: dict(r) for nombre, r in self._resultados.items()}
+            ultima = self._ultima_ronda
+        antiguedad = None if ultima is None else round(time.monotonic() - ultima, 2)
+        return {
+            'checks': resultados,
+            'age_seconds': antiguedad,
+            # Caché vencida si el hilo dejó de refrescar (3 intervalos sin ronda)
+            'stale': antiguedad is None or antiguedad > 3 * self.intervalo,
+        }
@@ -0,0 +1,206 @@
+"""
+idempotency.py - Generaciones reanudables e idempotencia de /chat
+
+Cada respuesta de /chat se publica en una `Generacion`: un buffer al que se
+pueden enganchar varios lectores. Si el cliente reintenta la misma petición
+con la misma clave de idempotencia, el reintento se engancha a la generación
+en curso (o repite la ya terminada) en vez de llamar otra vez al modelo y
+guardar turnos duplicados.
+
+`RegistroIdempotencia` vale dentro de un proceso; `RegistroCompartido` guarda
+en la caché compartida (cache.py) qué worker es dueño de cada clave, su texto
+parcial y la respuesta final, para que un reintento que cae en otro worker (u
+otro nodo) siga o repita la misma generación.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class Generacion:
+    """Buffer de una respuesta en curso que admite varios lectores y repetición."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._chunks = []
+        self.terminada = False
+        self.lectores = 0
+        self.creada = time.monotonic()
+        # Lo asigna quien produce la respuesta; también vale para los lectores que se reenganchan
+        self.al_abandonar = None
+        # sincronizar(generacion, terminada): copia el progreso fuera del proceso (RegistroCompartido)
+        self.sincronizar = None
+
+    def publicar(self, texto):
+        with self._cond:
+            self._chunks.append(texto)
+            self._cond.notify_all()
+        if self.sincronizar:
+            self.sincronizar(self, False)
+
+    def terminar(self):
+        # La respuesta final llega a la caché compartida antes de que los lectores vean el fin
+        if self.sincronizar and not self.terminada:
+            self.sincronizar(self, True)
+        with self._cond:
+            self.terminada = True
+            self._cond.notify_all()
+
+    @property
+    def texto(self):
+        with self._cond:
+            return "".join(self._chunks)
+
+    def seguir(self, al_abandonar=None):
+        """
+        Generador para un lector: entrega lo ya publicado y sigue lo nuevo.
+
+        `al_abandonar()` se llama cuando el último lector se va (el cliente se
+        desconecta) antes de que la generación termine; por defecto, el de la
+        generación.
+        """
+        with self._cond:
+            self.lectores += 1
+        indice = 0
+        try:
+            while True:
+                with self._cond:
+                    while indice >= len(self._chunks) and not self.terminada:
+                        self._cond.wait()
+                    nuevos = self._chunks[indice:]
+                    indice += len(nuevos)
+                    fin = self.terminada and indice >= len(self._chunks)
+                for chunk in nuevos:
+                    yield chunk
+                if fin:
+                    return
+        finally:
+            with self._cond:
+                self.lectores -= 1
+                abandonada = self.lectores == 0 and not self.terminada
+            al_abandonar = al_abandonar or self.al_abandonar
+            if abandonada and al_abandonar:
+                al_abandonar()
+
+
+class RegistroIdempotencia:
+    """Claves de idempotencia -> Generacion, con caducidad y tamaño acotado (por proceso)."""
+
+    def __init__(self, ttl=600, max_claves=10000):
+        self.ttl = ttl
+        self.max_claves = max_claves
+        self._lock = threading.Lock()
+        self._generaciones = OrderedDict()
+
+    def _purgar(self):
+        # Las entradas están en orden de creación: basta con mirar el principio
+        ahora = time.monotonic()
+        while self._generaciones:
+            clave, generacion = next(iter(self._generaciones.items()))
+            if ahora - generacion.creada < self.ttl and len(self._generaciones) <= self.max_claves:
+                break
+            self._generaciones.popitem(last=False)
+
+    def reservar(self, clave):
+        """Devuelve (generacion, nueva). Si la clave ya existe, `nueva` es False."""
+        with self._lock:
+            self._purgar()
+            generacion = self._generaciones.get(clave)
+            if generacion is not None:
+                return generacion, False
+            generacion = Generacion()
+            self._generaciones[clave] = generacion
+            return generacion, True
+
+    def liberar(self, clave):
+        """Olvida una clave reservada que no llegó a generar nada (p. ej. sesión no registrada)."""
+        with self._lock:
+            generacion = self._generaciones.pop(clave, None)
+        if generacion is not None:
+            generacion.terminar()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._generaciones)
+
+
+class RegistroCompartido:
+    """
+    Dueño, progreso y respuesta de cada clave de idempotencia en la caché compartida.
+
+    El worker que reserva la clave la genera y copia el texto acumulado (como
+    mucho cada `intervalo` segundos) y la respuesta final. Un reintento en otro
+    worker sigue ese texto desde la caché y renueva una marca de lector para
+    que el dueño no cancele la generación por abandono.
+    """
+
+    ESPACIO = 'idempotencia'
+    ESPACIO_LECTOR = 'idempotencia_lector'
+
+    def __init__(self, cache, ttl=600, intervalo=0.5, sin_progreso=30.0):
+        self.cache = cache
+        self.ttl = ttl
+        self.intervalo = intervalo
+        # Sin cambios en la entrada durante este tiempo, el dueño se da por caído
+        self.sin_progreso = sin_progreso
+
+    def reservar(self, clave):
+        """
+        None si este worker queda como dueño de la clave; si no, la entrada del dueño:
+        {'estado': 'en_curso' | 'terminada', 'texto': ..., 'ts': ...}.
+        """
+        entrada = {'estado': 'en_curso', 'texto': '', 'ts': time.time()}
+        for _ in range(2):
+            if self.cache.guardar_si_ausente(self.ESPACIO, clave, entrada, self.ttl):
+                return None
+            existente = self.cache.obtener(self.ESPACIO, clave)
+            if existente is not None:
+                return existente
+            # Expiró o se liberó entre la reserva y la lectura: probar de nuevo
+        return None
+
+    def liberar(self, clave):
+        self.cache.borrar(self.ESPACIO, clave)
+
+    def sincronizador(self, clave):
+        """Función sincronizar(generacion, terminada) para la Generacion del dueño."""
+        ultima = [0.0]
+
+        def sincronizar(generacion, terminada):
+            ahora = time.monotonic()
+            if not terminada and ahora - ultima[0] < self.intervalo:
+                return
+            ultima[0] = ahora
+            estado = 'terminada' if terminada else 'en_curso'
+            self.cache.guardar(self.ESPACIO, clave, {'estado': estado, 'texto': generacion.texto, 'ts': time.time()}, self.ttl)
+        return sincronizar
+
+    def hay_lector_remoto(self, clave):
+        return self.cache.obtener(self.ESPACIO_LECTOR, clave) is not None
+
+    def seguir(self, clave, generacion, detenido):
+        """
+        Copia en `generacion` (local) el texto que publica el dueño, hasta que termine.
+
+        Devuelve True si la respuesta llegó completa y False si el dueño dejó de
+        avanzar, la entrada desapareció o `detenido` (threading.Event) se activó.
+        """
+        publicado = ''
+        ultimo_cambio = time.time()
+        while not detenido.is_set():
+            self.cache.guardar(self.ESPACIO_LECTOR, clave, 1, max(2 * self.intervalo, 1))
+            entrada = self.cache.obtener(self.ESPACIO, clave)
+            if entrada is None:
+                return False
+            texto = entrada.get('texto', '')
+            if len(texto) > len(publicado):
+                generacion.publicar(texto[len(publicado):])
+                publicado = texto
+            if entrada.get('estado') == 'terminada':
+                return True
+            ultimo_cambio = max(ultimo_cambio, entrada.get('ts', 0))
+            if time.time() - ultimo_cambio > self.sin_progreso:
+                return False
+            detenido.wait(self.intervalo)
+        return False
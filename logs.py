@@ -0,0 +1,214 @@
+"""
+logs.py - Logging asíncrono con registros JSON e id de correlación
+
+Los hilos de petición solo encolan el registro (sin formatear ni tocar disco);
+un hilo `QueueListener` por proceso lo serializa a JSON y lo escribe en stdout
+y en un archivo con rotación por tamaño. Si la cola se llena, el registro se
+descarta y se cuenta: el logging nunca bloquea una petición.
+
+Cada petición lleva un id de correlación (cabecera X-Request-ID o uno nuevo)
+que se añade a todos sus registros, también a los de hilos auxiliares que se
+lancen con `con_contexto`. Las trazas DEBUG del pipeline se muestrean por
+petición: una petición muestreada las emite todas, el resto ninguna.
+
+Variables de entorno:
+- LOG_LEVEL: nivel mínimo (default INFO)
+- LOG_FORMAT: 'json' (default) o 'text' para desarrollo local
+- LOG_FILE: archivo de log (default app.log; vacío = solo stdout)
+- LOG_MAX_BYTES / LOG_BACKUP_COUNT: rotación (default 10 MB, 5 archivos)
+- LOG_QUEUE_SIZE: capacidad de la cola (default 10000)
+- LOG_DEBUG_SAMPLE_RATE: fracción de peticiones con trazas DEBUG (default 0)
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from profiling import ejecutar_en_hilo
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_FILE = os.getenv('LOG_FILE', 'app.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 0))
+
+_id_correlacion = contextvars.ContextVar('id_correlacion', default=None)
+_muestreada = contextvars.ContextVar('muestreada', default=False)
+
+# Atributos estándar de LogRecord: el resto se considera campo extra (logger.info(..., extra={...}))
+_ATRIBUTOS_ESTANDAR = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'correlation_id', 'exc'}
+
+_metricas = {'enqueued': 0, 'dropped': 0, 'sampled_out': 0}
+_estado = {'handler': None, 'listener': None, 'handlers': [], 'nivel': logging.INFO}
+
+
+# === Correlación y muestreo ===
+def iniciar_peticion(id_peticion):
+    """Fija el id de correlación de la petición actual y decide si se muestrea."""
+    _id_correlacion.set(id_peticion)
+    _muestreada.set(LOG_DEBUG_SAMPLE_RATE > 0 and random.random() < LOG_DEBUG_SAMPLE_RATE)
+
+
+def terminar_peticion():
+    _id_correlacion.set(None)
+    _muestreada.set(False)
+
+
+def id_correlacion():
+    return _id_correlacion.get()
+
+
+def con_contexto(funcion):
+    """Envuelve `funcion` para que se ejecute con el contexto (id de correlación) actual."""
+    contexto = contextvars.copy_context()
+
+    def envoltura(*args, **kwargs):
+        # ejecutar_en_hilo: si la petición se está perfilando, este hilo también se muestrea
+        return contexto.run(ejecutar_en_hilo, funcion, *args, **kwargs)
+    return envoltura
+
+
+# === Formato ===
+class FormateadorJSON(logging.Formatter):
+    """Una línea JSON por registro."""
+
+    def format(self, record):
+        datos = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        if getattr(record, 'correlation_id', None):
+            datos['correlation_id'] = record.correlation_id
+        if getattr(record, 'exc', None):
+            datos['exc'] = record.exc
+        for clave, valor in record.__dict__.items():
+            if clave not in _ATRIBUTOS_ESTANDAR and not clave.startswith('_'):
+                datos[clave] = valor
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class FormateadorTexto(logging.Formatter):
+    """Formato legible para desarrollo local, con el id de correlación."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s')
+
+    def format(self, record):
+        if not getattr(record, 'correlation_id', None):
+            record.correlation_id = '-'
+        texto = super().format(record)
+        if getattr(record, 'exc', None):
+            texto += '\n' + record.exc
+        return texto
+
+
+# === Encolado ===
+class ManejadorCola(QueueHandler):
+    """
+    QueueHandler que no bloquea: aplica el muestreo DEBUG, captura el id de
+    correlación en el hilo que emite y descarta si la cola está llena.
+    """
+
+    def emit(self, record):
+        if record.levelno < _estado['nivel'] and not _muestreada.get():
+            _metricas['sampled_out'] += 1
+            return
+        try:
+            self.enqueue(self.prepare(record))
+            _metricas['enqueued'] += 1
+        except queue.Full:
+            _metricas['dropped'] += 1
+        except Exception:
+            self.handleError(record)
+
+    def prepare(self, record):
+        # Se resuelven aquí los args y la traza: el registro cruza a otro hilo
+        preparado = logging.makeLogRecord(record.__dict__)
+        preparado.msg = record.getMessage()
+        preparado.args = None
+        preparado.correlation_id = _id_correlacion.get()
+        if record.exc_info:
+            preparado.exc = logging.Formatter().formatException(record.exc_info)
+        preparado.exc_info = None
+        preparado.exc_text = None
+        return preparado
+
+
+def _crear_handlers():
+    formateador = FormateadorJSON() if LOG_FORMAT == 'json' else FormateadorTexto()
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        # Con varios workers escribiendo el mismo archivo la rotación no está
+        # coordinada entre procesos; en contenedores basta con LOG_FILE=''
+        handlers.append(RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES,
+                                            backupCount=LOG_BACKUP_COUNT, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formateador)
+    return handlers
+
+
+def _arrancar_listener():
+    cola = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _estado['handler'].queue = cola
+    _estado['listener'] = QueueListener(cola, *_estado['handlers'])
+    _estado['listener'].start()
+
+
+def configurar_logging():
+    """Instala el pipeline en el logger raíz (idempotente)."""
+    if _estado['handler'] is not None:
+        return
+    nivel = logging.getLevelName(LOG_LEVEL)
+    _estado['nivel'] = nivel if isinstance(nivel, int) else logging.INFO
+    _estado['handlers'] = _crear_handlers()
+    _estado['handler'] = ManejadorCola(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    _arrancar_listener()
+
+    raiz = logging.getLogger()
+    for handler in list(raiz.handlers):
+        raiz.removeHandler(handler)
+    raiz.addHandler(_estado['handler'])
+    # El raíz deja pasar DEBUG si hay muestreo; el filtro real está en ManejadorCola
+    raiz.setLevel(logging.DEBUG if LOG_DEBUG_SAMPLE_RATE > 0 else _estado['nivel'])
+    logging.getLogger('werkzeug').setLevel(max(_estado['nivel'], logging.INFO))
+    atexit.register(detener_logging)
+
+
+def detener_logging():
+    """Vacía la cola y detiene el hilo escritor."""
+    if _estado['listener'] is not None:
+        _estado['listener'].stop()
+        _estado['listener'] = None
+
+
+def _reiniciar_tras_fork():
+    # El hilo escritor no sobrevive a fork(): el hijo arranca el suyo con una cola nueva
+    if _estado['handler'] is not None:
+        _arrancar_listener()
+
+
+def metricas_logging():
+    listener = _estado['listener']
+    return {
+        **_metricas,
+        'queue_depth': listener.queue.qsize() if listener is not None else 0,
+        'queue_capacity': LOG_QUEUE_SIZE,
+        'debug_sample_rate': LOG_DEBUG_SAMPLE_RATE,
+    }
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reiniciar_tras_fork)
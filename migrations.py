@@ -0,0 +1,150 @@
+"""
+migrations.py - Migraciones versionadas del esquema
+
+La tabla schema_version guarda las migraciones aplicadas. Al arrancar,
+DatabaseManager lee la versión con una sola consulta y, si está al día, no
+inspecciona nada más. Si faltan migraciones, las aplica en orden un único
+proceso a la vez: GET_LOCK en MySQL (vale entre workers y entre nodos), flock
+junto al archivo en SQLite. Los demás esperan el lock, vuelven a leer la
+versión y no repiten el trabajo.
+
+Cada migración comprueba lo que hace (columna o índice ya existentes), así
+una base creada antes de schema_version se pone al día sin errores y una
+migración interrumpida a medias se puede repetir. Los índices y columnas se
+crean online cuando el motor lo permite (ver storage.py).
+
+Para cambiar el esquema se añade una migración al final de MIGRACIONES con el
+siguiente número; nunca se modifica una ya publicada.
+
+Variables de entorno:
+- DB_MIGRATION_LOCK_TIMEOUT: segundos esperando el lock de migraciones (default 60)
+"""
+
+import os
+import logging
+
+from storage import ErrorBD
+from stats import TABLAS as TABLAS_ESTADISTICAS
+
+logger = logging.getLogger(__name__)
+
+DB_MIGRATION_LOCK_TIMEOUT = int(os.getenv('DB_MIGRATION_LOCK_TIMEOUT', 60))
+
+TABLA_VERSION = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INT NOT NULL PRIMARY KEY,
+        descripcion VARCHAR(255) NOT NULL,
+        aplicada TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+def _agregar_columna(cursor, almacen, tabla, columna, definicion):
+    if columna in almacen.columnas(cursor, tabla):
+        return
+    logger.info(f"📝 Agregando columna '{columna}' a {tabla}...")
+    almacen.agregar_columna(cursor, tabla, columna, definicion)
+    logger.info(f"✅ Columna '{columna}' agregada a {tabla}")
+
+
+def _crear_indice(cursor, almacen, nombre, tabla, columnas, unico=False, requerido=False):
+    """
+    Crea el índice si no existe. Si falla, un índice `requerido` (del que
+    depende la corrección de los datos) propaga el error: la migración queda
+    sin registrar y se reintenta en el siguiente arranque.
+    """
+    if nombre in almacen.indices(cursor, tabla):
+        return
+    logger.info(f"📝 Creando índice '{nombre}' en {tabla}...")
+    try:
+        almacen.crear_indice(cursor, nombre, tabla, columnas, unico)
+        logger.info(f"✅ Índice '{nombre}' creado")
+    except ErrorBD as err:
+        if requerido:
+            logger.error(f"❌ No se pudo crear el índice requerido '{nombre}': {err}")
+            raise
+        # P. ej. un índice único sobre datos antiguos con duplicados: la app funciona sin él
+        logger.warning(f"⚠️ No se pudo crear el índice '{nombre}': {err}")
+
+
+def _tablas_base(cursor, almacen):
+    for tabla in almacen.TABLAS_BASE:
+        cursor.execute(tabla)
+
+
+def _sesiones_usuarios(cursor, almacen):
+    _agregar_columna(cursor, almacen, 'usuarios_chatbot', 'session_id', "VARCHAR(255) NULL")
+    _agregar_columna(cursor, almacen, 'usuarios_chatbot', 'ultimo_acceso', "TIMESTAMP NULL")
+    # El nombre coincide con el que MySQL daba a la antigua columna session_id UNIQUE
+    _crear_indice(cursor, almacen, 'session_id', 'usuarios_chatbot', "session_id", unico=True)
+
+
+def _mensajes_por_rol(cursor, almacen):
+    _agregar_columna(cursor, almacen, 'mensajes_chatbot', 'session_id', "VARCHAR(255) NOT NULL DEFAULT ''")
+    _agregar_columna(cursor, almacen, 'mensajes_chatbot', 'rol', "ENUM('user', 'model') NOT NULL DEFAULT 'user'")
+    _agregar_columna(cursor, almacen, 'mensajes_chatbot', 'contenido', "TEXT")
+
+
+def _idioma_mensajes(cursor, almacen):
+    _agregar_columna(cursor, almacen, 'mensajes_chatbot', 'idioma', "VARCHAR(8) NULL")
+
+
+def _indice_historial(cursor, almacen):
+    # Historial por sesión paginando por id (keyset)
+    _crear_indice(cursor, almacen, 'idx_mensajes_session_id', 'mensajes_chatbot', "session_id, id")
+
+
+def _estadisticas(cursor, almacen):
+    # Índice por fecha para reconstruir las estadísticas día a día, y tablas de rollups
+    _crear_indice(cursor, almacen, 'idx_mensajes_fecha', 'mensajes_chatbot', "fecha")
+    for tabla in TABLAS_ESTADISTICAS:
+        cursor.execute(tabla)
+
+
+def _turno_id(cursor, almacen):
+    # Identificador de turno para reproducir el spool sin duplicados: sin el índice
+    # único, INSERT IGNORE no descarta nada y cada reproducción duplicaría filas
+    _agregar_columna(cursor, almacen, 'mensajes_chatbot', 'turno_id', "CHAR(32) NULL")
+    _crear_indice(cursor, almacen, 'uq_mensajes_turno', 'mensajes_chatbot', "turno_id, rol",
+                  unico=True, requerido=True)
+
+
+# (versión, descripción, función(cursor, almacen)) en orden
+MIGRACIONES = [
+    (1, "tablas base", _tablas_base),
+    (2, "session_id y ultimo_acceso en usuarios_chatbot", _sesiones_usuarios),
+    (3, "session_id, rol y contenido en mensajes_chatbot", _mensajes_por_rol),
+    (4, "idioma en mensajes_chatbot", _idioma_mensajes),
+    (5, "índice de historial por sesión", _indice_historial),
+    (6, "índice por fecha y tablas de estadísticas", _estadisticas),
+    (7, "turno_id idempotente para el spool", _turno_id),
+]
+VERSION_ESQUEMA = MIGRACIONES[-1][0]
+
+
+def version_actual(cursor):
+    """Versión aplicada del esquema (0 si todavía no existe schema_version)."""
+    try:
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+        fila = cursor.fetchone()
+    except ErrorBD:
+        return 0
+    return int(fila[0] or 0) if fila else 0
+
+
+def migrar(cursor, almacen):
+    """
+    Aplica las migraciones pendientes; hay que llamarla con el lock de
+    migraciones tomado. Devuelve las versiones aplicadas.
+    """
+    cursor.execute(TABLA_VERSION)
+    version = version_actual(cursor)
+    aplicadas = []
+    for numero, descripcion, funcion in MIGRACIONES:
+        if numero <= version:
+            continue
+        logger.info(f"🧱 Migración {numero}: {descripcion}")
+        funcion(cursor, almacen)
+        cursor.execute("INSERT INTO schema_version (version, descripcion) VALUES (%s, %s)", (numero, descripcion))
+        aplicadas.append(numero)
+    return aplicadas
@@ -0,0 +1,144 @@
+"""
+pipeline.py - Ejecución concurrente de las etapas previas a la generación
+
+Las etapas de /chat (lectura de usuario, historial, intención, keywords,
+traducción, búsqueda) forman un pequeño grafo de dependencias. Cada etapa se
+lanza en un pool de hilos en cuanto terminan sus dependencias, de modo que el
+tiempo hasta el primer token es el camino crítico y no la suma de etapas.
+"""
+
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from profiling import ejecutar_en_hilo
+
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', 16))
+
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix='pipeline')
+
+
+class EtapaOmitida(Exception):
+    """Una dependencia falló, así que la etapa no se ejecutó."""
+
+
+def _verificar_aciclico(etapas):
+    pendientes = {nombre: set(deps) for nombre, (_, deps) in etapas.items()}
+    while pendientes:
+        listas = [nombre for nombre, deps in pendientes.items() if not deps]
+        if not listas:
+            raise ValueError(f"El grafo de etapas tiene un ciclo: {sorted(pendientes)}")
+        for nombre in listas:
+            del pendientes[nombre]
+        for deps in pendientes.values():
+            deps.difference_update(listas)
+
+
+def ejecutar_grafo(etapas, executor=None, timeout=None):
+    """
+    Ejecuta un grafo de etapas y devuelve (resultados, tiempos).
+
+    `etapas` es un dict nombre -> (funcion, [dependencias]). Cada función recibe
+    como kwargs los resultados de sus dependencias. `tiempos` contiene, por
+    etapa, el instante de inicio y la duración en milisegundos relativos al
+    arranque del grafo. Si una etapa lanza una excepción, sus dependientes se
+    omiten y la primera excepción se relanza al final.
+    """
+    executor = executor or _executor
+    for nombre, (_, deps) in etapas.items():
+        for dep in deps:
+            if dep not in etapas:
+                raise ValueError(f"Etapa '{nombre}' depende de '{dep}', que no existe")
+
+    inicio_grafo = time.perf_counter()
+    lock = threading.Lock()
+    terminado = threading.Event()
+    resultados = {}
+    errores = {}
+    tiempos = {}
+    pendientes = {nombre: set(deps) for nombre, (_, deps) in etapas.items()}
+    dependientes = {nombre: [] for nombre in etapas}
+    for nombre, (_, deps) in etapas.items():
+        for dep in deps:
+            dependientes[dep].append(nombre)
+    restantes = [len(etapas)]
+
+    def ejecutar(nombre):
+        funcion, deps = etapas[nombre]
+        inicio = time.perf_counter()
+        try:
+            fallidas = [dep for dep in deps if dep in errores]
+            if fallidas:
+                raise EtapaOmitida(f"{nombre}: dependencias fallidas {fallidas}")
+            resultado = funcion(**{dep: resultados[dep] for dep in deps})
+            error = None
+        except Exception as e:
+            resultado, error = None, e
+        fin = time.perf_counter()
+
+        listas = []
+        with lock:
+            tiempos[nombre] = {
+                'start_ms': round((inicio - inicio_grafo) * 1000, 2),
+                'duration_ms': round((fin - inicio) * 1000, 2),
+            }
+            if error is None:
+                resultados[nombre] = resultado
+            else:
+                errores[nombre] = error
+            for dependiente in dependientes[nombre]:
+                pendientes[dependiente].discard(nombre)
+                if not pendientes[dependiente]:
+                    listas.append(dependiente)
+            restantes[0] -= 1
+            if restantes[0] == 0:
+                terminado.set()
+        for dependiente in listas:
+            executor.submit(contextvars.copy_context().run, ejecutar_en_hilo, ejecutar, dependiente)
+
+    _verificar_aciclico(etapas)
+    iniciales = [nombre for nombre, deps in pendientes.items() if not deps]
+    # Cada etapa corre con una copia del contexto del llamador (id de correlación de logs
+    # y, si la petición se está perfilando, la sesión del perfilador)
+    for nombre in iniciales:
+        executor.submit(contextvars.copy_context().run, ejecutar_en_hilo, ejecutar, nombre)
+
+    if etapas and not terminado.wait(timeout):
+        raise TimeoutError(f"Grafo de etapas sin terminar tras {timeout}s")
+
+    tiempos['_total'] = {'start_ms': 0.0, 'duration_ms': round((time.perf_counter() - inicio_grafo) * 1000, 2)}
+
+    for nombre, error in errores.items():
+        if not isinstance(error, EtapaOmitida):
+            raise error
+    return resultados, tiempos
+
+
+class MetricasEtapas:
+    """Acumula duraciones por etapa para reportar promedios y percentiles."""
+
+    def __init__(self, muestras=500):
+        self._lock = threading.Lock()
+        self._muestras = muestras
+        self._duraciones = {}
+
+    def registrar(self, tiempos):
+        with self._lock:
+            for nombre, tiempo in tiempos.items():
+                self._duraciones.setdefault(nombre, deque(maxlen=self._muestras)).append(tiempo['duration_ms'])
+
+    def snapshot(self):
+        with self._lock:
+            copia = {nombre: sorted(valores) for nombre, valores in self._duraciones.items()}
+        resumen = {}
+        for nombre, valores in copia.items():
+            resumen[nombre] = {
+                'samples': len(valores),
+                'avg_ms': round(sum(valores) / len(valores), 2),
+                'p50_ms': valores[len(valores) // 2],
+                'p95_ms': valores[min(len(valores) - 1, int(0.95 * len(valores)))],
+            }
+        return resumen
@@ -0,0 +1,365 @@
+"""
+profiling.py - Perfilado bajo demanda de un worker en producción
+
+- Perfilador de muestreo: un hilo toma las pilas de los hilos del worker con
+  sys._current_frames() cada PROFILER_INTERVAL_MS. En modo "peticiones" solo
+  muestrea los hilos de las próximas N peticiones a /chat (el hilo de la
+  petición, las etapas del pipeline y los hilos productores, que heredan la
+  sesión a través del contexto); en modo "segundos", todos los hilos durante T
+  segundos. El resultado es collapsed stacks ("hilo;f1;f2 N"), la entrada de
+  flamegraph.pl, speedscope o inferno, y se guarda en PROFILER_DIR para que
+  cualquier worker pueda servirlo.
+- Memoria: tracemalloc se activa a petición en un worker y da las líneas que
+  más memoria retienen y su diferencia con el momento de activarlo. Se apaga
+  solo tras TRACEMALLOC_MAX_SECONDS.
+
+Sin sesión activa no hay hilo de muestreo ni tracemalloc: el coste es
+comprobar un atributo por petición a /chat y leer una ContextVar al arrancar
+cada hilo.
+
+Variables de entorno:
+- PROFILER_DIR: directorio de resultados (default <tmp>/incalake_profiles)
+- PROFILER_INTERVAL_MS: intervalo de muestreo por defecto (default 10)
+- PROFILER_MAX_SECONDS: duración máxima de una sesión (default 300)
+- TRACEMALLOC_MAX_SECONDS: tracemalloc se desactiva solo tras este tiempo (default 600)
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import tempfile
+import threading
+import contextvars
+import tracemalloc
+from collections import Counter
+
+PROFILER_DIR = os.getenv('PROFILER_DIR', os.path.join(tempfile.gettempdir(), 'incalake_profiles'))
+PROFILER_INTERVAL_MS = float(os.getenv('PROFILER_INTERVAL_MS', 10))
+PROFILER_MAX_SECONDS = float(os.getenv('PROFILER_MAX_SECONDS', 300))
+TRACEMALLOC_MAX_SECONDS = float(os.getenv('TRACEMALLOC_MAX_SECONDS', 600))
+PROFILER_MAX_REQUESTS = 1000
+# Perfiles que se conservan en PROFILER_DIR
+PROFILER_KEEP = 20
+# Sin hilos seguidos durante este tiempo, las N peticiones se dan por terminadas
+_GRACIA_FIN = 0.25
+
+_sesion_actual = contextvars.ContextVar('sesion_perfil', default=None)
+
+
+def ejecutar_en_hilo(funcion, *args, **kwargs):
+    """Ejecuta `funcion` y, si el contexto pertenece a una petición perfilada, muestrea este hilo mientras tanto."""
+    sesion = _sesion_actual.get()
+    if sesion is None:
+        return funcion(*args, **kwargs)
+    ident = threading.get_ident()
+    sesion.seguir(ident)
+    try:
+        return funcion(*args, **kwargs)
+    finally:
+        sesion.soltar(ident)
+
+
+class SesionPerfil:
+    def __init__(self, peticiones=None, segundos=None, intervalo_ms=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.peticiones = peticiones
+        self.segundos = min(segundos or PROFILER_MAX_SECONDS, PROFILER_MAX_SECONDS)
+        self.intervalo = max(1.0, intervalo_ms or PROFILER_INTERVAL_MS) / 1000
+        self.inicio = time.time()
+        self.fin = None
+        self.iniciadas = 0
+        self.muestras = Counter()
+        self.ticks = 0
+        self._lock = threading.Lock()
+        self._hilos = Counter()
+        self._actividad = time.monotonic()
+
+    def seguir(self, ident):
+        with self._lock:
+            self._hilos[ident] += 1
+            self._actividad = time.monotonic()
+
+    def soltar(self, ident):
+        with self._lock:
+            self._hilos[ident] -= 1
+            if self._hilos[ident] <= 0:
+                del self._hilos[ident]
+            self._actividad = time.monotonic()
+
+    def reservar_peticion(self):
+        with self._lock:
+            if self.iniciadas >= self.peticiones:
+                return False
+            self.iniciadas += 1
+            return True
+
+    def hilos(self):
+        with self._lock:
+            return list(self._hilos)
+
+    def terminada(self):
+        if time.time() - self.inicio >= self.segundos:
+            return True
+        if self.peticiones is None:
+            return False
+        with self._lock:
+            return (self.iniciadas >= self.peticiones and not self._hilos
+                    and time.monotonic() - self._actividad > _GRACIA_FIN)
+
+    def resumen(self):
+        return {
+            'id': self.id,
+            'pid': os.getpid(),
+            'mode': 'seconds' if self.peticiones is None else 'requests',
+            'requests': self.peticiones,
+            'requests_profiled': self.iniciadas,
+            'max_seconds': self.segundos,
+            'interval_ms': round(self.intervalo * 1000, 2),
+            'started_at': self.inicio,
+            'finished_at': self.fin,
+            'status': 'done' if self.fin else 'running',
+            'samples': sum(self.muestras.values()),
+            'ticks': self.ticks,
+        }
+
+
+_NUMERO_HILO = re.compile(r'[-_ ]?\d+\b.*$')
+
+
+class Perfilador:
+    """Una sesión de muestreo a la vez por worker."""
+
+    def __init__(self, directorio=PROFILER_DIR):
+        self.directorio = directorio
+        self.sesion = None
+        self._lock = threading.Lock()
+        self._etiquetas = {}
+
+    @property
+    def activo(self):
+        return self.sesion is not None
+
+    def iniciar(self, peticiones=None, segundos=None, intervalo_ms=None):
+        """Arranca una sesión; RuntimeError si ya hay una en este worker."""
+        with self._lock:
+            if self.sesion is not None:
+                raise RuntimeError(f"ya hay una sesión de perfilado en curso ({self.sesion.id})")
+            sesion = SesionPerfil(peticiones, segundos, intervalo_ms)
+            os.makedirs(self.directorio, exist_ok=True)
+            self._podar()
+            self._guardar(sesion)
+            self.sesion = sesion
+        threading.Thread(target=self._bucle, args=(sesion,), name="profiler", daemon=True).start()
+        return sesion
+
+    # === Peticiones perfiladas ===
+    def iniciar_peticion(self):
+        """Al empezar una petición a /chat: la incluye si la sesión aún admite peticiones."""
+        sesion = self.sesion
+        if sesion is None or sesion.peticiones is None or not sesion.reservar_peticion():
+            return None
+        token = _sesion_actual.set(sesion)
+        sesion.seguir(threading.get_ident())
+        return sesion, token
+
+    def terminar_peticion(self, marca):
+        if marca is None:
+            return
+        sesion, token = marca
+        sesion.soltar(threading.get_ident())
+        try:
+            _sesion_actual.reset(token)
+        except ValueError:
+            _sesion_actual.set(None)
+
+    # === Muestreo ===
+    def _etiqueta(self, codigo):
+        etiqueta = self._etiquetas.get(codigo)
+        if etiqueta is None:
+            etiqueta = f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})"
+            self._etiquetas[codigo] = etiqueta
+        return etiqueta
+
+    def _pila(self, frame, hilo):
+        marcos = []
+        while frame is not None:
+            marcos.append(self._etiqueta(frame.f_code))
+            frame = frame.f_back
+        marcos.append(_NUMERO_HILO.sub('', hilo or 'hilo') or 'hilo')
+        marcos.reverse()
+        return ';'.join(marcos)
+
+    def _bucle(self, sesion):
+        propio = threading.get_ident()
+        try:
+            while not sesion.terminada():
+                time.sleep(sesion.intervalo)
+                marcos = sys._current_frames()
+                nombres = {hilo.ident: hilo.name for hilo in threading.enumerate()}
+                objetivos = marcos.keys() if sesion.peticiones is None else sesion.hilos()
+                sesion.ticks += 1
+                for ident in objetivos:
+                    frame = marcos.get(ident)
+                    if ident != propio and frame is not None:
+                        sesion.muestras[self._pila(frame, nombres.get(ident))] += 1
+                del marcos
+        finally:
+            sesion.fin = time.time()
+            self._guardar(sesion)
+            with self._lock:
+                self.sesion = None
+                self._etiquetas = {}
+
+    # === Resultados (compartidos entre workers a través del disco) ===
+    def _ruta(self, id_sesion, extension):
+        if not re.fullmatch(r'[0-9a-f]{12}', id_sesion or ''):
+            return None
+        return os.path.join(self.directorio, f"{id_sesion}.{extension}")
+
+    def _guardar(self, sesion):
+        if sesion.fin:
+            with open(self._ruta(sesion.id, 'collapsed'), 'w', encoding='utf-8') as f:
+                for pila, n in sesion.muestras.most_common():
+                    f.write(f"{pila} {n}\n")
+        temporal = self._ruta(sesion.id, 'json.tmp')
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(sesion.resumen(), f)
+        os.replace(temporal, self._ruta(sesion.id, 'json'))
+
+    def _podar(self):
+        try:
+            metas = sorted((n for n in os.listdir(self.directorio) if n.endswith('.json')),
+                           key=lambda n: os.path.getmtime(os.path.join(self.directorio, n)))
+        except FileNotFoundError:
+            return
+        for nombre in metas[:-PROFILER_KEEP or None]:
+            for extension in ('.json', '.collapsed'):
+                try:
+                    os.remove(os.path.join(self.directorio, nombre[:-5] + extension))
+                except FileNotFoundError:
+                    pass
+
+    def estado(self, id_sesion):
+        """Resumen de una sesión (de cualquier worker), o None si no existe."""
+        ruta = self._ruta(id_sesion, 'json')
+        if ruta is None:
+            return None
+        try:
+            with open(ruta, encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def collapsed(self, id_sesion):
+        """Collapsed stacks de una sesión terminada, o None."""
+        ruta = self._ruta(id_sesion, 'collapsed')
+        if ruta is None:
+            return None
+        try:
+            with open(ruta, encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+def funciones_principales(collapsed, limite=20):
+    """Funciones con más muestras propias (self) y totales (en la pila) de un collapsed."""
+    propias, totales, total = Counter(), Counter(), 0
+    for linea in collapsed.splitlines():
+        pila, _, n = linea.rpartition(' ')
+        n = int(n)
+        marcos = pila.split(';')[1:]
+        total += n
+        if marcos:
+            propias[marcos[-1]] += n
+        for marco in set(marcos):
+            totales[marco] += n
+    porcentaje = lambda n: round(100 * n / total, 2) if total else 0.0
+    return {
+        'samples': total,
+        'self': [{'frame': f, 'samples': n, 'percent': porcentaje(n)} for f, n in propias.most_common(limite)],
+        'total': [{'frame': f, 'samples': n, 'percent': porcentaje(n)} for f, n in totales.most_common(limite)],
+    }
+
+
+class MemoriaTracemalloc:
+    """tracemalloc a petición en este worker, con apagado automático."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._base = None
+        self._inicio = None
+        self._temporizador = None
+
+    @property
+    def activo(self):
+        return tracemalloc.is_tracing()
+
+    def iniciar(self, marcos=1):
+        with self._lock:
+            if tracemalloc.is_tracing():
+                return False
+            tracemalloc.start(max(1, min(int(marcos), 25)))
+            self._base = tracemalloc.take_snapshot()
+            self._inicio = time.time()
+            self._temporizador = threading.Timer(TRACEMALLOC_MAX_SECONDS, self.detener)
+            self._temporizador.daemon = True
+            self._temporizador.start()
+            return True
+
+    def detener(self):
+        with self._lock:
+            if self._temporizador is not None:
+                self._temporizador.cancel()
+                self._temporizador = None
+            self._base = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+                return True
+            return False
+
+    def instantanea(self, limite=20, agrupar='lineno'):
+        """Top de memoria retenida y crecimiento desde que se activó; None si no está activo."""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                return None
+            filtros = (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            )
+            actual = tracemalloc.take_snapshot().filter_traces(filtros)
+            base = self._base.filter_traces(filtros) if self._base else None
+            actual_total, pico = tracemalloc.get_traced_memory()
+            inicio = self._inicio
+
+        def ubicacion(traza):
+            return [f"{marco.filename}:{marco.lineno}" for marco in traza]
+
+        top = [
+            {'location': ubicacion(stat.traceback), 'size_kb': round(stat.size / 1024, 1), 'count': stat.count}
+            for stat in actual.statistics(agrupar)[:limite]
+        ]
+        crecimiento = []
+        if base is not None:
+            crecimiento = [
+                {'location': ubicacion(stat.traceback), 'size_diff_kb': round(stat.size_diff / 1024, 1),
+                 'count_diff': stat.count_diff}
+                for stat in actual.compare_to(base, agrupar)[:limite]
+            ]
+        return {
+            'pid': os.getpid(),
+            'tracing_seconds': round(time.time() - inicio, 1) if inicio else None,
+            'traced_kb': round(actual_total / 1024, 1),
+            'peak_kb': round(pico / 1024, 1),
+            'group_by': agrupar,
+            'top': top,
+            'growth': crecimiento,
+        }
+
+
+perfilador = Perfilador()
+memoria = MemoriaTracemalloc()
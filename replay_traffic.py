@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+replay_traffic.py - Reproduce conversaciones reales contra las etapas previas a la generación
+
+Dos pasos:
+
+- `export`: lee mensajes_chatbot (variables DB_* del .env) y escribe un NDJSON
+  con un turno de usuario por línea y el historial reciente de su sesión, tal
+  como lo vería /chat. Se anonimiza al exportar: la sesión se sustituye por un
+  hash con sal aleatoria y del texto se quitan el nombre, correo y WhatsApp del
+  usuario, además de cualquier correo o número largo.
+- `run`: reproduce esos turnos en procesos paralelos con el grafo de
+  app.etapas_pregeneracion (intención, keywords, traducción, búsqueda de tours,
+  contexto) y el LLM falso (LLM_PROVIDER=fake). No toca la base de datos: el
+  usuario y el historial salen del archivo. Informa la distribución de
+  latencias por etapa y, con --baseline, qué tours seleccionados cambiaron
+  respecto a una ejecución anterior (el archivo de --output de otra versión).
+
+Uso:
+  python replay_traffic.py export --from 2024-05-01 --sample 0.2 -o turnos.ndjson
+  git stash && python replay_traffic.py run turnos.ndjson -o base.ndjson && git stash pop
+  python replay_traffic.py run turnos.ndjson -o nuevo.ndjson --baseline base.ndjson --report informe.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import secrets
+import argparse
+import tempfile
+import multiprocessing
+from collections import deque
+from functools import lru_cache
+
+# Mensajes de historial por sesión (MAX_HISTORY_TURNS * 2 en app.py)
+HISTORIAL_MENSAJES = 10
+PERCENTILES = (50, 90, 95, 99)
+
+_CORREO = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+# Teléfonos, documentos, tarjetas: 6 o más dígitos, con separadores opcionales
+_NUMERO_LARGO = re.compile(r'\+?\d(?:[\s.-]?\d){5,}')
+
+
+# === Exportación ===
+@lru_cache(maxsize=4096)
+def _patrones_usuario(nombre, correo, whatsapp):
+    patrones = []
+    if correo:
+        patrones.append((re.compile(re.escape(correo), re.IGNORECASE), 'correo@ejemplo.com'))
+    if whatsapp:
+        patrones.append((re.compile(re.escape(whatsapp)), '000000'))
+    for parte in (nombre or '').split():
+        if len(parte) >= 3:
+            patrones.append((re.compile(r'\b' + re.escape(parte) + r'\b', re.IGNORECASE), 'Usuario'))
+    return tuple(patrones)
+
+
+def anonimizar(texto, fila):
+    """Texto sin los datos del usuario de la fila ni correos o números largos."""
+    for patron, sustituto in _patrones_usuario(fila.get('nombre'), fila.get('correo'), fila.get('whatsapp')):
+        texto = patron.sub(sustituto, texto)
+    texto = _CORREO.sub('correo@ejemplo.com', texto)
+    return _NUMERO_LARGO.sub('000000', texto)
+
+
+def turnos_anonimizados(filas, sal, muestra=1.0):
+    """
+    Convierte mensajes (en orden de id) en turnos de usuario con su historial previo.
+
+    Guarda solo los últimos HISTORIAL_MENSAJES mensajes de cada sesión, así que
+    la memoria depende del número de sesiones y no del de mensajes. Con
+    `muestra` < 1 se conserva esa fracción de sesiones (completas).
+    """
+    historiales = {}
+    turnos_por_sesion = {}
+    for fila in filas:
+        contenido = fila.get('contenido')
+        if not contenido or not fila.get('session_id'):
+            continue
+        resumen = hashlib.sha256((sal + fila['session_id']).encode('utf-8')).hexdigest()
+        if muestra < 1 and int(resumen[:8], 16) / 0xFFFFFFFF >= muestra:
+            continue
+        sesion = resumen[:16]
+        historial = historiales.setdefault(sesion, deque(maxlen=HISTORIAL_MENSAJES))
+        texto = anonimizar(contenido, fila)
+        if fila['rol'] == 'user':
+            numero = turnos_por_sesion.get(sesion, 0) + 1
+            turnos_por_sesion[sesion] = numero
+            yield {
+                'id': f"{sesion}:{numero}",
+                'session': sesion,
+                'language': fila.get('idioma') or 'es',
+                'message': texto,
+                'history': list(historial),
+            }
+        historial.append({'role': fila['rol'], 'parts': [texto]})
+
+
+def exportar_turnos(args):
+    from database import db_manager
+    from exports import parsear_fecha
+
+    try:
+        desde = parsear_fecha(args.desde)
+        hasta = parsear_fecha(args.hasta, fin=True)
+    except ValueError as e:
+        print(f"❌ Fecha inválida: {e}", file=sys.stderr)
+        return 2
+
+    inicio = time.perf_counter()
+    filas = db_manager.exportar_filas('messages', desde=desde, hasta=hasta)
+    # Sal nueva en cada exportación: los hashes no se pueden cruzar con la BD ni entre exportaciones
+    turnos = turnos_anonimizados(filas, secrets.token_hex(16), muestra=args.sample)
+    salida = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    total = 0
+    try:
+        for turno in turnos:
+            salida.write(json.dumps(turno, ensure_ascii=False) + '\n')
+            total += 1
+            if args.limit and total >= args.limit:
+                break
+    finally:
+        if args.output:
+            salida.close()
+        else:
+            salida.flush()
+    print(f"✅ {total} turnos anonimizados exportados en {time.perf_counter() - inicio:.1f} s", file=sys.stderr)
+    return 0
+
+
+# === Reproducción (en cada proceso hijo) ===
+_app = None
+_pipeline = None
+_USUARIO_REPLAY = {'id': 0, 'nombre': 'replay', 'session_id': 'replay'}
+_CALENTAMIENTO = [
+    ('hola', 'es'),
+    ('tour a las islas uros y taquile para 2 personas', 'es'),
+    ('machu picchu day trip under $200', 'en'),
+]
+
+
+def _iniciar_proceso(entorno):
+    """Importa la app con el LLM falso y sin BD real, y calienta las etapas."""
+    global _app, _pipeline
+    os.environ.update(entorno)
+    import app
+    import pipeline
+    _app, _pipeline = app, pipeline
+    for pregunta, idioma in _CALENTAMIENTO:
+        reproducir_turno({'id': '_calentamiento', 'message': pregunta, 'language': idioma})
+
+
+def reproducir_turno(turno):
+    """Ejecuta el grafo de etapas para un turno; devuelve intención, tours y tiempos."""
+    idioma = turno.get('language') or 'es'
+    if idioma not in _app.LANGUAGE_CONFIGS:
+        idioma = 'es'
+    historial = turno.get('history') or []
+    etapas = _app.etapas_pregeneracion(
+        turno['message'], idioma,
+        cargar_usuario=lambda: _USUARIO_REPLAY,
+        cargar_historial=lambda: historial
+    )
+    try:
+        resultados, tiempos = _pipeline.ejecutar_grafo(etapas)
+    except Exception as e:
+        return {'id': turno['id'], 'error': f"{type(e).__name__}: {e}"}
+    return {
+        'id': turno['id'],
+        'language': idioma,
+        'message': turno['message'],
+        'intent': resultados['intencion'],
+        'tours': [tour.get('url_servicio', '') for tour in resultados['tours']],
+        'stages_ms': {nombre: tiempo['duration_ms'] for nombre, tiempo in tiempos.items()},
+    }
+
+
+# === Informe ===
+def _percentil(ordenados, p):
+    return ordenados[min(len(ordenados) - 1, int(p / 100 * len(ordenados)))]
+
+
+def distribuciones(resultados):
+    """Por etapa: muestras, media, percentiles y máximo en ms ('_total' al final)."""
+    por_etapa = {}
+    for resultado in resultados:
+        for nombre, ms in resultado.get('stages_ms', {}).items():
+            por_etapa.setdefault(nombre, []).append(ms)
+    resumen = {}
+    for nombre in sorted(por_etapa, key=lambda n: (n == '_total', n)):
+        valores = sorted(por_etapa[nombre])
+        fila = {'samples': len(valores), 'mean_ms': round(sum(valores) / len(valores), 3)}
+        for p in PERCENTILES:
+            fila[f'p{p}_ms'] = _percentil(valores, p)
+        fila['max_ms'] = valores[-1]
+        resumen[nombre] = fila
+    return resumen
+
+
+def comparar(resultados, base, latencias, latencias_base):
+    """Turnos cuya intención o tours cambiaron, y p50/p95 por etapa frente a la base."""
+    por_id = {r['id']: r for r in base if 'error' not in r}
+    cambios = []
+    comparados = 0
+    for resultado in resultados:
+        anterior = por_id.get(resultado['id'])
+        if anterior is None or 'error' in resultado:
+            continue
+        comparados += 1
+        if resultado['tours'] == anterior['tours'] and resultado['intent'] == anterior['intent']:
+            continue
+        cambio = {
+            'id': resultado['id'],
+            'message': resultado['message'],
+            'baseline': anterior['tours'],
+            'current': resultado['tours'],
+            'added': [t for t in resultado['tours'] if t not in anterior['tours']],
+            'removed': [t for t in anterior['tours'] if t not in resultado['tours']],
+        }
+        if resultado['intent'] != anterior['intent']:
+            cambio['intent'] = [anterior['intent'], resultado['intent']]
+        cambios.append(cambio)
+
+    etapas = {}
+    for nombre, actual in latencias.items():
+        anterior = latencias_base.get(nombre)
+        if not anterior:
+            continue
+        etapas[nombre] = {}
+        for clave in ('p50_ms', 'p95_ms'):
+            delta = (actual[clave] - anterior[clave]) / anterior[clave] * 100 if anterior[clave] else None
+            etapas[nombre][clave] = {
+                'baseline': anterior[clave],
+                'current': actual[clave],
+                'delta_pct': round(delta, 1) if delta is not None else None,
+            }
+    return {
+        'compared': comparados,
+        'changed': len(cambios),
+        'changed_pct': round(len(cambios) / comparados * 100, 2) if comparados else 0.0,
+        'missing_in_baseline': len(resultados) - comparados,
+        'changes': cambios,
+        'latency': etapas,
+    }
+
+
+def _leer_ndjson(ruta):
+    with open(ruta, encoding='utf-8') as f:
+        return [json.loads(linea) for linea in f if linea.strip()]
+
+
+def _imprimir_informe(informe):
+    print(f"\n⏱️  Latencia por etapa ({informe['turns']} turnos, {informe['workers']} procesos, "
+          f"{informe['turns_per_second']} turnos/s)")
+    print(f"   {'etapa':22s} {'media':>8s} " + " ".join(f"{'p' + str(p):>8s}" for p in PERCENTILES) + f" {'max':>8s}")
+    for nombre, fila in informe['latency'].items():
+        print(f"   {nombre:22s} {fila['mean_ms']:8.2f} "
+              + " ".join(f"{fila[f'p{p}_ms']:8.2f}" for p in PERCENTILES) + f" {fila['max_ms']:8.2f}")
+    if informe['errors']:
+        print(f"\n❌ {informe['errors']} turnos con error (ver 'error' en la salida)")
+    diff = informe.get('diff')
+    if diff is None:
+        return
+    print(f"\n🔀 Tours frente a la base: {diff['changed']} de {diff['compared']} turnos cambian "
+          f"({diff['changed_pct']}%)" + (f", {diff['missing_in_baseline']} sin base" if diff['missing_in_baseline'] else ""))
+    for cambio in diff['changes'][:20]:
+        print(f"   {cambio['id']}  {cambio['message'][:60]!r}")
+        if 'intent' in cambio:
+            print(f"      intención: {cambio['intent'][0]} -> {cambio['intent'][1]}")
+        if cambio['added'] or cambio['removed']:
+            print(f"      - {cambio['removed']}\n      + {cambio['added']}")
+        elif cambio['baseline'] != cambio['current']:
+            print(f"      orden: {cambio['baseline']} -> {cambio['current']}")
+    if diff['changed'] > 20:
+        print(f"   ... {diff['changed'] - 20} cambios más en el informe JSON")
+    print("\n   Δ latencia (p50 / p95):")
+    for nombre, fila in diff['latency'].items():
+        print("   {:22s} ".format(nombre) + "   ".join(
+            f"{v['baseline']:.2f} -> {v['current']:.2f} ms"
+            + (f" ({v['delta_pct']:+.1f}%)" if v['delta_pct'] is not None else "")
+            for v in fila.values()
+        ))
+
+
+def reproducir(args):
+    turnos = _leer_ndjson(args.turns)
+    if args.limit:
+        turnos = turnos[:args.limit]
+    if not turnos:
+        print("❌ No hay turnos que reproducir", file=sys.stderr)
+        return 2
+
+    directorio = tempfile.mkdtemp(prefix='replay-')
+    # El LLM falso siempre (traducción de keywords determinista); BD, caché y spool locales
+    entorno = {
+        'LLM_PROVIDER': 'fake',
+        'FAKE_LLM_FIRST_TOKEN_DELAY': str(args.llm_delay),
+        'FAKE_LLM_FAILURE_RATE': '0',
+        'DB_ENGINE': 'sqlite',
+        'DB_SQLITE_PATH': os.path.join(directorio, 'replay.sqlite3'),
+        'CACHE_URL': 'memory://',
+        'SPOOL_ENABLED': '0',
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'LOG_FILE': '',
+    }
+    contexto = multiprocessing.get_context('spawn')
+    inicio = time.perf_counter()
+    with contexto.Pool(args.workers, initializer=_iniciar_proceso, initargs=(entorno,)) as pool:
+        arranque = time.perf_counter() - inicio
+        inicio = time.perf_counter()
+        resultados = []
+        for resultado in pool.imap(reproducir_turno, turnos, chunksize=max(1, min(64, len(turnos) // (args.workers * 4)))):
+            resultados.append(resultado)
+            if len(resultados) % 1000 == 0:
+                print(f"   ... {len(resultados)}/{len(turnos)} turnos", file=sys.stderr)
+        duracion = time.perf_counter() - inicio
+
+    validos = [r for r in resultados if 'error' not in r]
+    informe = {
+        'turns': len(resultados),
+        'errors': len(resultados) - len(validos),
+        'workers': args.workers,
+        'startup_seconds': round(arranque, 2),
+        'duration_seconds': round(duracion, 2),
+        'turns_per_second': round(len(resultados) / duracion, 1) if duracion else None,
+        'latency': distribuciones(validos),
+    }
+    if args.baseline:
+        base = _leer_ndjson(args.baseline)
+        informe['diff'] = comparar(validos, base, informe['latency'],
+                                   distribuciones([r for r in base if 'error' not in r]))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for resultado in resultados:
+                f.write(json.dumps(resultado, ensure_ascii=False) + '\n')
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(informe, f, ensure_ascii=False, indent=2)
+    _imprimir_informe(informe)
+
+    if args.fail_on_diff and (informe['errors'] or informe.get('diff', {}).get('changed')):
+        return 1
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Exporta y reproduce turnos reales contra las etapas de /chat")
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    exportar = subparsers.add_parser('export', help="exporta turnos anonimizados desde la BD")
+    exportar.add_argument('--from', dest='desde', help="fecha ISO inicial (incluida)")
+    exportar.add_argument('--to', dest='hasta', help="fecha ISO final (incluye el día completo si no lleva hora)")
+    exportar.add_argument('--sample', type=float, default=1.0, help="fracción de sesiones a exportar (0-1)")
+    exportar.add_argument('--limit', type=int, default=0, help="máximo de turnos")
+    exportar.add_argument('-o', '--output', help="archivo NDJSON (por defecto stdout)")
+
+    ejecutar = subparsers.add_parser('run', help="reproduce turnos y compara con una ejecución base")
+    ejecutar.add_argument('turns', help="NDJSON generado con export")
+    ejecutar.add_argument('--workers', type=int, default=os.cpu_count() or 2, help="procesos en paralelo")
+    ejecutar.add_argument('--limit', type=int, default=0, help="reproducir solo los primeros N turnos")
+    ejecutar.add_argument('--llm-delay', type=float, default=0.0,
+                          help="segundos que tarda el LLM falso en cada traducción (default 0)")
+    ejecutar.add_argument('-o', '--output', help="resultados por turno (NDJSON, sirve como --baseline)")
+    ejecutar.add_argument('--baseline', help="resultados de una ejecución anterior para comparar")
+    ejecutar.add_argument('--report', help="informe completo en JSON")
+    ejecutar.add_argument('--fail-on-diff', action='store_true',
+                          help="salir con código 1 si cambia algún tour o hay errores")
+    args = parser.parse_args(argv[1:])
+
+    if args.comando == 'export':
+        return exportar_turnos(args)
+    return reproducir(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
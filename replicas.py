@@ -0,0 +1,263 @@
+"""
+replicas.py - Réplicas de lectura para DatabaseManager
+
+Con DB_REPLICA_HOSTS configurado, las lecturas que toleran algo de retraso
+(historial, exportaciones, estadísticas) van a un pool por réplica y dejan el
+primario para el camino de escritura del chat. Sin réplicas todo sigue en el
+primario, sin coste añadido.
+
+- Lag: un hilo por proceso consulta SHOW REPLICA STATUS cada
+  DB_REPLICA_CHECK_INTERVAL segundos; una réplica caída o con más de
+  DB_REPLICA_MAX_LAG segundos de retraso deja de recibir lecturas.
+- Read-your-writes: tras escribir en una sesión, sus lecturas van al primario
+  durante DB_READ_YOUR_WRITES_SECONDS. La marca se guarda en la caché compartida
+  (cache.py) si se configura, para que valga también en los demás workers.
+
+Variables de entorno:
+- DB_REPLICA_HOSTS: host[:puerto] separados por comas (vacío = sin réplicas)
+- DB_REPLICA_USER / DB_REPLICA_PASSWORD: credenciales (default las del primario)
+- DB_REPLICA_POOL_SIZE: conexiones por réplica (default 5)
+- DB_REPLICA_MAX_LAG: segundos de retraso tolerados (default 5)
+- DB_REPLICA_CHECK_INTERVAL: segundos entre comprobaciones de lag (default 5)
+- DB_READ_YOUR_WRITES_SECONDS: ventana de lecturas en el primario tras escribir (default 10)
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import Counter
+
+import mysql.connector
+from mysql.connector import pooling
+
+logger = logging.getLogger(__name__)
+
+DB_REPLICA_HOSTS = os.getenv('DB_REPLICA_HOSTS', '')
+DB_REPLICA_POOL_SIZE = int(os.getenv('DB_REPLICA_POOL_SIZE', 5))
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 5))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 5))
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv('DB_READ_YOUR_WRITES_SECONDS', 10))
+# Marcas de escritura locales que se recuerdan como máximo
+MARCAS_MAX = 10000
+
+
+def parsear_hosts(valor):
+    """'db-r1:3307, db-r2' -> [('db-r1', 3307), ('db-r2', 3306)]"""
+    hosts = []
+    for parte in valor.split(','):
+        parte = parte.strip()
+        if not parte:
+            continue
+        host, _, puerto = parte.partition(':')
+        hosts.append((host, int(puerto or 3306)))
+    return hosts
+
+
+class Replica:
+    """Una réplica: su pool (perezoso, como el del primario) y su último lag medido."""
+
+    def __init__(self, indice, host, puerto, opciones):
+        self.nombre = f"{host}:{puerto}"
+        self.host = host
+        self.puerto = puerto
+        self._indice = indice
+        self._opciones = opciones
+        self._lock = threading.Lock()
+        self.pool = None
+        self.lag = None  # segundos; None si no se pudo medir (sin privilegio REPLICATION CLIENT)
+        self.sana = True
+        self.error = None
+        self.comprobada = None
+
+    def get_connection(self):
+        if self.pool is None:
+            with self._lock:
+                if self.pool is None:
+                    self.pool = pooling.MySQLConnectionPool(
+                        pool_name=f"incalake_replica_{self._indice}",
+                        pool_size=DB_REPLICA_POOL_SIZE,
+                        host=self.host,
+                        port=self.puerto,
+                        **self._opciones
+                    )
+                    logger.info(f"✅ Pool de réplica {self.nombre} creado")
+        return self.pool.get_connection()
+
+    def cerrar(self):
+        with self._lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            try:
+                pool._remove_connections()
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo cerrar el pool de la réplica {self.nombre}: {str(e)}")
+
+    def medir_lag(self):
+        """Consulta el retraso de replicación y actualiza el estado de la réplica."""
+        conn = None
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor(dictionary=True)
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+            except mysql.connector.Error:
+                cursor.execute("SHOW SLAVE STATUS")  # MySQL < 8.0.22 / MariaDB
+            estado = cursor.fetchone()
+            if estado is None:
+                lag = None
+            else:
+                lag = estado.get('Seconds_Behind_Source', estado.get('Seconds_Behind_Master'))
+                if lag is None:
+                    raise RuntimeError("la replicación está detenida")
+            self.lag = None if lag is None else float(lag)
+            self.sana = self.lag is None or self.lag <= DB_REPLICA_MAX_LAG
+            self.error = None
+        except mysql.connector.Error as err:
+            if err.errno == 1227:  # sin privilegio REPLICATION CLIENT: lag desconocido
+                self.lag, self.sana, self.error = None, True, None
+            else:
+                self.sana, self.error = False, str(err)
+        except Exception as e:
+            self.sana, self.error = False, str(e)
+        finally:
+            if conn:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self.comprobada = time.time()
+        return self.sana
+
+
+class EnrutadorLecturas:
+    """Elige primario o réplica para cada lectura y cuenta las decisiones."""
+
+    def __init__(self, hosts=None, opciones=None):
+        self.replicas = [Replica(i, host, puerto, opciones or {})
+                         for i, (host, puerto) in enumerate(hosts or [])]
+        self._lock = threading.Lock()
+        self._siguiente = 0
+        self._decisiones = Counter()
+        self._marcas = {}  # session_id -> instante hasta el que se lee del primario
+        self._almacen = None
+        self._hilo = None
+        self._pid = None
+        self._parar = threading.Event()
+
+    @property
+    def activo(self):
+        return bool(self.replicas)
+
+    def usar_almacen(self, almacen):
+        """Guarda las marcas de escritura en una caché compartida (obtener/guardar con TTL)."""
+        self._almacen = almacen
+
+    # === Read-your-writes ===
+    def marcar_escritura(self, session_id):
+        if not self.activo or not session_id:
+            return
+        hasta = time.time() + DB_READ_YOUR_WRITES_SECONDS
+        with self._lock:
+            if len(self._marcas) >= MARCAS_MAX:
+                ahora = time.time()
+                self._marcas = {s: t for s, t in self._marcas.items() if t > ahora}
+            self._marcas[session_id] = hasta
+        if self._almacen is not None:
+            self._almacen.guardar('escritura', session_id, hasta, DB_READ_YOUR_WRITES_SECONDS)
+
+    def _escritura_reciente(self, session_id):
+        ahora = time.time()
+        with self._lock:
+            if self._marcas.get(session_id, 0) > ahora:
+                return True
+        if self._almacen is not None:
+            hasta = self._almacen.obtener('escritura', session_id)
+            return hasta is not None and hasta > ahora
+        return False
+
+    # === Enrutado ===
+    def elegir(self, session_id=None):
+        """Réplica para esta lectura, o (None, motivo) si debe ir al primario."""
+        if not self.activo:
+            return None, 'no_replicas'
+        self._asegurar_monitor()
+        if session_id and self._escritura_reciente(session_id):
+            return None, 'read_your_writes'
+        with self._lock:
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[self._siguiente % len(self.replicas)]
+                self._siguiente += 1
+                if replica.sana:
+                    return replica, 'replica'
+        return None, 'replicas_unhealthy'
+
+    def registrar(self, destino, motivo):
+        with self._lock:
+            self._decisiones[f"{destino}:{motivo}"] += 1
+
+    def descartar(self, replica, error):
+        """Una réplica falló al dar conexión: fuera hasta la próxima comprobación."""
+        replica.sana = False
+        replica.error = str(error)
+        logger.warning(f"⚠️ Réplica {replica.nombre} no disponible, se lee del primario: {error}")
+
+    # === Monitor de lag ===
+    def _asegurar_monitor(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._parar = threading.Event()
+            self._hilo = threading.Thread(target=self._bucle, name="replica-lag", daemon=True)
+            self._hilo.start()
+
+    def _bucle(self):
+        while not self._parar.is_set():
+            for replica in self.replicas:
+                antes = replica.sana
+                if replica.medir_lag() != antes:
+                    estado = "disponible" if replica.sana else f"fuera (lag={replica.lag}, error={replica.error})"
+                    logger.info(f"🔁 Réplica {replica.nombre} {estado}")
+            self._parar.wait(DB_REPLICA_CHECK_INTERVAL)
+
+    def detener(self):
+        self._parar.set()
+
+    def reiniciar_tras_fork(self):
+        """Descarta pools y monitor heredados; el hijo los recrea al primer uso."""
+        self._lock = threading.Lock()
+        self._pid = None
+        for replica in self.replicas:
+            replica._lock = threading.Lock()
+            replica.pool = None
+
+    def cerrar(self):
+        self.detener()
+        for replica in self.replicas:
+            replica.cerrar()
+
+    def metricas(self):
+        with self._lock:
+            decisiones = dict(self._decisiones)
+            marcas = len(self._marcas)
+        lecturas = sum(decisiones.values())
+        en_replica = sum(n for clave, n in decisiones.items() if clave.startswith('replica:'))
+        return {
+            'replicas': [
+                {
+                    'name': replica.nombre,
+                    'healthy': replica.sana,
+                    'lag_seconds': replica.lag,
+                    'error': replica.error,
+                    'checked_age_seconds': round(time.time() - replica.comprobada, 1) if replica.comprobada else None,
+                }
+                for replica in self.replicas
+            ],
+            'routing': decisiones,
+            'replica_read_share': round(en_replica / lecturas, 4) if lecturas else 0.0,
+            'read_your_writes_marks': marcas,
+            'max_lag_seconds': DB_REPLICA_MAX_LAG,
+        }
@@ -0,0 +1,204 @@
+"""
+responses.py - Capa de respuestas JSON: serialización rápida, compresión y streaming
+
+- `ProveedorJSON` sustituye al encoder de la stdlib en `jsonify` por msgspec
+  (ya en requirements; mismo rendimiento que orjson) y cae a `json` si no está.
+  Las fechas salen en ISO 8601 / RFC 3339 ('2024-05-01T10:00:00') con los dos
+  serializadores, no en el formato HTTP ('Wed, 01 May 2024 ...') de Flask.
+- `comprimir_respuesta` (after_request) negocia br/gzip con el cliente para
+  respuestas de texto por encima de COMPRESS_MIN_BYTES. En streaming se leen
+  los primeros trozos hasta llegar al umbral: un stream más corto sale sin comprimir.
+- `respuesta_json_stream` emite un objeto JSON con un array grande por trozos,
+  sin construir el documento completo en memoria.
+
+Variables de entorno:
+- COMPRESS_MIN_BYTES: tamaño mínimo para comprimir (default 1024)
+- COMPRESS_GZIP_LEVEL / COMPRESS_BROTLI_QUALITY: nivel para respuestas dinámicas (default 6 / 4)
+- JSON_STREAM_BATCH: elementos del array por trozo emitido (default 500)
+"""
+
+import os
+import json
+import zlib
+from datetime import date, datetime
+from itertools import chain
+
+from flask import Response
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import msgspec
+except ImportError:  # opcional: sin msgspec se usa el encoder de la stdlib
+    msgspec = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', 4))
+JSON_STREAM_BATCH = int(os.getenv('JSON_STREAM_BATCH', 500))
+
+TIPOS_COMPRIMIBLES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/html')
+
+
+# === Serialización ===
+if msgspec is not None:
+    _encoder = msgspec.json.Encoder(enc_hook=str, decimal_format='number')
+
+    def dumps(obj):
+        """Serializa a bytes JSON (UTF-8, compacto)."""
+        return _encoder.encode(obj)
+
+    SERIALIZADOR = 'msgspec'
+else:
+    def _por_defecto(obj):
+        # Mismo formato de fechas que msgspec
+        if isinstance(obj, (datetime, date)):
+            return obj.isoformat()
+        return str(obj)
+
+    def dumps(obj):
+        """Serializa a bytes JSON (UTF-8, compacto)."""
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_por_defecto).encode('utf-8')
+
+    SERIALIZADOR = 'json'
+
+
+class ProveedorJSON(DefaultJSONProvider):
+    """Proveedor JSON de Flask con el serializador rápido (jsonify, app.json.dumps)."""
+
+    def dumps(self, obj, **kwargs):
+        if kwargs.get('indent'):
+            return super().dumps(obj, **kwargs)
+        return dumps(obj).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if self._app.debug and self.compact is not False:
+            return super().response(obj)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
+
+
+def _trozos_objeto(cabecera, clave, elementos, pie, lote):
+    inicio = dumps(cabecera)
+    yield inicio[:-1] + (b',' if len(inicio) > 2 else b'') + dumps(clave) + b':['
+    total, pendientes = 0, []
+    for elemento in elementos:
+        pendientes.append(dumps(elemento))
+        if len(pendientes) >= lote:
+            yield (b',' if total else b'') + b','.join(pendientes)
+            total += len(pendientes)
+            pendientes = []
+    if pendientes:
+        yield (b',' if total else b'') + b','.join(pendientes)
+        total += len(pendientes)
+    final = pie(total) if callable(pie) else (pie or {})
+    yield b']' + (b',' + dumps(final)[1:] if final else b'}')
+
+
+def respuesta_json_stream(cabecera, clave, elementos, pie=None, lote=None, dentro_de=None):
+    """
+    Respuesta JSON `{...cabecera, clave: [elementos...], ...pie}` emitida por trozos.
+
+    `elementos` puede ser cualquier iterable (una lista o un cursor de BD): se
+    serializa en lotes de `lote` elementos. `pie` puede ser una función que se
+    llama al final y recibe cuántos elementos se emitieron (p. ej. para 'count').
+    Con `dentro_de`, el array va dentro del dict `cabecera[dentro_de]`.
+    """
+    lote = lote or JSON_STREAM_BATCH
+
+    def generar():
+        if dentro_de is None:
+            yield from _trozos_objeto(cabecera, clave, elementos, pie, lote)
+            return
+        exterior = dumps({k: v for k, v in cabecera.items() if k != dentro_de})
+        yield exterior[:-1] + (b',' if len(exterior) > 2 else b'') + dumps(dentro_de) + b':'
+        yield from _trozos_objeto(cabecera[dentro_de], clave, elementos, pie, lote)
+        yield b'}'
+
+    return Response(generar(), mimetype='application/json')
+
+
+# === Compresión ===
+def elegir_codificacion(accept_encodings):
+    """'br', 'gzip' o None según lo que acepta el cliente (request.accept_encodings)."""
+    if brotli is not None and accept_encodings['br'] > 0:
+        return 'br'
+    if accept_encodings['gzip'] > 0:
+        return 'gzip'
+    return None
+
+
+def _compresor(codificacion):
+    if codificacion == 'br':
+        return brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+    return zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)  # 31 = formato gzip
+
+
+def _comprimir_iterable(iterable, codificacion, original=None):
+    """Comprime trozo a trozo; al terminar cierra `original` (por defecto, el propio iterable)."""
+    original = iterable if original is None else original
+    compresor = _compresor(codificacion)
+    try:
+        for trozo in iterable:
+            if isinstance(trozo, str):
+                trozo = trozo.encode('utf-8')
+            datos = compresor.process(trozo) if codificacion == 'br' else compresor.compress(trozo)
+            if datos:
+                yield datos
+        yield compresor.finish() if codificacion == 'br' else compresor.flush()
+    finally:
+        if hasattr(original, 'close'):
+            original.close()
+
+
+def _leer_hasta(iterador, minimo):
+    """Trozos leídos hasta juntar `minimo` bytes y si el iterador se agotó antes."""
+    leidos, total = [], 0
+    for trozo in iterador:
+        leidos.append(trozo)
+        total += len(trozo)
+        if total >= minimo:
+            return leidos, False
+    return leidos, True
+
+
+def comprimir_respuesta(respuesta, accept_encodings):
+    """Comprime la respuesta si es texto, no está ya codificada y supera el umbral."""
+    if (respuesta.status_code < 200 or respuesta.status_code in (204, 304)
+            or respuesta.direct_passthrough or 'Content-Encoding' in respuesta.headers
+            or respuesta.mimetype not in TIPOS_COMPRIMIBLES):
+        return respuesta
+    respuesta.vary.add('Accept-Encoding')
+    codificacion = elegir_codificacion(accept_encodings)
+    if codificacion is None:
+        return respuesta
+
+    if respuesta.is_streamed:
+        # Tamaño desconocido: se lee hasta el umbral y, si lo pasa, se comprime trozo a trozo
+        # (el stream de /chat es text/event-stream y no entra aquí)
+        original = respuesta.response
+        iterador = iter(original)
+        leidos, agotado = _leer_hasta(iterador, COMPRESS_MIN_BYTES)
+        if agotado:
+            if hasattr(original, 'close'):
+                original.close()
+            respuesta.set_data(b''.join(t.encode('utf-8') if isinstance(t, str) else t for t in leidos))
+            return respuesta
+        respuesta.response = _comprimir_iterable(chain(leidos, iterador), codificacion, original)
+        respuesta.headers.pop('Content-Length', None)
+    else:
+        datos = respuesta.get_data()
+        if len(datos) < COMPRESS_MIN_BYTES:
+            return respuesta
+        respuesta.set_data(b''.join(_comprimir_iterable([datos], codificacion)))
+    respuesta.headers['Content-Encoding'] = codificacion
+    if respuesta.headers.get('ETag'):
+        # Como nginx: el ETag fuerte pasa a débil en la variante comprimida
+        # (If-None-Match usa comparación débil, así que la revalidación sigue funcionando)
+        etag, _ = respuesta.get_etag()
+        respuesta.set_etag(etag, weak=True)
+    return respuesta
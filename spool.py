@@ -0,0 +1,428 @@
+"""
+spool.py - Spool local durable de turnos del chat (write-ahead log segmentado)
+
+Cada turno terminado se escribe primero aquí y un reproductor en segundo plano
+lo pasa a MySQL. Así la latencia del chat no depende de la escritura en la
+base de datos y una caída de MySQL no pierde turnos: se acumulan en disco y se
+insertan al volver.
+
+Formato: archivos seg-<inicio ms>-<pid>-<secuencia>.wal con registros
+[longitud u32][crc32 u32][JSON]. Cada proceso escribe en su propio segmento y
+mantiene sobre él un flock compartido; un segmento sin flock está cerrado
+(rotado o de un proceso que murió) y, una vez reproducido, se borra. Un
+registro a medio escribir al final de un segmento cerrado se descarta (CRC).
+
+- Escritura: write + flush bajo un lock; un hilo hace fsync cada
+  SPOOL_FSYNC_INTERVAL agrupando todos los registros pendientes (group commit)
+  y `agregar` vuelve cuando su registro es durable.
+- Reproducción: un único proceso por directorio (flock sobre replay.lock; si
+  muere, otro lo toma) mezcla los segmentos por marca de tiempo, aplica los
+  registros en orden y guarda el offset por segmento en checkpoint.json
+  (escritura atómica). La aplicación debe ser idempotente (turno_id): tras una
+  caída se puede repetir el último lote.
+- Un registro que falla SPOOL_MAX_ATTEMPTS veces con la base de datos
+  disponible va a dead-letter.ndjson para no bloquear la cola.
+
+Variables de entorno:
+- SPOOL_ENABLED: 1 para escribir los turnos en el spool (default 1)
+- SPOOL_DIR: directorio del spool; en Docker, un volumen (default spool)
+- SPOOL_SEGMENT_BYTES: tamaño de rotación de segmentos (default 8 MB)
+- SPOOL_FSYNC_INTERVAL: segundos entre fsync agrupados; 0 = fsync por registro (default 0.005)
+- SPOOL_REPLAY_INTERVAL: pausa del reproductor cuando no hay pendientes (default 0.2)
+- SPOOL_REPLAY_BATCH: registros por segmento y ronda (default 200)
+- SPOOL_MAX_ATTEMPTS: intentos de un registro antes de apartarlo (default 5)
+"""
+
+import os
+import json
+import time
+import zlib
+import fcntl
+import heapq
+import struct
+import atexit
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+
+from responses import dumps
+
+logger = logging.getLogger(__name__)
+
+SPOOL_ENABLED = os.getenv('SPOOL_ENABLED', '1') == '1'
+SPOOL_DIR = os.getenv('SPOOL_DIR', 'spool')
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', 8 * 1024 * 1024))
+SPOOL_FSYNC_INTERVAL = float(os.getenv('SPOOL_FSYNC_INTERVAL', 0.005))
+SPOOL_REPLAY_INTERVAL = float(os.getenv('SPOOL_REPLAY_INTERVAL', 0.2))
+SPOOL_REPLAY_BATCH = int(os.getenv('SPOOL_REPLAY_BATCH', 200))
+SPOOL_MAX_ATTEMPTS = int(os.getenv('SPOOL_MAX_ATTEMPTS', 5))
+# Espera máxima de `agregar` hasta que el registro es durable
+SPOOL_SYNC_TIMEOUT = 5.0
+# Pausa máxima entre reintentos cuando MySQL no acepta los registros
+SPOOL_BACKOFF_MAX = 30.0
+
+CABECERA = struct.Struct('<II')  # longitud, crc32 del JSON
+CHECKPOINT = 'checkpoint.json'
+DEAD_LETTER = 'dead-letter.ndjson'
+
+
+def codificar(registro):
+    datos = dumps(registro)
+    return CABECERA.pack(len(datos), zlib.crc32(datos)) + datos
+
+
+def leer_registros(ruta, desde=0, limite=None):
+    """
+    Registros válidos de un segmento a partir del offset `desde`.
+
+    Devuelve ([(offset_fin, registro)], completo): completo es False si se
+    encontró un registro incompleto o corrupto antes del final del archivo.
+    """
+    registros = []
+    with open(ruta, 'rb') as f:
+        f.seek(desde)
+        posicion = desde
+        while limite is None or len(registros) < limite:
+            cabecera = f.read(CABECERA.size)
+            if not cabecera:
+                return registros, True
+            if len(cabecera) < CABECERA.size:
+                return registros, False
+            longitud, crc = CABECERA.unpack(cabecera)
+            datos = f.read(longitud)
+            if len(datos) < longitud or zlib.crc32(datos) != crc:
+                return registros, False
+            posicion += CABECERA.size + longitud
+            registros.append((posicion, json.loads(datos)))
+    return registros, True
+
+
+def _segmentos(directorio):
+    try:
+        return sorted(n for n in os.listdir(directorio) if n.startswith('seg-') and n.endswith('.wal'))
+    except FileNotFoundError:
+        return []
+
+
+def _segmento_cerrado(ruta):
+    """True si ningún proceso escribe en el segmento (nadie tiene su flock)."""
+    try:
+        with open(ruta, 'rb') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return True
+    except FileNotFoundError:
+        return True
+
+
+def _fsync_directorio(directorio):
+    fd = os.open(directorio, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _leer_checkpoint(directorio):
+    try:
+        with open(os.path.join(directorio, CHECKPOINT), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'offsets': {}}
+
+
+class EscritorSpool:
+    """Añade registros al segmento de este proceso con fsync agrupado."""
+
+    def __init__(self, directorio=SPOOL_DIR, segmento_max=SPOOL_SEGMENT_BYTES, intervalo_fsync=SPOOL_FSYNC_INTERVAL):
+        self.directorio = directorio
+        self.segmento_max = segmento_max
+        self.intervalo_fsync = intervalo_fsync
+        self._cond = threading.Condition()
+        self._pid = None
+        self._archivo = None
+        self._tamano = 0
+        self._secuencia = 0
+        self._etiqueta = None
+        self._escritos = 0
+        self._sincronizados = 0
+        self._metricas = Counter()
+        self._hilo = None
+
+    def _asegurar_proceso(self):
+        # Tras un fork el hijo abre su propio segmento (el del padre sigue siendo del padre)
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._archivo = None
+        self._tamano = 0
+        self._secuencia = 0
+        self._escritos = self._sincronizados = 0
+        self._etiqueta = f"{int(time.time() * 1000):013d}-{os.getpid()}"
+        os.makedirs(self.directorio, exist_ok=True)
+        if self.intervalo_fsync > 0:
+            self._hilo = threading.Thread(target=self._bucle_fsync, name="spool-fsync", daemon=True)
+            self._hilo.start()
+
+    def _abrir_segmento(self):
+        self._secuencia += 1
+        ruta = os.path.join(self.directorio, f"seg-{self._etiqueta}-{self._secuencia:06d}.wal")
+        archivo = open(ruta, 'ab')
+        fcntl.flock(archivo, fcntl.LOCK_SH)
+        _fsync_directorio(self.directorio)
+        self._archivo = archivo
+        self._tamano = 0
+        self._metricas['segments_opened'] += 1
+
+    def _cerrar_segmento(self):
+        if self._archivo is None:
+            return
+        self._archivo.flush()
+        os.fsync(self._archivo.fileno())
+        self._sincronizados = self._escritos
+        self._archivo.close()  # libera el flock: el reproductor lo verá como cerrado
+        self._archivo = None
+        self._cond.notify_all()
+
+    def agregar(self, registro):
+        """Escribe el registro y espera a que sea durable. True si quedó en disco."""
+        datos = codificar(registro)
+        with self._cond:
+            self._asegurar_proceso()
+            if self._archivo is None or (self._tamano and self._tamano + len(datos) > self.segmento_max):
+                self._cerrar_segmento()
+                self._abrir_segmento()
+            self._archivo.write(datos)
+            self._archivo.flush()
+            self._tamano += len(datos)
+            self._escritos += 1
+            self._metricas['appended'] += 1
+            self._metricas['bytes'] += len(datos)
+            mio = self._escritos
+            if self.intervalo_fsync <= 0:
+                os.fsync(self._archivo.fileno())
+                self._metricas['fsyncs'] += 1
+                self._sincronizados = mio
+                return True
+            return self._cond.wait_for(lambda: self._sincronizados >= mio, timeout=SPOOL_SYNC_TIMEOUT)
+
+    def _bucle_fsync(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.intervalo_fsync)
+            with self._cond:
+                if self._archivo is None or self._sincronizados >= self._escritos:
+                    continue
+                objetivo = self._escritos
+                fd = os.dup(self._archivo.fileno())  # el segmento puede rotar mientras se sincroniza
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with self._cond:
+                self._sincronizados = max(self._sincronizados, objetivo)
+                self._metricas['fsyncs'] += 1
+                self._cond.notify_all()
+
+    def cerrar(self):
+        with self._cond:
+            if self._pid == os.getpid():
+                self._cerrar_segmento()
+
+    def metricas(self):
+        with self._cond:
+            metricas = dict(self._metricas)
+        fsyncs = metricas.get('fsyncs', 0)
+        metricas['records_per_fsync'] = round(metricas.get('appended', 0) / fsyncs, 2) if fsyncs else 0.0
+        return metricas
+
+
+class ReproductorSpool:
+    """
+    Pasa los registros del spool a su destino en orden, una sola instancia por directorio.
+
+    `aplicar(registro)` devuelve True si el registro quedó aplicado (o ya lo
+    estaba); `destino_disponible()` distingue un registro inválido de un destino caído.
+    """
+
+    def __init__(self, aplicar, destino_disponible, directorio=SPOOL_DIR):
+        self.aplicar = aplicar
+        self.destino_disponible = destino_disponible
+        self.directorio = directorio
+        self._pid = None
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        self._intentos = Counter()
+        self._metricas = Counter()
+        self.activo = False
+
+    def asegurar_iniciado(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._parar = threading.Event()
+            threading.Thread(target=self._bucle, name="spool-replay", daemon=True).start()
+
+    def detener(self):
+        self._parar.set()
+
+    def _bucle(self):
+        os.makedirs(self.directorio, exist_ok=True)
+        with open(os.path.join(self.directorio, 'replay.lock'), 'a') as cerrojo:
+            # Solo un reproductor por directorio; los demás esperan por si el actual muere
+            while not self._parar.is_set():
+                try:
+                    fcntl.flock(cerrojo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    self._parar.wait(5)
+            else:
+                return
+            self.activo = True
+            logger.info(f"📼 Reproductor del spool activo en el proceso {os.getpid()}")
+            checkpoint = _leer_checkpoint(self.directorio)
+            espera = SPOOL_REPLAY_INTERVAL
+            while not self._parar.is_set():
+                try:
+                    aplicados, bloqueado = self.ronda(checkpoint)
+                except Exception as e:
+                    logger.error(f"❌ Error en el reproductor del spool: {str(e)}", exc_info=True)
+                    aplicados, bloqueado = 0, True
+                if bloqueado and not aplicados:
+                    espera = min(max(espera * 2, 1.0), SPOOL_BACKOFF_MAX)
+                elif bloqueado:
+                    espera = SPOOL_REPLAY_INTERVAL
+                elif aplicados:
+                    espera = 0
+                else:
+                    espera = SPOOL_REPLAY_INTERVAL
+                if espera:
+                    self._parar.wait(espera)
+
+    def ronda(self, checkpoint):
+        """
+        Lee hasta SPOOL_REPLAY_BATCH registros nuevos de cada segmento, los aplica
+        mezclados por marca de tiempo y avanza el checkpoint. Devuelve (aplicados, bloqueado).
+        """
+        offsets = checkpoint.setdefault('offsets', {})
+        cerrados, colas = {}, []
+        for nombre in _segmentos(self.directorio):
+            ruta = os.path.join(self.directorio, nombre)
+            cerrados[nombre] = _segmento_cerrado(ruta)  # antes de leer: si está cerrado, lo leído es todo
+            registros, completo = leer_registros(ruta, offsets.get(nombre, 0), SPOOL_REPLAY_BATCH)
+            if not completo and cerrados[nombre] and len(registros) < SPOOL_REPLAY_BATCH:
+                # Nadie escribe ya en el segmento: lo que no se pudo leer es un registro a medias
+                registros.append((os.path.getsize(ruta), None))
+            if registros:
+                colas.append([(registro.get('ts', '') if registro else '', nombre, fin, registro)
+                              for fin, registro in registros])
+
+        # Solo se reescribe el checkpoint (con fsync) si la ronda avanzó algo
+        aplicados, bloqueado, cambiado = 0, False, False
+        for _, nombre, fin, registro in heapq.merge(*colas, key=lambda r: (r[0], r[1])):
+            if registro is None:
+                logger.warning(f"⚠️ Registro incompleto o corrupto al final de {nombre}: se descarta la cola del segmento")
+                self._metricas['torn_tails'] += 1
+            elif not self._aplicar(registro):
+                bloqueado = True
+                break
+            offsets[nombre] = fin
+            aplicados += registro is not None
+            cambiado = True
+
+        # Segmentos cerrados y reproducidos por completo: se borran
+        for nombre, cerrado in cerrados.items():
+            ruta = os.path.join(self.directorio, nombre)
+            if cerrado and offsets.get(nombre, 0) >= os.path.getsize(ruta):
+                os.remove(ruta)
+                offsets.pop(nombre, None)
+                self._metricas['segments_removed'] += 1
+                cambiado = True
+
+        pendiente = None
+        for cola in colas:
+            for ts, nombre, fin, registro in cola:
+                if registro is not None and fin > offsets.get(nombre, 0):
+                    pendiente = ts if pendiente is None else min(pendiente, ts)
+                    break
+        cambiado = cambiado or checkpoint.get('oldest_pending_ts') != pendiente
+        checkpoint['oldest_pending_ts'] = pendiente
+        checkpoint['replayed'] = checkpoint.get('replayed', 0) + aplicados
+        if cambiado:
+            checkpoint['updated_at'] = time.time()
+            self._guardar_checkpoint(checkpoint)
+        return aplicados, bloqueado
+
+    def _aplicar(self, registro):
+        clave = registro.get('turno_id') or json.dumps(registro, sort_keys=True)
+        if self.aplicar(registro):
+            self._intentos.pop(clave, None)
+            self._metricas['applied'] += 1
+            return True
+        self._metricas['failures'] += 1
+        self._intentos[clave] += 1
+        if self._intentos[clave] >= SPOOL_MAX_ATTEMPTS and self.destino_disponible():
+            # El destino responde pero este registro falla siempre: apartarlo y seguir
+            with open(os.path.join(self.directorio, DEAD_LETTER), 'ab') as f:
+                f.write(dumps(registro) + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._intentos.pop(clave, None)
+            self._metricas['dead_letters'] += 1
+            logger.error(f"❌ Registro del spool apartado en {DEAD_LETTER} tras {SPOOL_MAX_ATTEMPTS} intentos: "
+                         f"{registro.get('turno_id')}")
+            return True
+        return False
+
+    def _guardar_checkpoint(self, checkpoint):
+        ruta = os.path.join(self.directorio, CHECKPOINT)
+        temporal = ruta + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, ruta)
+
+    def metricas(self):
+        return dict(self._metricas, active_in_this_process=self.activo)
+
+
+def estado_spool(directorio=SPOOL_DIR):
+    """Profundidad y retraso del spool leídos del disco (válido desde cualquier proceso)."""
+    checkpoint = _leer_checkpoint(directorio)
+    offsets = checkpoint.get('offsets', {})
+    segmentos = _segmentos(directorio)
+    pendientes = 0
+    for nombre in segmentos:
+        try:
+            pendientes += max(0, os.path.getsize(os.path.join(directorio, nombre)) - offsets.get(nombre, 0))
+        except FileNotFoundError:
+            continue
+    lag = None
+    if pendientes == 0:
+        lag = 0.0
+    elif checkpoint.get('oldest_pending_ts'):
+        lag = round(max(0.0, time.time() - datetime.fromisoformat(checkpoint['oldest_pending_ts']).timestamp()), 3)
+    try:
+        dead_letters = os.path.getsize(os.path.join(directorio, DEAD_LETTER))
+    except FileNotFoundError:
+        dead_letters = 0
+    return {
+        'segments': len(segmentos),
+        'pending_bytes': pendientes,
+        'replay_lag_seconds': lag,
+        'replayed_total': checkpoint.get('replayed', 0),
+        'checkpoint_age_seconds': round(time.time() - checkpoint['updated_at'], 1) if checkpoint.get('updated_at') else None,
+        'dead_letter_bytes': dead_letters,
+    }
+
+
+escritor = EscritorSpool()
+atexit.register(escritor.cerrar)
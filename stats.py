@@ -0,0 +1,263 @@
+"""
+stats.py - Estadísticas de conversaciones mantenidas de forma incremental (rollups)
+
+En lugar de recorrer todos los mensajes en cada consulta de /admin/stats, cada
+turno guardado actualiza unos contadores por día e idioma:
+
+- estadisticas_diarias: (dia, idioma) -> mensajes, turnos, sesiones y usuarios
+  únicos, primer y último mensaje. idioma '*' agrega todos los idiomas.
+- estadisticas_unicos: qué sesiones/usuarios ya se contaron en cada (dia, idioma),
+  para que los únicos se incrementen una sola vez (INSERT IGNORE). Con el día
+  DIA_TOTAL (1970-01-01) guarda las sesiones/usuarios de toda la historia.
+
+Los totales históricos se calculan al leer (suma de las filas diarias y conteo
+de los únicos de DIA_TOTAL): una fila de totales actualizada en cada turno
+sería un punto de bloqueo para todas las escrituras concurrentes del chat.
+
+La actualización va en la misma transacción que los mensajes (bajo un
+SAVEPOINT: si falla, el turno se guarda igual y backfill_stats.py lo corrige).
+backfill_stats.py reconstruye los rollups desde mensajes_chatbot día a día.
+"""
+
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+DIA_TOTAL = date(1970, 1, 1)
+IDIOMA_TODOS = '*'
+IDIOMA_DESCONOCIDO = 'und'  # mensajes anteriores a la columna idioma
+# Claves (ámbito, tipo, valor) ya confirmadas que se recuerdan por proceso
+STATS_SEEN_CACHE_MAX = int(os.getenv('STATS_SEEN_CACHE_MAX', 50000))
+
+BUCKETS = {
+    'day': "dia",
+    'week': "DATE_SUB(dia, INTERVAL WEEKDAY(dia) DAY)",
+    'month': "DATE_FORMAT(dia, '%%Y-%%m-01')",
+}
+
+TABLAS = [
+    """
+    CREATE TABLE IF NOT EXISTS estadisticas_diarias (
+        dia DATE NOT NULL,
+        idioma VARCHAR(8) NOT NULL,
+        mensajes INT UNSIGNED NOT NULL DEFAULT 0,
+        turnos INT UNSIGNED NOT NULL DEFAULT 0,
+        sesiones INT UNSIGNED NOT NULL DEFAULT 0,
+        usuarios INT UNSIGNED NOT NULL DEFAULT 0,
+        primer_mensaje DATETIME NULL,
+        ultimo_mensaje DATETIME NULL,
+        PRIMARY KEY (dia, idioma)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS estadisticas_unicos (
+        dia DATE NOT NULL,
+        idioma VARCHAR(8) NOT NULL,
+        tipo ENUM('sesion', 'usuario') NOT NULL,
+        valor VARCHAR(255) NOT NULL,
+        PRIMARY KEY (dia, idioma, tipo, valor)
+    )
+    """,
+]
+
+_UPSERT = """
+    INSERT INTO estadisticas_diarias
+        (dia, idioma, mensajes, turnos, sesiones, usuarios, primer_mensaje, ultimo_mensaje)
+    VALUES {filas}
+    ON DUPLICATE KEY UPDATE
+        mensajes = mensajes + VALUES(mensajes),
+        turnos = turnos + VALUES(turnos),
+        sesiones = sesiones + VALUES(sesiones),
+        usuarios = usuarios + VALUES(usuarios),
+        primer_mensaje = LEAST(COALESCE(primer_mensaje, VALUES(primer_mensaje)), VALUES(primer_mensaje)),
+        ultimo_mensaje = GREATEST(COALESCE(ultimo_mensaje, VALUES(ultimo_mensaje)), VALUES(ultimo_mensaje))
+"""
+
+_COLUMNAS = ('mensajes', 'turnos', 'sesiones', 'usuarios', 'primer_mensaje', 'ultimo_mensaje')
+
+# Totales históricos por idioma, calculados al leer (ver el docstring del módulo)
+_TOTALES = """
+    SELECT d.idioma, SUM(d.mensajes), SUM(d.turnos),
+           (SELECT COUNT(*) FROM estadisticas_unicos u
+            WHERE u.dia = %s AND u.idioma = d.idioma AND u.tipo = 'sesion'),
+           (SELECT COUNT(*) FROM estadisticas_unicos u
+            WHERE u.dia = %s AND u.idioma = d.idioma AND u.tipo = 'usuario'),
+           MIN(d.primer_mensaje), MAX(d.ultimo_mensaje)
+    FROM estadisticas_diarias d
+    WHERE d.dia > %s
+    GROUP BY d.idioma
+"""
+
+
+def _fecha(valor):
+    """Las expresiones (MIN(fecha), NOW()...) llegan como texto desde SQLite."""
+    return datetime.fromisoformat(valor) if isinstance(valor, str) else valor
+
+
+def _fila(columnas):
+    fila = dict(zip(_COLUMNAS, columnas))
+    for clave in ('mensajes', 'turnos', 'sesiones', 'usuarios'):
+        fila[clave] = int(fila[clave] or 0)
+    for clave in ('primer_mensaje', 'ultimo_mensaje'):
+        fila[clave] = _fecha(fila[clave])
+    return fila
+
+
+class RollupsEstadisticas:
+    """Actualización y lectura de los rollups. Los métodos reciben un cursor (no diccionario)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vistos = set()
+        self._dia_vistos = None
+
+    # === Escritura (por turno) ===
+    def registrar_turno(self, cursor, session_id, usuario_id, idioma, mensajes=2, momento=None):
+        """
+        Suma un turno a los rollups del día, dentro de la transacción en curso.
+
+        De los totales históricos solo se registran los únicos (una fila por
+        sesión/usuario, sin contención); los contadores se suman al leer.
+
+        momento es la fecha del turno si no es ahora (turnos reproducidos desde el spool).
+
+        Devuelve las claves de únicos insertadas; hay que pasarlas a `confirmar`
+        después del commit para no volver a consultarlas en este proceso.
+        """
+        if momento is None:
+            cursor.execute("SELECT NOW()")
+            ahora = _fecha(cursor.fetchone()[0])
+            dia = ahora.date()
+        else:
+            dia, ahora = momento.date(), momento
+        idioma = idioma or IDIOMA_DESCONOCIDO
+        ambitos = [(dia, idioma), (dia, IDIOMA_TODOS), (DIA_TOTAL, idioma), (DIA_TOTAL, IDIOMA_TODOS)]
+
+        nuevas, filas, parametros = [], [], []
+        for ambito in ambitos:
+            nuevos = {}
+            for tipo, valor in (('sesion', session_id), ('usuario', str(usuario_id))):
+                clave = (*ambito, tipo, valor)
+                if clave in self._vistos:
+                    nuevos[tipo] = 0
+                    continue
+                cursor.execute(
+                    "INSERT IGNORE INTO estadisticas_unicos (dia, idioma, tipo, valor) VALUES (%s, %s, %s, %s)",
+                    clave
+                )
+                nuevos[tipo] = cursor.rowcount
+                nuevas.append(clave)
+            if ambito[0] == DIA_TOTAL:
+                continue
+            filas.append("(%s, %s, %s, 1, %s, %s, %s, %s)")
+            parametros.extend([*ambito, mensajes, nuevos['sesion'], nuevos['usuario'], ahora, ahora])
+
+        cursor.execute(_UPSERT.format(filas=", ".join(filas)), parametros)
+        return nuevas
+
+    def confirmar(self, claves):
+        """Recuerda las claves ya contadas (tras el commit). Se vacía al cambiar de día o al llenarse."""
+        if not claves:
+            return
+        dia = max(clave[0] for clave in claves)
+        with self._lock:
+            if (dia != DIA_TOTAL and dia != self._dia_vistos) or len(self._vistos) > STATS_SEEN_CACHE_MAX:
+                self._vistos = set()
+                self._dia_vistos = dia
+            self._vistos.update(claves)
+
+    # === Lectura ===
+    def resumen(self, cursor):
+        """
+        Totales históricos por idioma ('*' = todos).
+
+        Suma las filas diarias (una por día e idioma) y cuenta los únicos de
+        DIA_TOTAL por rango de la clave primaria de estadisticas_unicos.
+        """
+        cursor.execute(_TOTALES, (DIA_TOTAL, DIA_TOTAL, DIA_TOTAL))
+        return {fila[0]: _fila(fila[1:]) for fila in cursor.fetchall()}
+
+    def serie(self, cursor, desde, hasta, bucket='day', idioma=IDIOMA_TODOS):
+        """
+        Serie temporal [{periodo, mensajes, turnos, sesiones, usuarios, ...}] entre desde y hasta (exclusivo).
+
+        Con bucket 'week' o 'month', sesiones y usuarios son la suma de los únicos
+        de cada día (sesiones-día / usuarios-día), no únicos del periodo.
+        """
+        cursor.execute(f"""
+            SELECT {BUCKETS[bucket]} AS periodo, SUM(mensajes), SUM(turnos), SUM(sesiones), SUM(usuarios),
+                   MIN(primer_mensaje), MAX(ultimo_mensaje)
+            FROM estadisticas_diarias
+            WHERE idioma = %s AND dia > %s AND dia >= %s AND dia < %s
+            GROUP BY periodo
+            ORDER BY periodo
+        """, (idioma, DIA_TOTAL, desde, hasta))
+        serie = []
+        for fila in cursor.fetchall():
+            punto = _fila(fila[1:])
+            punto['periodo'] = str(fila[0])[:10]
+            serie.append(punto)
+        return serie
+
+    # === Reconstrucción (backfill) ===
+    def rango_mensajes(self, cursor):
+        """(primer_dia, ultimo_dia) con mensajes, o None si no hay."""
+        cursor.execute("SELECT MIN(fecha), MAX(fecha) FROM mensajes_chatbot")
+        primero, ultimo = cursor.fetchone()
+        if primero is None:
+            return None
+        return _fecha(primero).date(), _fecha(ultimo).date()
+
+    def reconstruir_dia(self, cursor, dia):
+        """
+        Recalcula los rollups de un día desde mensajes_chatbot (dentro de una transacción).
+
+        Los únicos del día se reemplazan; los históricos solo se añaden (son
+        conjuntos), y los totales se recalculan aparte con `reconstruir_totales`.
+        Una fila del esquema original (sin contenido) guarda pregunta y respuesta:
+        cuenta como dos mensajes y un turno, como al guardarla, y su sesión es la
+        del usuario (su columna session_id quedó vacía al migrar).
+        """
+        inicio = datetime.combine(dia, datetime.min.time())
+        rango = (inicio, inicio + timedelta(days=1))
+        cursor.execute("DELETE FROM estadisticas_diarias WHERE dia = %s", (dia,))
+        cursor.execute("DELETE FROM estadisticas_unicos WHERE dia = %s", (dia,))
+
+        idioma = f"COALESCE(m.idioma, '{IDIOMA_DESCONOCIDO}')"
+        sesion = "COALESCE(NULLIF(m.session_id, ''), u.session_id, '')"
+        legado = "(m.contenido IS NULL AND (m.mensaje_usuario IS NOT NULL OR m.respuesta_bot IS NOT NULL))"
+        origen = """
+            FROM mensajes_chatbot m
+            LEFT JOIN usuarios_chatbot u ON u.id = m.usuario_id
+            WHERE m.fecha >= %s AND m.fecha < %s
+        """
+        for dia_ambito in (dia, DIA_TOTAL):
+            for expresion_idioma in (idioma, f"'{IDIOMA_TODOS}'"):
+                for tipo, valor in (('sesion', sesion), ('usuario', "CAST(m.usuario_id AS CHAR)")):
+                    cursor.execute(f"""
+                        INSERT IGNORE INTO estadisticas_unicos (dia, idioma, tipo, valor)
+                        SELECT DISTINCT %s, {expresion_idioma}, '{tipo}', {valor}
+                        {origen}
+                    """, (dia_ambito, *rango))
+
+        for expresion_idioma, agrupar in ((idioma, f"GROUP BY {idioma}"), (f"'{IDIOMA_TODOS}'", "HAVING COUNT(*) > 0")):
+            cursor.execute(f"""
+                INSERT INTO estadisticas_diarias
+                    (dia, idioma, mensajes, turnos, sesiones, usuarios, primer_mensaje, ultimo_mensaje)
+                SELECT %s, {expresion_idioma},
+                       SUM(CASE WHEN {legado} THEN 2 ELSE 1 END),
+                       SUM(CASE WHEN {legado} OR m.rol = 'user' THEN 1 ELSE 0 END),
+                       COUNT(DISTINCT {sesion}), COUNT(DISTINCT m.usuario_id), MIN(m.fecha), MAX(m.fecha)
+                {origen}
+                {agrupar}
+            """, (dia, *rango))
+
+    def reconstruir_totales(self, cursor):
+        """
+        Cierra una reconstrucción: los totales se calculan al leer, así que solo
+        borra las filas DIA_TOTAL de estadisticas_diarias de versiones anteriores
+        y olvida las claves recordadas por el proceso.
+        """
+        cursor.execute("DELETE FROM estadisticas_diarias WHERE dia = %s", (DIA_TOTAL,))
+        with self._lock:
+            self._vistos = set()
@@ -0,0 +1,410 @@
+"""
+storage.py - Motores de almacenamiento detrás de DatabaseManager
+
+DatabaseManager escribe SQL de MySQL y usa la API de mysql.connector
+(cursor(dictionary=True), start_transaction, commit, rollback, close). Aquí
+está lo que depende del motor: cómo se crean las conexiones, las tablas base
+y lo que necesitan las migraciones (migrations.py): inspeccionar el esquema,
+DDL online y el lock que garantiza que migra un solo proceso.
+
+- AlmacenMySQL: pool de mysql.connector (el comportamiento de siempre).
+- AlmacenSQLite: archivo SQLite embebido en modo WAL, para un despliegue de un
+  solo nodo o para arrancar, medir y probar sin servidor MySQL. Sus conexiones
+  imitan la API de mysql.connector y traducen el dialecto que usa este
+  proyecto (%s, INSERT IGNORE, ON DUPLICATE KEY UPDATE, DESCRIBE, ENUM, NOW(),
+  CURDATE(), LEAST/GREATEST, DATE_SUB/WEEKDAY/DATE_FORMAT). Requiere SQLite 3.35+.
+
+Variables de entorno:
+- DB_ENGINE: mysql | sqlite (default mysql)
+- DB_SQLITE_PATH: archivo de la base SQLite (default incalake.sqlite3)
+- DB_SQLITE_BUSY_TIMEOUT: segundos de espera si otra conexión escribe (default 5)
+- DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME: conexión MySQL
+"""
+
+import os
+import re
+import time
+import fcntl
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, date
+from functools import lru_cache
+
+import mysql.connector
+from mysql.connector import pooling, errorcode
+
+logger = logging.getLogger(__name__)
+
+DB_ENGINE = os.getenv('DB_ENGINE', 'mysql').lower()
+DB_SQLITE_PATH = os.getenv('DB_SQLITE_PATH', 'incalake.sqlite3')
+DB_SQLITE_BUSY_TIMEOUT = float(os.getenv('DB_SQLITE_BUSY_TIMEOUT', 5))
+# Conexiones del pool (MySQL) / conexiones libres que se conservan (SQLite)
+DB_POOL_SIZE = 5
+# Errores de MySQL por los que se reintenta un DDL sin ALGORITHM/LOCK (servidor sin DDL online)
+_DDL_ONLINE_NO_SOPORTADO = {1064, 1800, 1845, 1846}
+
+# Errores de base de datos de cualquiera de los motores (para los except)
+ErrorBD = (mysql.connector.Error, sqlite3.Error)
+
+
+class AlmacenMySQL:
+    nombre = 'mysql'
+    admite_replicas = True
+
+    # Esquema original; verificar_y_migrar_esquema añade el resto de columnas
+    TABLAS_BASE = [
+        """
+        CREATE TABLE IF NOT EXISTS usuarios_chatbot (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            nombre VARCHAR(255) NOT NULL,
+            correo VARCHAR(255) NOT NULL,
+            telefono VARCHAR(50),
+            fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS mensajes_chatbot (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            usuario_id INT,
+            mensaje_usuario TEXT,
+            respuesta_bot TEXT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]
+
+    def crear_pool(self):
+        try:
+            # Opciones de SSL - Intenta verificar el certificado del servidor
+            ssl_config = {
+                'ssl_disabled': False,
+                # 'ssl_verify_cert': True, # Puedes activar esto si tienes problemas de certificado
+                # 'ssl_verify_identity': True, # Puedes activar esto si tienes problemas de certificado
+                # 'ssl_ca': '/path/to/ca-cert.pem', # Si necesitas un certificado CA específico
+            }
+
+            pool = pooling.MySQLConnectionPool(
+                pool_name="incalake_pool",
+                pool_size=DB_POOL_SIZE,
+                host=os.getenv("DB_HOST"),
+                user=os.getenv("DB_USER"),
+                password=os.getenv("DB_PASSWORD"),
+                database=os.getenv("DB_NAME"),
+                port=int(os.getenv("DB_PORT", 3306)),
+                autocommit=True,
+                **ssl_config
+            )
+            logger.info("✅ Pool de conexiones MySQL creado")
+            return pool
+        except mysql.connector.Error as err:
+            if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+                logger.error("❌ Error de autenticación con MySQL")
+            elif err.errno == errorcode.ER_BAD_DB_ERROR:
+                logger.error("❌ La base de datos no existe")
+            else:
+                logger.error(f"❌ Error de conexión a MySQL: {err}")
+            raise
+
+    def columnas(self, cursor, tabla):
+        cursor.execute("""
+            SELECT column_name
+            FROM information_schema.columns
+            WHERE table_schema = %s
+            AND table_name = %s
+        """, (os.getenv("DB_NAME"), tabla))
+        return {fila[0] for fila in cursor.fetchall()}
+
+    def indices(self, cursor, tabla):
+        cursor.execute("""
+            SELECT DISTINCT index_name
+            FROM information_schema.statistics
+            WHERE table_schema = %s
+            AND table_name = %s
+        """, (os.getenv("DB_NAME"), tabla))
+        return {fila[0] for fila in cursor.fetchall()}
+
+    # === DDL online: de la variante menos bloqueante a la más compatible ===
+    def _ddl_online(self, cursor, sentencia, variantes):
+        for i, variante in enumerate(variantes):
+            try:
+                cursor.execute(sentencia + variante)
+                return
+            except mysql.connector.Error as err:
+                if i == len(variantes) - 1 or err.errno not in _DDL_ONLINE_NO_SOPORTADO:
+                    raise
+                logger.info(f"ℹ️ DDL sin '{variante.strip(', ')}' ({err.errno}), se reintenta")
+
+    def agregar_columna(self, cursor, tabla, columna, definicion):
+        self._ddl_online(cursor, f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}",
+                         (", ALGORITHM=INSTANT", ", ALGORITHM=INPLACE, LOCK=NONE", ""))
+
+    def crear_indice(self, cursor, nombre, tabla, columnas, unico=False):
+        # INPLACE + LOCK=NONE: InnoDB construye el índice sin bloquear lecturas ni escrituras
+        self._ddl_online(cursor, f"ALTER TABLE {tabla} ADD {'UNIQUE ' if unico else ''}INDEX {nombre} ({columnas})",
+                         (", ALGORITHM=INPLACE, LOCK=NONE", ""))
+
+    @contextmanager
+    def bloqueo_migraciones(self, cursor, timeout):
+        """GET_LOCK con nombre por base de datos: un solo proceso migra, en cualquier nodo."""
+        nombre = f"{os.getenv('DB_NAME')}.schema_migrations"
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (nombre, timeout))
+        if cursor.fetchone()[0] != 1:
+            raise TimeoutError(f"no se obtuvo el lock de migraciones en {timeout} s")
+        try:
+            yield
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (nombre,))
+            cursor.fetchone()
+
+
+# === SQLite ===
+_TRADUCCIONES = [
+    (re.compile(r'\bINSERT IGNORE\b'), 'INSERT OR IGNORE'),
+    (re.compile(r'\bDESCRIBE\s+(\w+)'), r"SELECT name FROM pragma_table_info('\1')"),
+    (re.compile(r"\bENUM\([^)]*\)"), 'TEXT'),
+    (re.compile(r'\bDATE_SUB\((\w+), INTERVAL (.+?) DAY\)'), r"date(\1, '-' || (\2) || ' days')"),
+]
+_DUPLICADO = re.compile(r'\bON DUPLICATE KEY UPDATE\b')
+_VALUES_COLUMNA = re.compile(r'\bVALUES\((\w+)\)')
+
+
+@lru_cache(maxsize=512)
+def traducir_sqlite(consulta):
+    """SQL del dialecto MySQL de este proyecto -> SQLite (memorizado por texto de consulta)."""
+    consulta = consulta.replace('%s', '?').replace('%%', '%')
+    for patron, reemplazo in _TRADUCCIONES:
+        consulta = patron.sub(reemplazo, consulta)
+    partes = _DUPLICADO.split(consulta, maxsplit=1)
+    if len(partes) == 2:
+        # Upsert sin destino de conflicto (SQLite 3.35+): vale cualquier clave única, como en MySQL
+        consulta = partes[0] + 'ON CONFLICT DO UPDATE SET' + _VALUES_COLUMNA.sub(r'excluded.\1', partes[1])
+    return consulta
+
+
+def _parametro(valor):
+    if isinstance(valor, datetime):
+        return valor.isoformat(' ')
+    if isinstance(valor, date):
+        return valor.isoformat()
+    return valor
+
+
+def _a_fecha_hora(valor):
+    try:
+        return datetime.fromisoformat(valor.decode())
+    except ValueError:
+        return valor.decode()
+
+
+def _a_fecha(valor):
+    try:
+        return date.fromisoformat(valor.decode()[:10])
+    except ValueError:
+        return valor.decode()
+
+
+# Columnas declaradas con estos tipos vuelven como datetime/date, igual que en mysql.connector
+for _tipo in ('TIMESTAMP', 'DATETIME'):
+    sqlite3.register_converter(_tipo, _a_fecha_hora)
+sqlite3.register_converter('DATE', _a_fecha)
+
+
+def _least(*valores):
+    return None if any(v is None for v in valores) else min(valores)
+
+
+def _greatest(*valores):
+    return None if any(v is None for v in valores) else max(valores)
+
+
+def _weekday(valor):
+    return None if valor is None else date.fromisoformat(str(valor)[:10]).weekday()
+
+
+def _date_format(valor, formato):
+    if valor is None:
+        return None
+    return datetime.fromisoformat(str(valor)).strftime(formato)
+
+
+class CursorSQLite:
+    """Cursor con la interfaz de mysql.connector que usa DatabaseManager."""
+
+    def __init__(self, cursor, diccionario=False):
+        self._cursor = cursor
+        self._diccionario = diccionario
+
+    def execute(self, consulta, parametros=()):
+        self._cursor.execute(traducir_sqlite(consulta), tuple(_parametro(p) for p in parametros or ()))
+
+    def _fila(self, fila):
+        if fila is None or not self._diccionario:
+            return fila
+        return dict(zip((d[0] for d in self._cursor.description), fila))
+
+    def fetchone(self):
+        return self._fila(self._cursor.fetchone())
+
+    def fetchall(self):
+        return [self._fila(fila) for fila in self._cursor.fetchall()]
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+
+class ConexionSQLite:
+    """Conexión en autocommit (como el pool MySQL); close() la devuelve al pool."""
+
+    def __init__(self, pool, conexion):
+        self._pool = pool
+        self._conexion = conexion
+
+    def cursor(self, dictionary=False):
+        return CursorSQLite(self._conexion.cursor(), dictionary)
+
+    def start_transaction(self):
+        # IMMEDIATE: toma el lock de escritura al empezar, sin fallos al promocionar la transacción
+        self._conexion.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        if self._conexion.in_transaction:
+            self._conexion.execute("COMMIT")
+
+    def rollback(self):
+        if self._conexion.in_transaction:
+            self._conexion.execute("ROLLBACK")
+
+    def close(self):
+        if self._conexion is not None:
+            self.rollback()
+            self._pool.devolver(self._conexion)
+            self._conexion = None
+
+
+class PoolSQLite:
+    """Conexiones a un archivo SQLite; se reutilizan hasta DB_POOL_SIZE libres."""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._libres = []
+
+    def _abrir(self):
+        conexion = sqlite3.connect(self.ruta, timeout=DB_SQLITE_BUSY_TIMEOUT, isolation_level=None,
+                                   check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("PRAGMA synchronous=NORMAL")
+        conexion.execute("PRAGMA foreign_keys=ON")
+        conexion.create_function('NOW', 0, lambda: datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        conexion.create_function('CURDATE', 0, lambda: date.today().isoformat())
+        conexion.create_function('LEAST', -1, _least, deterministic=True)
+        conexion.create_function('GREATEST', -1, _greatest, deterministic=True)
+        conexion.create_function('WEEKDAY', 1, _weekday, deterministic=True)
+        conexion.create_function('DATE_FORMAT', 2, _date_format, deterministic=True)
+        return conexion
+
+    def get_connection(self):
+        with self._lock:
+            conexion = self._libres.pop() if self._libres else None
+        return ConexionSQLite(self, conexion or self._abrir())
+
+    def devolver(self, conexion):
+        with self._lock:
+            if len(self._libres) < DB_POOL_SIZE:
+                self._libres.append(conexion)
+                return
+        conexion.close()
+
+    def _remove_connections(self):
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for conexion in libres:
+            conexion.close()
+
+
+class AlmacenSQLite:
+    nombre = 'sqlite'
+    admite_replicas = False
+
+    # Mismo esquema original que en MySQL (AUTOINCREMENT: los ids no se reutilizan tras borrar)
+    TABLAS_BASE = [
+        """
+        CREATE TABLE IF NOT EXISTS usuarios_chatbot (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre VARCHAR(255) NOT NULL,
+            correo VARCHAR(255) NOT NULL,
+            telefono VARCHAR(50),
+            fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS mensajes_chatbot (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INT,
+            mensaje_usuario TEXT,
+            respuesta_bot TEXT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]
+
+    def __init__(self, ruta=DB_SQLITE_PATH):
+        self.ruta = ruta
+
+    def crear_pool(self):
+        directorio = os.path.dirname(os.path.abspath(self.ruta))
+        os.makedirs(directorio, exist_ok=True)
+        pool = PoolSQLite(self.ruta)
+        logger.info(f"✅ Base de datos SQLite en {self.ruta} (WAL)")
+        return pool
+
+    def columnas(self, cursor, tabla):
+        cursor.execute("SELECT name FROM pragma_table_info(%s)", (tabla,))
+        return {fila[0] for fila in cursor.fetchall()}
+
+    def indices(self, cursor, tabla):
+        cursor.execute("SELECT name FROM pragma_index_list(%s)", (tabla,))
+        return {fila[0] for fila in cursor.fetchall()}
+
+    def agregar_columna(self, cursor, tabla, columna, definicion):
+        cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+
+    def crear_indice(self, cursor, nombre, tabla, columnas, unico=False):
+        cursor.execute(f"CREATE {'UNIQUE ' if unico else ''}INDEX {nombre} ON {tabla} ({columnas})")
+
+    @contextmanager
+    def bloqueo_migraciones(self, cursor, timeout):
+        """flock sobre un archivo junto a la base: un solo proceso del nodo migra."""
+        with open(self.ruta + '.migrations.lock', 'a') as cerrojo:
+            limite = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(cerrojo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > limite:
+                        raise TimeoutError(f"no se obtuvo el lock de migraciones en {timeout} s")
+                    time.sleep(0.1)
+            try:
+                yield
+            finally:
+                fcntl.flock(cerrojo, fcntl.LOCK_UN)
+
+
+def crear_almacen(motor=DB_ENGINE):
+    if motor == 'sqlite':
+        return AlmacenSQLite()
+    if motor != 'mysql':
+        logger.warning(f"⚠️ DB_ENGINE desconocido ({motor}), se usa MySQL")
+    return AlmacenMySQL()
@@ -0,0 +1,67 @@
+"""
+Pruebas del reproductor del spool (spool.py).
+
+Uso: python -m pytest tests/   (o python -m unittest discover tests)
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spool  # noqa: E402
+
+
+class RondaReproductorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directorio = tempfile.mkdtemp(prefix='spool-test-')
+        self.aplicados = []
+        self.escritor = spool.EscritorSpool(directorio=self.directorio, intervalo_fsync=0)
+        self.reproductor = spool.ReproductorSpool(
+            lambda registro: self.aplicados.append(registro) or True,
+            lambda: True,
+            directorio=self.directorio
+        )
+        self.checkpoint = spool._leer_checkpoint(self.directorio)
+        self.ruta_checkpoint = os.path.join(self.directorio, spool.CHECKPOINT)
+
+    def tearDown(self):
+        self.escritor.cerrar()
+
+    def _mtime(self):
+        return os.stat(self.ruta_checkpoint).st_mtime_ns
+
+    def test_ronda_sin_novedades_no_reescribe_el_checkpoint(self):
+        self.assertTrue(self.escritor.agregar({'turno_id': 'a', 'ts': '2024-01-01T00:00:00'}))
+        self.assertEqual(self.reproductor.ronda(self.checkpoint), (1, False))
+        antes = self._mtime()
+
+        # Con el segmento del escritor abierto y ya reproducido, nada cambia
+        for _ in range(3):
+            self.assertEqual(self.reproductor.ronda(self.checkpoint), (0, False))
+        self.assertEqual(self._mtime(), antes)
+        self.assertEqual(len(self.aplicados), 1)
+
+    def test_borrar_un_segmento_si_guarda_el_checkpoint(self):
+        self.assertTrue(self.escritor.agregar({'turno_id': 'a', 'ts': '2024-01-01T00:00:00'}))
+        self.reproductor.ronda(self.checkpoint)
+        self.escritor.cerrar()
+        antes = self._mtime()
+        os.utime(self.ruta_checkpoint, ns=(antes - 10**9, antes - 10**9))
+
+        self.assertEqual(self.reproductor.ronda(self.checkpoint), (0, False))
+        self.assertEqual(spool._segmentos(self.directorio), [])
+        self.assertEqual(spool._leer_checkpoint(self.directorio)['offsets'], {})
+        self.assertGreater(self._mtime(), antes - 10**9)
+
+        # Ya sin segmentos, las rondas siguientes tampoco escriben
+        despues = self._mtime()
+        self.reproductor.ronda(self.checkpoint)
+        self.assertEqual(self._mtime(), despues)
+
+
+if __name__ == '__main__':
+    unittest.main()
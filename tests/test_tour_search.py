@@ -0,0 +1,35 @@
+"""
+Pruebas de la extracción de restricciones de tour_search.py.
+
+Uso: python -m pytest tests/   (o python -m unittest discover tests)
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tour_search import extraer_restricciones  # noqa: E402
+
+
+class PersonasTest(unittest.TestCase):
+
+    def personas(self, texto):
+        return extraer_restricciones(texto).get('personas')
+
+    def test_numeros_completos(self):
+        self.assertEqual(self.personas("tour a uros para 2 personas"), 2)
+        self.assertEqual(self.personas("somos dos personas"), 2)
+        self.assertEqual(self.personas("120 personas"), 120)
+        self.assertEqual(self.personas("group of 4"), 4)
+
+    def test_no_toma_el_final_de_otra_palabra(self):
+        # "veintidos" termina en "dos" y "1200" en "200": ninguno es un tamaño de grupo válido
+        self.assertIsNone(self.personas("veintidos personas"))
+        self.assertIsNone(self.personas("1200 personas"))
+        self.assertIsNone(self.personas("somos veintidos"))
+
+
+if __name__ == '__main__':
+    unittest.main()
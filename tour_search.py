@@ -0,0 +1,135 @@
+"""
+tour_search.py - Búsqueda de tours por presupuesto, tamaño de grupo y destino
+
+Los tramos de precios (`precios_rango`) de todo el catálogo se parsean una
+sola vez al cargar y quedan en arrays de NumPy. Una consulta como "menos de
+$60 por persona para 4 personas en Puno" se resuelve con máscaras
+vectorizadas, sin recorrer los tours en Python ni pasar por el LLM.
+"""
+
+import re
+import numpy as np
+
+from catalog import DESTINOS, CatalogoBinario, tramos_numericos, destinos_de_tour
+
+# Bit de cada destino en la máscara por tour
+BIT_DESTINO = {destino: 1 << i for i, destino in enumerate(DESTINOS)}
+
+NUMEROS_ESCRITOS = {
+    'uno': 1, 'una': 1, 'dos': 2, 'tres': 3, 'cuatro': 4, 'cinco': 5,
+    'seis': 6, 'siete': 7, 'ocho': 8, 'nueve': 9, 'diez': 10,
+    'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
+    'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10,
+}
+_NUMERO = r'(\d{1,3}|' + '|'.join(NUMEROS_ESCRITOS) + r')'
+PATRONES_PERSONAS = [
+    re.compile(r'\b' + _NUMERO + r'\s+(?:personas?|people|persons?|pax|adult[oa]s?|adults?|viajeros?|travell?ers?|guests?)\b'),
+    re.compile(r'\b(?:somos|we\s+are|grupo\s+de|group\s+of|party\s+of)\s+' + _NUMERO + r'\b'),
+]
+PATRONES_PRESUPUESTO = [
+    re.compile(r'(?:us\$|\$|usd\s*)\s*(\d+(?:[.,]\d+)?)'),
+    re.compile(r'(\d+(?:[.,]\d+)?)\s*(?:usd|d[oó]lares|dollars|bucks|\$)'),
+]
+
+
+def _a_numero(texto):
+    return NUMEROS_ESCRITOS.get(texto) or int(texto)
+
+
+def extraer_restricciones(texto):
+    """
+    Presupuesto por persona (USD), tamaño de grupo y destino mencionados en el texto.
+
+    Devuelve un dict con las claves presentes: 'presupuesto', 'personas', 'destino'.
+    """
+    texto = texto.lower()
+    restricciones = {}
+    for patron in PATRONES_PRESUPUESTO:
+        coincidencia = patron.search(texto)
+        if coincidencia:
+            restricciones['presupuesto'] = float(coincidencia.group(1).replace(',', '.'))
+            break
+    for patron in PATRONES_PERSONAS:
+        coincidencia = patron.search(texto)
+        if coincidencia:
+            personas = _a_numero(coincidencia.group(1))
+            if personas > 0:
+                restricciones['personas'] = personas
+            break
+    destinos = destinos_de_tour({'titulo_producto': texto})
+    if len(destinos) == 1:
+        restricciones['destino'] = destinos[0]
+    return restricciones
+
+
+def filtra_por_precio(restricciones):
+    """True si las restricciones piden filtrar por precio o grupo (no solo por destino)."""
+    return 'presupuesto' in restricciones or 'personas' in restricciones
+
+
+class IndicePrecios:
+    """
+    Tramos de precio de todo el catálogo en arrays contiguos.
+
+    Los tramos de un tour ocupan el rango [inicio[i], inicio[i+1]) de
+    `desde`/`hasta`/`precio`; por tour se guardan prioridad y máscara de destinos.
+    """
+
+    def __init__(self, tours):
+        n = len(tours)
+        if isinstance(tours, CatalogoBinario):
+            # Las columnas del binario ya son arrays: vistas sin copia sobre el mmap
+            self.inicio = np.frombuffer(tours.inicio_tramos, dtype=np.uint32).astype(np.int64)
+            self.desde = np.frombuffer(tours.desde, dtype=np.uint32)
+            self.hasta = np.frombuffer(tours.hasta, dtype=np.uint32)
+            self.precio = np.frombuffer(tours.precio, dtype=np.float64)
+            self.prioridad = np.frombuffer(tours.prioridades, dtype=np.int32)
+        else:
+            tramos = [tramos_numericos(tour) for tour in tours]
+            self.inicio = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum([len(t) for t in tramos], out=self.inicio[1:])
+            planos = [tramo for t in tramos for tramo in t]
+            self.desde = np.array([d for d, _, _ in planos], dtype=np.uint32)
+            self.hasta = np.array([h for _, h, _ in planos], dtype=np.uint32)
+            self.precio = np.array([p for _, _, p in planos], dtype=np.float64)
+            self.prioridad = np.array([tour.get('prioridad', 5) for tour in tours], dtype=np.int32)
+        # Tour al que pertenece cada tramo
+        self.tour_de_tramo = np.repeat(np.arange(n), np.diff(self.inicio))
+        self.destinos = np.zeros(n, dtype=np.uint8)
+        for i, tour in enumerate(tours):
+            for destino in destinos_de_tour(tour):
+                self.destinos[i] |= BIT_DESTINO[destino]
+        self.n = n
+
+    def buscar(self, presupuesto=None, personas=None, destino=None, limite=None):
+        """
+        Tours que cumplen las restricciones, ordenados por prioridad y precio.
+
+        Devuelve una lista de (indice, precio_por_persona). Con `personas` se usa
+        el tramo que corresponde a ese tamaño de grupo; sin él, el tramo más
+        barato. Con `presupuesto` o `personas`, los tours sin precio se excluyen.
+        """
+        mascara_tramos = np.ones(len(self.precio), dtype=bool)
+        if personas is not None:
+            mascara_tramos &= (self.desde <= personas) & (self.hasta >= personas)
+        if presupuesto is not None:
+            mascara_tramos &= self.precio <= presupuesto
+
+        # Mejor precio por tour entre sus tramos válidos (inf si ninguno)
+        mejor = np.full(self.n, np.inf)
+        np.minimum.at(mejor, self.tour_de_tramo[mascara_tramos], self.precio[mascara_tramos])
+
+        if presupuesto is not None or personas is not None:
+            mascara_tours = np.isfinite(mejor)
+        else:
+            mascara_tours = np.ones(self.n, dtype=bool)
+        if destino is not None:
+            bit = BIT_DESTINO.get(destino.capitalize())
+            if bit is None:
+                return []
+            mascara_tours &= (self.destinos & bit) != 0
+
+        indices = np.flatnonzero(mascara_tours)
+        orden = np.lexsort((mejor[indices], self.prioridad[indices]))
+        indices = indices[orden][:limite]
+        return [(int(i), float(mejor[i]) if np.isfinite(mejor[i]) else None) for i in indices]
@@ -0,0 +1,378 @@
+"""
+upstream.py - Gobernador de llamadas al modelo (Gemini)
+
+Limita la concurrencia hacia la API con un límite AIMD, reintenta con backoff
+exponencial + jitter los errores recuperables (429/5xx) y abre un circuito
+cuando el upstream cae, para fallar rápido en vez de acumular hilos.
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Códigos HTTP que vale la pena reintentar
+CODIGOS_REINTENTABLES = {408, 429, 500, 502, 503, 504}
+# Códigos que indican saturación del upstream (reducen el límite AIMD)
+CODIGOS_SOBRECARGA = {429, 503, 504}
+
+# Nombres de excepciones de google.api_core sin atributo .code numérico
+_CODIGOS_POR_NOMBRE = {
+    'ResourceExhausted': 429,
+    'TooManyRequests': 429,
+    'InternalServerError': 500,
+    'BadGateway': 502,
+    'ServiceUnavailable': 503,
+    'DeadlineExceeded': 504,
+    'GatewayTimeout': 504,
+    'RetryError': 503,
+    'TimeoutError': 504,
+    'ConnectionError': 503,
+}
+
+_FIN = object()
+
+
+class UpstreamNoDisponible(Exception):
+    """Se lanza cuando el circuito está abierto o se agota la espera en cola."""
+
+
+def codigo_error(exc):
+    """Obtiene el código HTTP asociado a una excepción del upstream (o None)."""
+    code = getattr(exc, 'code', None)
+    if code is not None:
+        try:
+            return int(code)
+        except (TypeError, ValueError):
+            pass
+    for clase in type(exc).__mro__:
+        if clase.__name__ in _CODIGOS_POR_NOMBRE:
+            return _CODIGOS_POR_NOMBRE[clase.__name__]
+    return None
+
+
+def es_reintentable(exc):
+    return codigo_error(exc) in CODIGOS_REINTENTABLES
+
+
+def cancelar_respuesta(respuesta):
+    """
+    Cancela (best effort) una respuesta en streaming del upstream desde otro hilo.
+
+    Las respuestas de google.generativeai envuelven el stream gRPC en `_iterator`,
+    que expone cancel(); el proveedor fake expone cancel() directamente.
+    """
+    for objeto in (respuesta, getattr(respuesta, '_iterator', None)):
+        cancel = getattr(objeto, 'cancel', None)
+        if callable(cancel):
+            try:
+                cancel()
+                return True
+            except Exception:
+                pass
+    return False
+
+
+def _cerrar_iterador(iterador):
+    close = getattr(iterador, 'close', None)
+    if callable(close):
+        try:
+            close()
+        except Exception:
+            pass
+
+
+class UpstreamGovernor:
+    """Semáforo adaptativo (AIMD) + reintentos + circuit breaker."""
+
+    def __init__(self, nombre='gemini', limite_inicial=4, limite_min=1, limite_max=16,
+                 factor_reduccion=0.5, espera_max_cola=10.0, max_reintentos=2,
+                 backoff_base=0.5, backoff_max=8.0, umbral_circuito=5,
+                 enfriamiento_circuito=30.0, muestras_metricas=1000):
+        self.nombre = nombre
+        self.limite = float(limite_inicial)
+        self.limite_min = limite_min
+        self.limite_max = limite_max
+        self.factor_reduccion = factor_reduccion
+        self.espera_max_cola = espera_max_cola
+        self.max_reintentos = max_reintentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.umbral_circuito = umbral_circuito
+        self.enfriamiento_circuito = enfriamiento_circuito
+
+        self._cond = threading.Condition()
+        self._en_vuelo = 0
+        self._en_cola = 0
+
+        # Estado del circuito: 'closed', 'open' o 'half_open'
+        self._circuito = 'closed'
+        self._fallos_consecutivos = 0
+        self._abierto_desde = 0.0
+        self._sonda_en_vuelo = False
+
+        self._esperas = deque(maxlen=muestras_metricas)
+        self._contadores = {
+            'llamadas': 0,
+            'exitos': 0,
+            'fallos': 0,
+            'reintentos': 0,
+            'sobrecargas': 0,
+            'rechazos_circuito': 0,
+            'rechazos_cola': 0,
+            'cancelaciones': 0,
+            'aperturas_circuito': 0,
+        }
+
+    @classmethod
+    def desde_entorno(cls, nombre='gemini', prefijo='GEMINI'):
+        """Crea un gobernador leyendo la configuración de variables de entorno."""
+        def env(clave, defecto, tipo=float):
+            return tipo(os.getenv(f"{prefijo}_{clave}", defecto))
+
+        return cls(
+            nombre=nombre,
+            limite_inicial=env('CONCURRENCY_INITIAL', 4, int),
+            limite_min=env('CONCURRENCY_MIN', 1, int),
+            limite_max=env('CONCURRENCY_MAX', 16, int),
+            espera_max_cola=env('QUEUE_TIMEOUT', 10.0),
+            max_reintentos=env('MAX_RETRIES', 2, int),
+            backoff_base=env('BACKOFF_BASE', 0.5),
+            backoff_max=env('BACKOFF_MAX', 8.0),
+            umbral_circuito=env('CIRCUIT_THRESHOLD', 5, int),
+            enfriamiento_circuito=env('CIRCUIT_COOLDOWN', 30.0),
+        )
+
+    # --- Circuit breaker ---
+    def _verificar_circuito(self):
+        """Lanza UpstreamNoDisponible si el circuito no admite la llamada."""
+        with self._cond:
+            if self._circuito == 'closed':
+                return
+            if self._circuito == 'open':
+                if time.monotonic() - self._abierto_desde < self.enfriamiento_circuito:
+                    self._contadores['rechazos_circuito'] += 1
+                    raise UpstreamNoDisponible(f"Circuito abierto para {self.nombre}")
+                self._circuito = 'half_open'
+                self._sonda_en_vuelo = False
+                logger.info(f"🟡 Circuito {self.nombre} en half-open, enviando sonda")
+            # half_open: solo una sonda a la vez
+            if self._sonda_en_vuelo:
+                self._contadores['rechazos_circuito'] += 1
+                raise UpstreamNoDisponible(f"Circuito {self.nombre} probando recuperación")
+            self._sonda_en_vuelo = True
+
+    def _registrar_exito(self):
+        with self._cond:
+            self._contadores['exitos'] += 1
+            self._fallos_consecutivos = 0
+            if self._circuito != 'closed':
+                logger.info(f"🟢 Circuito {self.nombre} cerrado de nuevo")
+            self._circuito = 'closed'
+            self._sonda_en_vuelo = False
+            # Incremento aditivo: ~+1 por cada ventana de `limite` éxitos
+            self.limite = min(self.limite_max, self.limite + 1.0 / max(self.limite, 1.0))
+            self._cond.notify_all()
+
+    def _registrar_sobrecarga(self, exc):
+        """Decremento multiplicativo ante cada 429/503/504, también en intentos que luego se reintentan."""
+        if codigo_error(exc) not in CODIGOS_SOBRECARGA:
+            return
+        with self._cond:
+            self._contadores['sobrecargas'] += 1
+            self.limite = max(float(self.limite_min), self.limite * self.factor_reduccion)
+
+    def _registrar_fallo(self, exc):
+        """Resultado final fallido de una llamada: contadores y circuito (el límite ya lo ajustó _registrar_sobrecarga)."""
+        codigo = codigo_error(exc)
+        with self._cond:
+            self._contadores['fallos'] += 1
+            self._sonda_en_vuelo = False
+            if codigo not in CODIGOS_REINTENTABLES:
+                # Errores del cliente (400, 403...) no dicen nada de la salud del upstream
+                if self._circuito == 'half_open':
+                    self._circuito = 'closed'
+                return
+            self._fallos_consecutivos += 1
+            if self._circuito == 'half_open' or self._fallos_consecutivos >= self.umbral_circuito:
+                if self._circuito != 'open':
+                    self._contadores['aperturas_circuito'] += 1
+                    logger.warning(f"🔴 Circuito {self.nombre} abierto tras {self._fallos_consecutivos} fallos (último: {codigo})")
+                self._circuito = 'open'
+                self._abierto_desde = time.monotonic()
+
+    def _liberar_sonda(self):
+        with self._cond:
+            self._sonda_en_vuelo = False
+
+    # --- Semáforo adaptativo ---
+    def _adquirir(self):
+        inicio = time.monotonic()
+        limite_espera = inicio + self.espera_max_cola
+        with self._cond:
+            self._en_cola += 1
+            try:
+                while self._en_vuelo >= max(int(self.limite), self.limite_min):
+                    restante = limite_espera - time.monotonic()
+                    if restante <= 0:
+                        self._contadores['rechazos_cola'] += 1
+                        raise UpstreamNoDisponible(f"Tiempo de espera agotado en la cola de {self.nombre}")
+                    self._cond.wait(restante)
+                self._en_vuelo += 1
+            finally:
+                self._en_cola -= 1
+            self._esperas.append(time.monotonic() - inicio)
+
+    def _liberar(self):
+        with self._cond:
+            self._en_vuelo -= 1
+            self._cond.notify()
+
+    def _backoff(self, intento):
+        """Backoff exponencial con full jitter."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** intento)))
+
+    # --- API pública ---
+    def call(self, fn, *args, **kwargs):
+        """Ejecuta una llamada no-streaming bajo el gobernador."""
+        self._verificar_circuito()
+        try:
+            self._adquirir()
+        except UpstreamNoDisponible:
+            self._liberar_sonda()
+            raise
+        with self._cond:
+            self._contadores['llamadas'] += 1
+        try:
+            intento = 0
+            while True:
+                try:
+                    resultado = fn(*args, **kwargs)
+                    self._registrar_exito()
+                    return resultado
+                except Exception as e:
+                    self._registrar_sobrecarga(e)
+                    if not es_reintentable(e) or intento >= self.max_reintentos:
+                        self._registrar_fallo(e)
+                        raise
+                    intento += 1
+                    with self._cond:
+                        self._contadores['reintentos'] += 1
+                    logger.warning(f"🔁 Reintento {intento}/{self.max_reintentos} en {self.nombre}: {e}")
+                    time.sleep(self._backoff(intento))
+        finally:
+            self._liberar()
+
+    def stream(self, factory, cancelado=None):
+        """
+        Generador que envuelve una respuesta en streaming.
+
+        `factory()` debe devolver un iterable de chunks. Solo se reintenta antes
+        del primer chunk; una vez entregado contenido al cliente no se repite.
+        El slot de concurrencia se mantiene hasta agotar o cerrar el generador.
+        Si `cancelado` (threading.Event) está activo, los errores provocados por
+        la cancelación cuentan como cancelaciones y no como fallos del upstream.
+        """
+        self._verificar_circuito()
+        try:
+            self._adquirir()
+        except UpstreamNoDisponible:
+            self._liberar_sonda()
+            raise
+        with self._cond:
+            self._contadores['llamadas'] += 1
+
+        registrado = False
+        iniciado = False
+        iterador = None
+        try:
+            intento = 0
+            while True:
+                try:
+                    iterador = iter(factory())
+                    primero = next(iterador, _FIN)
+                    break
+                except Exception as e:
+                    cancelada = cancelado is not None and cancelado.is_set()
+                    if not cancelada:
+                        self._registrar_sobrecarga(e)
+                    if cancelada or not es_reintentable(e) or intento >= self.max_reintentos:
+                        raise
+                    intento += 1
+                    with self._cond:
+                        self._contadores['reintentos'] += 1
+                    logger.warning(f"🔁 Reintento {intento}/{self.max_reintentos} en {self.nombre}: {e}")
+                    time.sleep(self._backoff(intento))
+
+            iniciado = True
+            if primero is not _FIN:
+                yield primero
+                for chunk in iterador:
+                    yield chunk
+            registrado = True
+            self._registrar_exito()
+        except GeneratorExit:
+            # El consumidor cerró el stream: no es un fallo del upstream
+            registrado = True
+            self._registrar_cancelacion()
+            _cerrar_iterador(iterador)
+            raise
+        except Exception as e:
+            if not registrado:
+                registrado = True
+                if cancelado is not None and cancelado.is_set():
+                    self._registrar_cancelacion()
+                else:
+                    if iniciado:
+                        # Los errores antes del primer chunk ya ajustaron el límite en el bucle
+                        self._registrar_sobrecarga(e)
+                    self._registrar_fallo(e)
+            raise
+        finally:
+            self._liberar()
+
+    def _registrar_cancelacion(self):
+        with self._cond:
+            self._contadores['cancelaciones'] += 1
+            self._sonda_en_vuelo = False
+
+    @property
+    def estado_circuito(self):
+        with self._cond:
+            if self._circuito == 'open' and time.monotonic() - self._abierto_desde >= self.enfriamiento_circuito:
+                return 'half_open'
+            return self._circuito
+
+    def metrics(self):
+        """Devuelve un snapshot de métricas (incluye tiempos de espera en cola)."""
+        with self._cond:
+            esperas = sorted(self._esperas)
+            contadores = dict(self._contadores)
+            snapshot = {
+                'name': self.nombre,
+                'limit': round(self.limite, 2),
+                'in_flight': self._en_vuelo,
+                'queued': self._en_cola,
+                'circuit': self._circuito,
+                'consecutive_failures': self._fallos_consecutivos,
+            }
+
+        def percentil(p):
+            if not esperas:
+                return 0.0
+            return round(esperas[min(len(esperas) - 1, int(p * len(esperas)))] * 1000, 2)
+
+        snapshot['counters'] = contadores
+        snapshot['queue_wait_ms'] = {
+            'samples': len(esperas),
+            'avg': round(sum(esperas) / len(esperas) * 1000, 2) if esperas else 0.0,
+            'p50': percentil(0.50),
+            'p95': percentil(0.95),
+            'p99': percentil(0.99),
+            'max': round(esperas[-1] * 1000, 2) if esperas else 0.0,
+        }
+        return snapshot
@@ -13,15 +13,22 @@ load_dotenv()
 # Agregar directorio actual al path
 sys.path.insert(0, os.path.dirname(__file__))
 
+import time
+import logging
+
 # Importar y configurar la app
-from app import app, initialize_app
+from app import app, initialize_app, metricas_arranque
+
+logger = logging.getLogger(__name__)
 
-# Inicializar aplicación
+# Inicializar aplicación (con gunicorn.conf.py esto corre una sola vez, en el master)
 try:
+    inicio = time.perf_counter()
     initialize_app()
-    print("✅ Aplicación inicializada correctamente para WSGI")
+    metricas_arranque['initialize_ms'] = round((time.perf_counter() - inicio) * 1000, 2)
+    logger.info("✅ Aplicación inicializada correctamente para WSGI")
 except Exception as e:
-    print(f"❌ Error inicializando aplicación: {e}")
+    logger.exception(f"❌ Error inicializando aplicación: {e}")
     raise
 
 # Para Gunicorn
@@ -30,5 +37,5 @@ application = app
 # Para testing local con wsgi
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5000))
-    print(f"🚀 Ejecutando en modo de desarrollo en puerto {port}")
+    logger.info(f"🚀 Ejecutando en modo de desarrollo en puerto {port}")
     app.run(host='0.0.0.0', port=port, debug=False)